@@ -6,6 +6,7 @@ from sklearn.pipeline import Pipeline
 from sklearn.preprocessing import FunctionTransformer
 import plotly.express as px
 import os
+from experiments.uploads.blob_store import replaced_output
 
 def remove_useless_userparams(featurexml_path):
     """
@@ -18,7 +19,10 @@ def remove_useless_userparams(featurexml_path):
         fm.clearMetaInfo()
         for f in fm:
             f.clearMetaInfo()
-        oms.FeatureXMLFile().store(featurexml_path, fm)
+        # The upload may be a link to a blob shared with other folders: write a new file and rename
+        # it over the link instead of rewriting the blob in place
+        with replaced_output(featurexml_path) as temp_path:
+            oms.FeatureXMLFile().store(temp_path, fm)
     except Exception as e:
         print(f"[WARN] Could not clean UserParams from {featurexml_path}: {e}")
 
@@ -51,16 +55,18 @@ def load_files(consensus_path, db_mapping_path, db_structure_path, adducts_path,
     # Pass ConsensusMap object instead of file path
     ams.run(consensus_map, mztab)
     consensus_basename = os.path.basename(consensus_path).rsplit(".", 1)[0]
-    oms.MzTabFile().store(os.path.join(uploads_dir, f"{consensus_basename}_ids.tsv"), mztab)
+    with replaced_output(os.path.join(uploads_dir, f"{consensus_basename}_ids.tsv")) as temp_path:
+        oms.MzTabFile().store(temp_path, mztab)
     
     fig_id, id_file, id_filtered_file = plot_identifications(consensus_map, mztab, uploads_dir, consensus_basename)
     
    
 
-    with open(os.path.join(uploads_dir, f"{consensus_basename}_ids_smsection.tsv"), "w") as output, open(os.path.join(uploads_dir, f"{consensus_basename}_ids.tsv"), "r") as input:
-        for line in input:
-            if line.startswith("SM"):
-                output.write(line[4:])
+    with replaced_output(os.path.join(uploads_dir, f"{consensus_basename}_ids_smsection.tsv")) as temp_path:
+        with open(temp_path, "w") as output, open(os.path.join(uploads_dir, f"{consensus_basename}_ids.tsv"), "r") as input:
+            for line in input:
+                if line.startswith("SM"):
+                    output.write(line[4:])
 
     ams_df = pd.read_csv(os.path.join(uploads_dir, f"{consensus_basename}_ids_smsection.tsv"), sep="\t")
 
@@ -71,13 +77,15 @@ def load_files(consensus_path, db_mapping_path, db_structure_path, adducts_path,
     csv = ams_df.to_csv(index=False)
     csv_path = os.path.join(uploads_dir, f"{consensus_basename}_ids_smsection.csv")
 
-    with open(csv_path, "w", encoding="utf-8") as f:
-        f.write(csv)
+    with replaced_output(csv_path) as temp_path:
+        with open(temp_path, "w", encoding="utf-8") as f:
+            f.write(csv)
 
     csv_filtered = ams_df[ams_df['identifier'].notnull()]
     csv_filtered_path = os.path.join(uploads_dir, f"{consensus_basename}_ids_smsection_filtered.csv")
     identifications_filtered_path = os.path.join(uploads_dir, f"{consensus_basename}_ids_with_identifications.tsv")
-    csv_filtered.to_csv(csv_filtered_path, index=False)
+    with replaced_output(csv_filtered_path) as temp_path:
+        csv_filtered.to_csv(temp_path, index=False)
     
     return csv_path, csv_filtered_path, identifications_filtered_path, fig_id
 
@@ -174,7 +182,8 @@ def plot_identifications(consensus_map, mztab, uploads_dir, consensus_basename):
     
     # Filter only features with identifications
     id_df_filtered = id_df[id_df["identifications"] != ""].copy()
-    id_df_filtered.to_csv(os.path.join(uploads_dir, f"{consensus_basename}_ids_with_identifications.tsv"), sep="\t", index=False)
+    with replaced_output(os.path.join(uploads_dir, f"{consensus_basename}_ids_with_identifications.tsv")) as temp_path:
+        id_df_filtered.to_csv(temp_path, sep="\t", index=False)
     # print(f"Resultado solo con identificaciones guardado en {consensus_basename}_ids_with_identifications.tsv: {id_df_filtered.shape}")
     # print(f"Features con identificaciones: {len(id_df_filtered)} de {len(id_df)} ({len(id_df_filtered)/len(id_df)*100:.2f}%)")
 
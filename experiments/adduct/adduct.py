@@ -1,6 +1,8 @@
 import pyopenms as oms
 import pandas as pd
 import os
+from experiments.parallel.pool import file_task_memory, parallel_workers, run_parallel
+from experiments.uploads.blob_store import replaced_output
 
 
 def convert_adducts_csv_to_ams_tsv(input_csv, output_tsv):
@@ -26,6 +28,13 @@ def convert_adducts_csv_to_ams_tsv(input_csv, output_tsv):
             ams_df.to_csv(output_tsv, sep="\t", index=False, encoding="utf-8", lineterminator='\n')
 
 
+def load_feature_map(file):
+    # Create a FeatureMap and load the featureXML file
+    feature_map = oms.FeatureMap()
+    oms.FeatureXMLFile().load(file, feature_map)
+    return feature_map
+
+
 def process_adducts(file, output_dir, mode="positive"):
     """
     Process adducts for a single file.
@@ -38,10 +47,26 @@ def process_adducts(file, output_dir, mode="positive"):
     Returns:
         Tuple of (csv_file, featureXML_file, db_file) paths
     """
-    # Create a FeatureMap and load the featureXML file
-    feature_map = oms.FeatureMap()
-    oms.FeatureXMLFile().load(file, feature_map)
+    return deconvolve_adducts(load_feature_map(file), file, output_dir, mode)
+
+
+def process_adducts_modes(file, output_dir, modes):
+    """
+    Process adducts for a single file in several modes, loading the featureXML only once
+    (the deconvolution does not modify its input map).
     
+    Returns:
+        List with the (csv_file, featureXML_file, db_file) paths of each mode
+    """
+    feature_map = load_feature_map(file)
+    return [deconvolve_adducts(feature_map, file, output_dir, mode) for mode in modes]
+
+
+def deconvolve_adducts(feature_map, file, output_dir, mode="positive"):
+    """
+    MetaboliteFeatureDeconvolution of a loaded FeatureMap (file is the featureXML it was read from,
+    used to name the outputs). Returns the (csv_file, featureXML_file, db_file) paths.
+    """
     # Initialize MetaboliteFeatureDeconvolution
     mfd = oms.MetaboliteFeatureDeconvolution()
     
@@ -87,11 +112,13 @@ def process_adducts(file, output_dir, mode="positive"):
     output_file2 = f"{output_dir}/{base_name}{suffix}.featureXML"
     output_file3 = f"{output_dir}/{base_name}{suffix}_db.tsv"
     
-    # Save the DataFrame to a CSV file
-    df.to_csv(output_file, index=False)
+    # Save the DataFrame to a CSV file (outputs are renamed into place: the adducts folder holds uploads linked to blobs)
+    with replaced_output(output_file) as temp_path:
+        df.to_csv(temp_path, index=False)
     
     # Save the featureXML file
-    oms.FeatureXMLFile().store(output_file2, feature_map_MFD)
+    with replaced_output(output_file2) as temp_path:
+        oms.FeatureXMLFile().store(temp_path, feature_map_MFD)
     
     # Prepare and save the adduct database file
     df2 = df.filter(items=['adduct', 'charge']).copy()
@@ -117,7 +144,8 @@ def process_adducts(file, output_dir, mode="positive"):
         df_out = pd.DataFrame(adduct_rows)
         print(f"{mode.capitalize()} adducts:")
         print(df_out.head(10))
-        df_out.to_csv(output_file3, index=False, header=False, sep=";")
+        with replaced_output(output_file3) as temp_path:
+            df_out.to_csv(temp_path, index=False, header=False, sep=";")
     
     return output_file, output_file2, output_file3
 
@@ -144,16 +172,23 @@ def get_adduct_files(file_paths, output_dir, modes=None):
     
     results = {}
     
-    for mode in modes:
-        output_files = []
-        output_files2 = []
-        output_files3 = []
-        
-        for file in file_paths:
-            csv_file, feature_file, db_file = process_adducts(file, output_dir, mode)
-            output_files.append(csv_file)
-            output_files2.append(feature_file)
-            output_files3.append(db_file)
+    task_memory = max((file_task_memory(file) for file in file_paths), default=None)
+    if len(file_paths) >= parallel_workers(len(file_paths) * len(modes), task_memory):
+        # Enough files to keep every worker busy: one task per file, which loads the featureXML
+        # once and runs all the modes on it
+        file_outputs = run_parallel(process_adducts_modes, [(file, output_dir, modes) for file in file_paths],
+                                    task_memory=task_memory)
+        outputs = [file_outputs[j][i] for i in range(len(modes)) for j in range(len(file_paths))]
+    else:
+        # Fewer files than workers: every (file, mode) pair in its own worker, so the modes of a file run at the same time
+        tasks = [(file, output_dir, mode) for mode in modes for file in file_paths]
+        outputs = run_parallel(process_adducts, tasks, task_memory=task_memory)
+    
+    for i, mode in enumerate(modes):
+        mode_outputs = outputs[i * len(file_paths):(i + 1) * len(file_paths)]
+        output_files = [csv_file for csv_file, _, _ in mode_outputs]
+        output_files2 = [feature_file for _, feature_file, _ in mode_outputs]
+        output_files3 = [db_file for _, _, db_file in mode_outputs]
         
         results[mode] = {
             'csv_files': output_files,
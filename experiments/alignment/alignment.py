@@ -1,32 +1,40 @@
 import pyopenms as oms
 import os
+import re
+from experiments.loaders.experiment_cache import get_experiment, load_experiment
+from experiments.loaders.mzml_peek import peek_mzml
+from experiments.parallel.pool import file_task_memory, run_parallel
+from experiments.uploads.blob_store import replaced_output
 
-def set_feature_maps(feature_file_paths, output_dir):
-    feature_maps = []
-    for feature_file in feature_file_paths:
-            
-        file_path = os.path.join(output_dir, feature_file)
-        feature_map = oms.FeatureMap()
-        oms.FeatureXMLFile().load(file_path, feature_map)  
-            
-        # Check for unique IDs
-        feature_map.setUniqueIds()
-            
-        # Store the filename as meta value for later reference
-        feature_map.setMetaValue("source_file", feature_file)
-        feature_maps.append(feature_map)
-        print(f"  - Loaded: {feature_file} ({feature_map.size()} features)")
-    # Use as reference the file with the highest number of features
-    ref_index = feature_maps.index(sorted(feature_maps, key=lambda x: x.size())[-1])
-    print(f"\nReference map: {feature_file_paths[ref_index]} (index: {ref_index})")
+_FEATURE_LIST_COUNT = re.compile(rb'<featureList\s+count="(\d+)"')
+
+
+def feature_count(file_path):
+    """
+    Number of features of a featureXML file, from the count of its featureList (no feature is parsed)
+    """
+    with open(file_path, "rb") as f:
+        match = _FEATURE_LIST_COUNT.search(f.read(64 * 1024))
+    if match:
+        return int(match.group(1))
+    feature_map = oms.FeatureMap()
+    oms.FeatureXMLFile().load(file_path, feature_map)
+    return feature_map.size()
+
+def load_feature_map(feature_file, output_dir):
+    file_path = os.path.join(output_dir, feature_file)
+    feature_map = oms.FeatureMap()
+    oms.FeatureXMLFile().load(file_path, feature_map)  
         
-    return feature_maps, ref_index
+    # Check for unique IDs
+    feature_map.setUniqueIds()
         
-def align_files(feature_file_paths, mzML_file_paths, resolution, output_dir, value):
-    # Create feature maps
-    feature_maps, ref_index = set_feature_maps(feature_file_paths, output_dir)
-
+    # Store the filename as meta value for later reference
+    feature_map.setMetaValue("source_file", feature_file)
+    print(f"  - Loaded: {feature_file} ({feature_map.size()} features)")
+    return feature_map
 
+def set_aligner(resolution, value):
     # Set parameters for the aligner
     aligner = oms.MapAlignmentAlgorithmPoseClustering()
     aligner_par = aligner.getDefaults()
@@ -51,110 +59,133 @@ def align_files(feature_file_paths, mzML_file_paths, resolution, output_dir, val
         aligner_par.setValue("pairfinder:distance_MZ:max_difference", float(value))  # 0.5-1.0 Da
         
     aligner.setParameters(aligner_par)
-    aligner.setReference(feature_maps[ref_index])
+    return aligner
 
-    # Dictionary for transformation files
-    transform_files = {}
-    
-    print("\nAligning feature maps...")
-    
-    for i, feature_map in enumerate(feature_maps):
-        if i == ref_index:
-            # The reference map does not need transformation
-            source_file = str(feature_map.getMetaValue("source_file"))
-            transform_files[source_file] = None
-            print(f"  - {feature_file_paths[i]}: REFERENCE (no transformation)")
-            continue
-        
-        transformation = oms.TransformationDescription()
-        aligner.align(feature_map, transformation)
-    
-        # Save the transformation
-        source_file = str(feature_map.getMetaValue("source_file"))    
-        transform_files[source_file] = transformation
+def align_one_file(feature_file, mzML_file, reference_file, resolution, value, output_dir):
+    """
+    Align one feature map (and its mzML file) to the reference map and save both.
+    Runs in a worker process of the shared pool: every worker loads the reference itself.
+    Returns (aligned featureXML, aligned mzML or None, MS levels of the mzML or None).
+    """
+    feature_map = load_feature_map(feature_file, output_dir)
+
+    tran_description = None
+    if feature_file == reference_file:
+        # The reference map does not need transformation
+        print(f"  - {feature_file}: REFERENCE (no transformation)")
+    else:
+        aligner = set_aligner(resolution, value)
+        aligner.setReference(load_feature_map(reference_file, output_dir))
+
+        tran_description = oms.TransformationDescription()
+        aligner.align(feature_map, tran_description)
     
         # Apply the transformation
         transformer = oms.MapAlignmentTransformer()
-        transformer.transformRetentionTimes(feature_map, transformation, True)
+        transformer.transformRetentionTimes(feature_map, tran_description, True)
     
-        print(f"  - {feature_file_paths[i]}: Aligned successfully")
+        print(f"  - {feature_file}: Aligned successfully")
+
+    base_name = os.path.basename(feature_file)
+    aligned_file = os.path.join(output_dir, f"align_{base_name}")
+    # Outputs are renamed into place: a file with the same name in output_dir may be a link to an uploaded blob
+    with replaced_output(aligned_file) as temp_path:
+        oms.FeatureXMLFile().store(temp_path, feature_map)
+    print(f"  - Saved: {aligned_file}")
+
+    if mzML_file is None:
+        return aligned_file, None, None
+    base_name = os.path.basename(mzML_file)
+    mzML_path = os.path.join(output_dir, base_name)
+
+    # Check if the file exists
+    if not os.path.exists(mzML_path):
+        print(f"  - WARNING: {base_name} not found, skipping...")
+        return aligned_file, None, None
+
+    # MS levels from the spectrum headers
+    ms_levels = sorted(peek_mzml(mzML_path)["ms_levels"])
+
+    # Load the mzML file
+    exp = load_experiment(mzML_path)
+    exp.sortSpectra(True)
+
+    # save the aligned mzML file
+    aligned_mzML_path = os.path.join(output_dir, f"align_{base_name}")
+
+    if tran_description is None:
+        # Is the reference file, save directly
+        with replaced_output(aligned_mzML_path) as temp_path:
+            oms.MzMLFile().store(temp_path, exp)
+        print(f" - {base_name}: REFERENCE (no changes)")
+    else:
+        # Apply the transformation
+        transformer = oms.MapAlignmentTransformer()
+        transformer.transformRetentionTimes(exp, tran_description, True)
+        with replaced_output(aligned_mzML_path) as temp_path:
+            oms.MzMLFile().store(temp_path, exp)
+        print(f" - {base_name}: Aligned and saved")
+    return aligned_file, aligned_mzML_path, ms_levels
         
+def align_files(feature_file_paths, mzML_file_paths, resolution, output_dir, value):
+    # Use as reference the file with the highest number of features
+    counts = [feature_count(os.path.join(output_dir, feature_file)) for feature_file in feature_file_paths]
+    # On a tie the last of those files, as the stable sort by size did before
+    ref_index = len(counts) - 1 - counts[::-1].index(max(counts))
+    print(f"\nReference map: {feature_file_paths[ref_index]} (index: {ref_index})")
+
+    print("\nAligning feature maps...")
+
+    # Every map is aligned to the same reference: one file (featureXML + mzML) per worker process
+    tasks = []
+    task_memory = 0
+    for i, feature_file in enumerate(feature_file_paths):
+        mzML_file = mzML_file_paths[i] if i < len(mzML_file_paths) else None
+        tasks.append((feature_file, mzML_file, feature_file_paths[ref_index], resolution, value, output_dir))
+        files = [os.path.join(output_dir, feature_file), os.path.join(output_dir, feature_file_paths[ref_index])]
+        if mzML_file is not None:
+            files.append(os.path.join(output_dir, os.path.basename(mzML_file)))
+        task_memory = max(task_memory, file_task_memory(*files))
+    results = run_parallel(align_one_file, tasks, task_memory=task_memory)
+
     # output_paths
-    aligned_feature_paths = []
-    aligned_mzml_paths = []
-
-    print("\nSaving aligned featureXML files...")
-    for i, feature_map in enumerate(feature_maps):
-        base_name = os.path.basename(feature_file_paths[i])
-        aligned_file = os.path.join(output_dir, f"align_{base_name}")
-        oms.FeatureXMLFile().store(aligned_file, feature_map)
-        aligned_feature_paths.append(aligned_file)
-        print(f"  - Saved: {aligned_file}")
-
-    for i, mzML_file in enumerate(mzML_file_paths):
-        base_name = os.path.basename(mzML_file)
-        mzML_path = os.path.join(output_dir, base_name)
-
-        # Check if the file exists
-        if not os.path.exists(mzML_path):
-            print(f"  - WARNING: {base_name} not found, skipping...")
-            continue
-
-        # Load the mzML file
-        exp = oms.MSExperiment()
-        oms.MzMLFile().load(mzML_path, exp)
-        ms_levels = set()
-        for spectrum in exp.getSpectra():
-            ms_levels.add(spectrum.getMSLevel())
-        exp.sortSpectra(True)
-
-        # Get the corresponding transformation
-        feature_file = feature_file_paths[i]
-        tran_description = transform_files.get(feature_file)
-
-        # save the aligned mzML file
-        aligned_mzML_path = os.path.join(output_dir, f"align_{base_name}")
-
-        if tran_description is None:
-            # Is the reference file, save directly
-            oms.MzMLFile().store(aligned_mzML_path, exp)
-            print(f" - {base_name}: REFERENCE (no changes)")
-        else:
-            # Apply the transformation
-            transformer = oms.MapAlignmentTransformer()
-            transformer.transformRetentionTimes(exp, tran_description, True)
-            oms.MzMLFile().store(aligned_mzML_path, exp)
-            print(f" - {base_name}: Aligned and saved")
-        aligned_mzml_paths.append(aligned_mzML_path)
-    return aligned_feature_paths, aligned_mzml_paths, sorted(ms_levels)
+    aligned_feature_paths = [aligned_file for aligned_file, _, _ in results]
+    aligned_mzml_paths = [aligned_mzML for _, aligned_mzML, _ in results if aligned_mzML is not None]
+    # MS levels of the last mzML file aligned
+    ms_levels = next((levels for _, _, levels in reversed(results) if levels is not None), [])
+    return aligned_feature_paths, aligned_mzml_paths, ms_levels
+
+def map_one_file(featurexml, mzml, output_dir):
+    """
+    Map the identifications of one aligned mzML onto its aligned feature map (runs in a worker process)
+    """
+    exp = get_experiment(mzml)
+    feature_map = oms.FeatureMap()
+    oms.FeatureXMLFile().load(featurexml, feature_map)
+        
+    mapper = oms.IDMapper()
+    peptide_ids = []
+    protein_ids = []
+    params = mapper.getParameters()
+        
+    use_centroid_rt = False
+    use_centroid_mz = True
+    mapper.annotate(feature_map, peptide_ids, protein_ids, use_centroid_rt, use_centroid_mz, exp)
+        
+    base_name = os.path.basename(featurexml)
+    # oms.FeatureXMLFile().store(os.path.join(output_dir, f"mapped_{os.path.basename(featurexml)}"), feature_map)
+        
+    mapped_feature = os.path.join(output_dir, f"mapped_{base_name}")
+    with replaced_output(mapped_feature) as temp_path:
+        oms.FeatureXMLFile().store(temp_path, feature_map)
+    return mapped_feature
 
 def map_identifications(aligned_mzml_paths, aligned_feature_paths, output_dir):
     
-    mapped_features = []
-
-    for featurexml, mzml in zip(aligned_feature_paths, aligned_mzml_paths):
-            
-        
-        exp = oms.MSExperiment()
-        oms.MzMLFile().load(mzml, exp)
-        feature_map = oms.FeatureMap()
-        oms.FeatureXMLFile().load(featurexml, feature_map)
-            
-        mapper = oms.IDMapper()
-        peptide_ids = []
-        protein_ids = []
-        params = mapper.getParameters()
-            
-        use_centroid_rt = False
-        use_centroid_mz = True
-        mapper.annotate(feature_map, peptide_ids, protein_ids, use_centroid_rt, use_centroid_mz, exp)
-            
-        base_name = os.path.basename(featurexml)
-        # oms.FeatureXMLFile().store(os.path.join(output_dir, f"mapped_{os.path.basename(featurexml)}"), feature_map)
-            
-        mapped_feature = os.path.join(output_dir, f"mapped_{base_name}")
-        mapped_features.append(mapped_feature)
-        oms.FeatureXMLFile().store(mapped_feature, feature_map)
+    # One (featureXML, mzML) pair per worker process
+    tasks = [(featurexml, mzml, output_dir) for featurexml, mzml in zip(aligned_feature_paths, aligned_mzml_paths)]
+    task_memory = max((file_task_memory(featurexml, mzml) for featurexml, mzml, _ in tasks), default=None)
+    mapped_features = run_parallel(map_one_file, tasks, task_memory=task_memory)
     
     return mapped_features
     
@@ -1,5 +1,65 @@
 import os
 import pyopenms as oms
+from experiments.parallel.pool import file_task_memory, run_parallel
+from experiments.parallel.sharded import sharded_filter
+
+def picker_filters():
+    """
+    Spectrum and chromatogram filters of the centroiding (built again in every worker process)
+    """
+    
+    # BASELINE CORRECTION     (NO DISPONIBLE) -----------------------
+    
+    
+    # baseline_filter = oms.BaselineFilter()
+    # print(baseline_filter.getParameters())
+    # baseline_params = baseline_filter.getParameters()
+    # baseline_filter.setParameters(baseline_params)
+    # baseline_filter.filter(profile_spectra)
+    
+    
+
+    # Centroiding 
+    picker = oms.PeakPickerHiRes()
+    
+    # NOISE PARAMETERS ----------------------------------------------
+    
+    # ADJUST PARAMETERS IF NEEDED
+    params = picker.getParameters() 
+    params.setValue("signal_to_noise", 2.0)  
+    picker.setParameters(params)
+
+    # Pick spectrum by spectrum (the run is never fully loaded). Like
+    # pickExperiment(check_spectrum_type=True), centroided spectra are kept as they are
+    def pick_spectrum(spectrum):
+        if spectrum.getType(True) == oms.SpectrumSettings.SpectrumType.CENTROID:
+            return spectrum
+        centroided = oms.MSSpectrum()
+        picker.pick(spectrum, centroided)
+        return centroided
+
+    def pick_chromatogram(chromatogram):
+        centroided = oms.MSChromatogram()
+        picker.pick(chromatogram, centroided)
+        return centroided
+
+    return pick_spectrum, pick_chromatogram
+
+def centroid_one_file(file_path, output_file):
+    """
+    Centroid a single mzML file (runs in a worker process of the shared pool, or
+    split by spectra across the workers when it is the only file)
+    """
+    print(f"Processing: {file_path}")
+    print(f"Output: {output_file}")
+
+    # Guardar
+    n_spectra = sharded_filter(file_path, output_file, picker_filters)
+    print(f"Spectra processed: {n_spectra}")
+    print("Centroiding successful.")
+    print(f"Centroid file stored: {output_file}")
+
+    return output_file
 
 def centroid_file(file_paths, output_dir):
     """
@@ -11,47 +71,12 @@ def centroid_file(file_paths, output_dir):
     os.makedirs(output_dir, exist_ok=True)
     print(hasattr(oms, "BaselineFilter"))
 
-    output_files = []
+    tasks = []
     for file_path in file_paths:
         input_filename = os.path.basename(file_path)
         output_filename = os.path.splitext(input_filename)[0] + "_centroid.mzML"
-        output_file = os.path.join(output_dir, output_filename)
-        output_files.append(output_file)
-
-        print(f"Processing: {file_path}")
-        print(f"Output: {output_file}")
-
-        # load data
-        profile_spectra = oms.MSExperiment()
-        oms.MzMLFile().load(file_path, profile_spectra)
-        print(f"Spectra loaded: {profile_spectra.size()}")
-        
-        # BASELINE CORRECTION     (NO DISPONIBLE) -----------------------
-        
-        
-        # baseline_filter = oms.BaselineFilter()
-        # print(baseline_filter.getParameters())
-        # baseline_params = baseline_filter.getParameters()
-        # baseline_filter.setParameters(baseline_params)
-        # baseline_filter.filter(profile_spectra)
-        
-        
-
-        # Centroiding 
-        centroided_spectra = oms.MSExperiment()
-        picker = oms.PeakPickerHiRes()
-        
-        # NOISE PARAMETERS ----------------------------------------------
-        
-        # ADJUST PARAMETERS IF NEEDED
-        params = picker.getParameters() 
-        params.setValue("signal_to_noise", 2.0)  
-        picker.setParameters(params)
-        picker.pickExperiment(profile_spectra, centroided_spectra, True)
-
-        # Guardar
-        oms.MzMLFile().store(output_file, centroided_spectra)
-        print("Centroiding successful.")
-        print(f"Centroid file stored: {output_file}")
+        tasks.append((file_path, os.path.join(output_dir, output_filename)))
 
+    # One file per worker process (streaming: a single spectrum in memory per file)
+    output_files = run_parallel(centroid_one_file, tasks, task_memory=file_task_memory())
     return output_files
\ No newline at end of file
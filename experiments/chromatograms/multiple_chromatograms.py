@@ -2,6 +2,12 @@ import pyopenms
 import plotly.graph_objects as go
 import numpy as np
 from scipy.signal import find_peaks
+from experiments.loaders.peak_stats import ms1_chromatograms, stored_chromatogram
+from experiments.loaders.indexed_mzml import read_spectrum
+from experiments.loaders.load_options import MS1_ONLY
+
+# Base peak chromatograms are built from the MS1 spectra only
+LOAD_OPTIONS = MS1_ONLY
 
 # Load the data from the mzML file list and extract retention times, base peaks, m/z values, and index peaks of every file
 def load_chromatogram(file_paths, intensity_threshold):
@@ -12,25 +18,24 @@ def load_chromatogram(file_paths, intensity_threshold):
     
     # Analize each file from the list of file paths
     for file_path in file_paths:
-        exp = pyopenms.MSExperiment()
-        pyopenms.MzMLFile().load(file_path, exp)
-        spectra = exp.getSpectra()
-        print(f"Number of spectra in {file_path}: {len(spectra)}")
-
-        base_peaks = []
-        retention_times = []
-        mz_values = []
+        stored = stored_chromatogram(file_path, "bpc", ms_level=1)
+        if stored is not None:
+            # The file already has the base peak chromatogram of its MS1 spectra
+            # (points at 0 are spectra without peaks, left out as below)
+            has_peaks = stored["intensity"] > 0
+            base_peaks = stored["intensity"][has_peaks]
+            retention_times = stored["rt"][has_peaks]
+            spectrum_index = stored["index"][has_peaks]
+        else:
+            # TIC/BPC of all the MS1 spectra at once (vectorized over the flat peak arrays)
+            chromatograms = ms1_chromatograms(file_path, LOAD_OPTIONS)
+            print(f"Number of MS1 spectra in {file_path}: {len(chromatograms['index'])}")
 
-        # In each file, gets the spectrum data and appends to every list
-        for spectrum in spectra:
-            if spectrum.getMSLevel() == 1:
-                mz_array, intensity_array = spectrum.get_peaks()
-                if len(intensity_array) > 0:
-                    max_intensity = max(intensity_array)
-                    base_peaks.append(max_intensity)
-                    max_index = list(intensity_array).index(max_intensity)
-                    mz_values.append(mz_array[max_index])
-                    retention_times.append(spectrum.getRT())
+            # Spectra without peaks have no base peak
+            has_peaks = chromatograms["peak_count"] > 0
+            base_peaks = chromatograms["bpc"][has_peaks]
+            retention_times = chromatograms["rt"][has_peaks]
+            mz_values = chromatograms["base_peak_mz"][has_peaks]
 
         index_peaks, _ = find_peaks(
             base_peaks,
@@ -38,6 +43,13 @@ def load_chromatogram(file_paths, intensity_threshold):
             prominence=50,
             distance=10
         )
+        if stored is not None:
+            # A stored BPC has no m/z: decode only the spectra of the labelled peaks
+            mz_values = np.full(len(base_peaks), np.nan)
+            for j in index_peaks:
+                spectrum = read_spectrum(file_path, int(spectrum_index[j]))
+                if len(spectrum["intensity"]):
+                    mz_values[j] = spectrum["mz"][np.argmax(spectrum["intensity"])]
         all_retention_times.append(retention_times)
         all_base_peaks.append(base_peaks)
         all_mz_values.append(mz_values)
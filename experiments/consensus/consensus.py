@@ -1,6 +1,8 @@
 import pandas as pd
 import pyopenms as oms
 import os, re
+from experiments.loaders.experiment_cache import get_experiment
+from experiments.uploads.blob_store import replaced_output
 
 def get_consensus_matrix(feature_file_paths, output_dir, empty_idmxl):
     
@@ -51,8 +53,7 @@ def get_consensus_matrix(feature_file_paths, output_dir, empty_idmxl):
     use_centroid_mz = True
     mapper = oms.IDMapper()
     for file in mzml_files:
-        exp = oms.MSExperiment()
-        oms.MzMLFile().load(file, exp)
+        exp = get_experiment(file)
         for i, feature_map in enumerate(feature_maps):
             # Check if metadata matches
             if feature_map.getMetaValue("spectra_data")[0].decode() == exp.getMetaValue("mzML_path"):
@@ -93,7 +94,8 @@ def get_consensus_matrix(feature_file_paths, output_dir, empty_idmxl):
                         output_dir,
                         os.path.splitext(os.path.basename(feature_file))[0] + ".mapped.idXML",
                     )
-                    oms.IdXMLFile().store(mapped_idxml_path, protein_ids, peptide_ids)
+                    with replaced_output(mapped_idxml_path) as temp_path:
+                        oms.IdXMLFile().store(temp_path, protein_ids, peptide_ids)
                     print(f"Stored mapped idXML: {mapped_idxml_path}")
                 except Exception as e:
                     print(f"Could not store mapped idXML: {e}")
@@ -140,7 +142,9 @@ def get_consensus_matrix(feature_file_paths, output_dir, empty_idmxl):
     consensus_map.setUniqueIds()
 
     output_path = os.path.join(output_dir, f"{matrix_name}.consensusXML")
-    oms.ConsensusXMLFile().store(output_path, consensus_map)
+    # Outputs are renamed into place: a file with the same name may be a link to an uploaded blob
+    with replaced_output(output_path) as temp_path:
+        oms.ConsensusXMLFile().store(temp_path, consensus_map)
     # print(f"\nConsensus matrix saved to: {output_path}")
     
     oms.ConsensusXMLFile().load(output_path, consensus_map)
@@ -177,8 +181,9 @@ def get_consensus_matrix(feature_file_paths, output_dir, empty_idmxl):
     df = df[columns]
     csv = df.to_csv(index=False)
     csv_path = os.path.join(output_dir, f"{matrix_name}_consensus.csv")
-    with open(csv_path, 'w') as f:
-        f.write(csv)
+    with replaced_output(csv_path) as temp_path:
+        with open(temp_path, 'w') as f:
+            f.write(csv)
     print(f"Consensus matrix CSV saved to: {csv_path}")
     # for row in df.itertuples():
     #     print(row)
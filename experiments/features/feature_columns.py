@@ -0,0 +1,41 @@
+import numpy as np
+import pyopenms as oms
+
+
+def feature_columns(feature_map):
+    """
+    RT, m/z and intensity of every feature of a FeatureMap as NumPy arrays, in a single pass
+    (the arrays are small and picklable, so the worker processes return them instead of the map)
+    """
+    n_features = feature_map.size()
+    columns = {
+        "rt": np.empty(n_features, dtype=np.float64),
+        "mz": np.empty(n_features, dtype=np.float64),
+        "intensity": np.empty(n_features, dtype=np.float64),
+    }
+    for i, feature in enumerate(feature_map):
+        columns["rt"][i] = feature.getRT()
+        columns["mz"][i] = feature.getMZ()
+        columns["intensity"][i] = feature.getIntensity()
+    return columns
+
+
+def load_feature_columns(feature_file):
+    """
+    feature_columns of a featureXML file
+    """
+    feature_map = oms.FeatureMap()
+    oms.FeatureXMLFile().load(feature_file, feature_map)
+    return feature_columns(feature_map)
+
+
+def decimate_features(columns, max_points):
+    """
+    Indices of the max_points most intense features (all of them if there are fewer), in the
+    original order, so a plot keeps the features that stand out
+    """
+    n_features = len(columns["intensity"])
+    if n_features <= max_points:
+        return np.arange(n_features)
+    keep = np.argpartition(columns["intensity"], n_features - max_points)[n_features - max_points:]
+    return np.sort(keep)
@@ -1,149 +1,345 @@
 import pyopenms as oms
 import os
+import shutil
+import tempfile
 import plotly.graph_objects as go
 import numpy as np
+from experiments.loaders.experiment_cache import load_experiment
+from experiments.loaders.load_options import LoadOptions, MS1_ONLY
+from experiments.loaders.mzml_peek import peek_mzml
+from experiments.parallel.pool import MAX_WORKERS, file_task_memory, in_worker, parallel_workers, run_parallel
+from experiments.parallel.sharded import MIN_SHARD_MB, read_spectra
+from experiments.features.feature_columns import decimate_features, feature_columns, load_feature_columns
+from experiments.features.trace_cache import experiment_peaks, load_traces, stage_params, store_traces
+from experiments.uploads.blob_store import replaced_output
 
-def detect_features(file_paths, mass_error_ppm, noise_threshold_int, features_type):
-    
+# Both feature finders work on MS1 data only
+LOAD_OPTIONS = MS1_ONLY
+
+# RT (seconds) added on both sides of a window in the partitioned feature detection
+# (doubled for a window whose features reach its edges)
+FEATURE_RT_MARGIN = 120.0
+# Fewest MS1 spectra in the core of an RT window
+MIN_WINDOW_SPECTRA = 200
+
+# FeatureFindingMetabo options of the Features page
+ISOTOPE_FILTERING_MODELS = ("none", "metabolites (2% RMS)", "metabolites (5% RMS)", "peptides")
+DEFAULT_ISOTOPE_FILTERING_MODEL = "none"
+DEFAULT_REMOVE_SINGLE_TRACES = "true"
+
+# Features drawn in the features map (all files); above it the most intense ones are kept
+MAX_PLOT_FEATURES = int(os.environ.get("MS_MAX_PLOT_FEATURES", 50000))
+
+def metabolomics_feature_map(input_path, window, load_exp, mass_error_ppm, noise_threshold_int,
+                             isotope_filtering_model=DEFAULT_ISOTOPE_FILTERING_MODEL,
+                             remove_single_traces=DEFAULT_REMOVE_SINGLE_TRACES):
+    """
+    Mass traces, elution peaks and FeatureFindingMetabo on the MS1 spectra of input_path in window
+    (None: the whole file). Returns the FeatureMap and the mass traces it was built from.
+
+    The mass traces and the split traces are cached for the parameters each stage depends on
+    (see trace_cache), so a re-run that only changes FeatureFindingMetabo parameters starts from
+    the split traces, and one that only changes ElutionPeakDetection from the mass traces.
+    load_exp() returns the RT sorted spectra; it is only called if the mass traces are not cached.
+    """
+    # Initialize mass trace detection
+    mtd = oms.MassTraceDetection()
+    mtd_params = mtd.getDefaults()
+
+    # Set detection parameters
+    mtd_params.setValue("mass_error_ppm", float(mass_error_ppm)) # Mass error in ppm
+    mtd_params.setValue("dalton_error", 0.0)  # Absolute mass error in Da (set to 0 if using ppm)
+    mtd_params.setValue("noise_threshold_int", float(noise_threshold_int))  # Noise threshold
+    mtd.setParameters(mtd_params)
+
+    # Initialize elution peak detection
+    epd = oms.ElutionPeakDetection()
+    epd_params = epd.getDefaults()
+    epd_params.setValue("width_filtering", "fixed")  # Peak width filtering
+    epd.setParameters(epd_params)
+
+    # Reuse the split traces if cached (their key includes the mass trace detection parameters)
+    epd_stage = stage_params(mtd.getParameters(), epd.getParameters())
+    mass_traces_final, _ = load_traces(input_path, window, epd_stage)
+    if mass_traces_final is None:
+        # Detect mass traces (or reuse them)
+        mtd_stage = stage_params(mtd.getParameters())
+        mass_traces, trace_peaks = load_traces(input_path, window, mtd_stage)
+        if mass_traces is None:
+            exp = load_exp()
+            mass_traces = []
+            mtd.run(exp, mass_traces, 0)
+            trace_peaks = store_traces(input_path, window, mtd_stage, mass_traces, experiment_peaks(exp))
+
+        # Detect elution peaks
+        mass_traces_split = []
+        mass_traces_final = []
+        epd.detectPeaks(mass_traces, mass_traces_split)
+
+        # If peak width filtering is automatic, filter the traces
+        if epd.getParameters().getValue("width_filtering") == "auto":
+            epd.filterByPeakWidth(mass_traces_split, mass_traces_final)
+        else: 
+            mass_traces_final = mass_traces_split
+        if trace_peaks is not None:
+            store_traces(input_path, window, epd_stage, mass_traces_final, trace_peaks)
+
+    # Initialize FeatureFindingMetabo to find features
+    fm = oms.FeatureMap()
+    feat_chrom = []
+    ffm = oms.FeatureFindingMetabo()
+
+    # Set FeatureFindingMetabo parameters
+    ffm_params = ffm.getDefaults()
+    ffm_params.setValue("isotope_filtering_model", isotope_filtering_model)
+    ffm_params.setValue("remove_single_traces", remove_single_traces)  # Remove single traces
+
+    # Filter traces with only one peak
+    ffm_params.setValue("mz_scoring_by_elements", "false")
+    ffm_params.setValue("report_convex_hulls", "true")
+    ffm.setParameters(ffm_params)
+
+    # Run feature detection
+    ffm.run(mass_traces_final, fm, feat_chrom)
+    return fm, mass_traces_final
+
+def detect_window_features(input_path, window, core, mass_error_ppm, noise_threshold_int,
+                           isotope_filtering_model, remove_single_traces, output_path):
+    """
+    Features of one RT window of an mzML file (runs in a worker process).
+
+    Only the spectra with RT in window = (start, end) are loaded, and only the features whose RT
+    (apex) is in core = [start, end) are kept, so every feature belongs to exactly one window.
+    Saves them to output_path and returns (truncated, core_intensity, window_intensity):
+    truncated is True if one of them reaches the edge of the window (it may be cut: the window
+    has to be detected again with a wider margin); the intensities are the smoothed intensity of
+    the mass traces centred in the core and of all the traces of the window (see the quality below).
+    """
+    peek = peek_mzml(input_path)
+    spectra = np.flatnonzero((peek["ms_level"] == 1) & (peek["rt"] >= window[0]) & (peek["rt"] <= window[1]))
+
+    def load_window():
+        options = LoadOptions(ms_levels=(1,), rt_range=window)
+        exp = read_spectra(input_path, int(spectra[0]), int(spectra[-1]) + 1, options)
+        if exp is None:
+            exp = load_experiment(input_path, options)
+        exp.sortSpectra(True)
+        return exp
+
+    window_features = oms.FeatureMap()
+    truncated = False
+    core_intensity = window_intensity = 0.0
+    if len(spectra):
+        # A window that stops before the end of the run can cut the features that start in its
+        # first spectrum or end in its last one
+        ms1_rt = peek["rt"][peek["ms_level"] == 1]
+        window_rt = np.sort(peek["rt"][spectra])
+        first_rt = window_rt[1] if window[0] > ms1_rt.min() and len(window_rt) > 1 else -np.inf
+        last_rt = window_rt[-2] if window[1] < ms1_rt.max() and len(window_rt) > 1 else np.inf
+        fm, mass_traces = metabolomics_feature_map(input_path, tuple(map(float, window)), load_window,
+                                                   mass_error_ppm, noise_threshold_int,
+                                                   isotope_filtering_model, remove_single_traces)
+        for trace in mass_traces:
+            window_intensity += trace.getIntensity(True)
+            if core[0] <= trace.getCentroidRT() < core[1]:
+                core_intensity += trace.getIntensity(True)
+        for feature in fm:
+            if not core[0] <= feature.getRT() < core[1]:
+                continue
+            window_features.push_back(feature)
+            hull = feature.getConvexHull().getBoundingBox()
+            truncated |= hull.minPosition()[0] < first_rt or hull.maxPosition()[0] > last_rt
+
+    window_features.setUniqueIds()
+    oms.FeatureXMLFile().store(output_path, window_features)
+    return truncated, core_intensity, window_intensity
+
+def partitioned_metabolomics_features(input_path, mass_error_ppm, noise_threshold_int, n_windows,
+                                      isotope_filtering_model=DEFAULT_ISOTOPE_FILTERING_MODEL,
+                                      remove_single_traces=DEFAULT_REMOVE_SINGLE_TRACES):
+    """
+    FeatureFindingMetabo on n_windows overlapping RT windows of the MS1 map in parallel.
+
+    The cores of the windows hold the same number of MS1 spectra and every window adds
+    FEATURE_RT_MARGIN seconds on both sides. Features are assigned to the window of their apex;
+    a window with features cut by its edges is detected again with twice the margin, so the
+    features that cross a seam come out whole, as in a single pass. The overall quality that
+    FeatureFindingMetabo divides by the intensity of the window is brought back to the whole run;
+    the mass trace labels (T<i>) keep the numbering of their window. Returns the FeatureMap.
+    """
+    peek = peek_mzml(input_path)
+    ms1_rt = np.sort(peek["rt"][peek["ms_level"] == 1])
+    seams = ms1_rt[(np.arange(1, n_windows) * len(ms1_rt)) // n_windows]
+    cores = list(zip(np.concatenate(([-np.inf], seams)), np.concatenate((seams, [np.inf]))))
+    margins = [FEATURE_RT_MARGIN] * len(cores)
+    intensities = [None] * len(cores)
+
+    window_dir = tempfile.mkdtemp(prefix=".windows_", dir=os.path.dirname(input_path) or ".")
+    try:
+        pending = list(range(len(cores)))
+        while pending:
+            tasks = []
+            for k in pending:
+                window = (max(cores[k][0] - margins[k], ms1_rt[0]), min(cores[k][1] + margins[k], ms1_rt[-1]))
+                tasks.append((input_path, window, cores[k], mass_error_ppm, noise_threshold_int,
+                              isotope_filtering_model, remove_single_traces,
+                              os.path.join(window_dir, f"window_{k}.featureXML")))
+            print(f"[FEATURES] {input_path}: {len(tasks)} RT windows")
+            results = run_parallel(detect_window_features, tasks,
+                                   task_memory=file_task_memory(input_path) * 2 // len(cores))
+            for k, (_, core_intensity, window_intensity) in zip(pending, results):
+                intensities[k] = (core_intensity, window_intensity)
+            pending = [k for k, (cut, _, _) in zip(pending, results) if cut]
+            for k in pending:
+                margins[k] *= 2
+
+        # Stitch the windows: each feature comes from a single window, in m/z order as FeatureFindingMetabo
+        run_intensity = sum(core_intensity for core_intensity, _ in intensities)
+        fm = oms.FeatureMap()
+        for k in range(len(cores)):
+            window_features = oms.FeatureMap()
+            oms.FeatureXMLFile().load(os.path.join(window_dir, f"window_{k}.featureXML"), window_features)
+            for feature in window_features:
+                if run_intensity > 0:
+                    feature.setOverallQuality(feature.getOverallQuality() * intensities[k][1] / run_intensity)
+                fm.push_back(feature)
+        fm.sortByMZ()
+        return fm
+    finally:
+        shutil.rmtree(window_dir, ignore_errors=True)
+
+def detect_metabolomics_features(input_path, mass_error_ppm, noise_threshold_int,
+                                 isotope_filtering_model=DEFAULT_ISOTOPE_FILTERING_MODEL,
+                                 remove_single_traces=DEFAULT_REMOVE_SINGLE_TRACES):
+    """
+    Mass traces, elution peaks and FeatureFindingMetabo on one mzML file (runs in a worker process).
+    A single large file is split in RT windows across the worker processes.
+    Returns the featureXML path and the feature_columns of the map (for the plot, without reloading it).
+    """
+    n_windows = 1
+    if not in_worker() and os.path.getsize(input_path) >= MIN_SHARD_MB * 1024 * 1024:
+        n_ms1 = peek_mzml(input_path)["ms_levels"].get(1, 0)
+        n_windows = parallel_workers(n_ms1 // MIN_WINDOW_SPECTRA, file_task_memory(input_path) * 2 // MAX_WORKERS)
+
+    if n_windows > 1:
+        fm = partitioned_metabolomics_features(input_path, mass_error_ppm, noise_threshold_int, n_windows,
+                                               isotope_filtering_model, remove_single_traces)
+    else:
+        def load_file():
+            # Load mzML file (MS1 only)
+            exp = load_experiment(input_path, LOAD_OPTIONS)
+
+            # Sort spectra by retention time
+            exp.sortSpectra(True)
+            return exp
+
+        fm, _ = metabolomics_feature_map(input_path, None, load_file, mass_error_ppm, noise_threshold_int,
+                                         isotope_filtering_model, remove_single_traces)
+
+    # Set unique identifiers
+    fm.setUniqueIds()
+    fm.setPrimaryMSRunPath([input_path.encode()])
+
+    # Define output path
+    output_path = input_path.replace(".mzML", "_Meta.featureXML")
+
+    # Save the result to a FeatureXML file (renamed over output_path: an upload with the same name is a link to a blob)
+    with replaced_output(output_path) as temp_path:
+        oms.FeatureXMLFile().store(temp_path, fm)
+    return output_path, feature_columns(fm)
+
+def detect_proteomics_features(input_path):
+    """
+    FeatureFinderAlgorithmPicked on one mzML file (runs in a worker process).
+    Returns the featureXML path and its feature_columns, or (None, None) if the file could not be processed.
+    """
+    try:
+        # Cargar solo espectros MS1 para ahorrar memoria
+        input_map = load_experiment(input_path, LOAD_OPTIONS)
+
+        # Verificar que hay espectros MS1
+        if input_map.getNrSpectra() == 0:
+            print(f"[ERROR] No MS1 spectra found in {input_path}")
+            return None, None
+
+        # Inicializar y ejecutar FeatureFinderAlgorithmPicked
+        ff = oms.FeatureFinderAlgorithmPicked()
+        out_features = oms.FeatureMap()
+        seeds = oms.FeatureMap()  # No se usan semillas en este caso
+
+        # Obtener y configurar parámetros
+        params = ff.getParameters()
+        # Puedes ajustar parámetros aquí si es necesario
+        # params.setValue("some_param", value)
+
+        ff.run(input_map, out_features, params, seeds)
+
+        # Verificar si se detectaron features
+        if out_features.size() == 0:
+            print(f"[WARN] No features detected in {input_path}")
+
+        # Define output path
+        output_file = input_path.replace(".mzML", "_Prote.featureXML")
+
+        # Asignar IDs únicos y guardar en archivo
+        out_features.setUniqueIds()
+        with replaced_output(output_file) as temp_path:
+            oms.FeatureXMLFile().store(temp_path, out_features)
+
+        # Verificar que el archivo se creó
+        if not os.path.exists(output_file):
+            print(f"[ERROR] FeatureXML file not created: {output_file}")
+        return output_file, feature_columns(out_features)
+    except Exception as e:
+        print(f"[ERROR] Exception processing {input_path}: {e}")
+        return None, None
+
+def detect_features(file_paths, mass_error_ppm, noise_threshold_int, features_type,
+                    isotope_filtering_model=DEFAULT_ISOTOPE_FILTERING_MODEL,
+                    remove_single_traces=DEFAULT_REMOVE_SINGLE_TRACES):
+    """
+    Detect the features of every mzML file. Returns (output_paths, all_are_features, features_type,
+    columns): columns holds the feature_columns of each output file, or None for the featureXML
+    files that were given as input (they are read by the caller).
+    """
     # Detect if all files are already features
     all_are_features = all(".featureXML" in file for file in file_paths)
 
     if all_are_features:
         output_paths = file_paths
+        columns = [None] * len(file_paths)
     else:
-        output_paths = []
+        results = []
+        # One file per worker process, as many at a time as the free RAM allows
+        task_memory = max(file_task_memory(input_path) for input_path in file_paths)
         if features_type == 'Metabolomics':
-            for input_path in file_paths:
-                # Load mzML file
-                exp = oms.MSExperiment()
-                oms.MzMLFile().load(input_path, exp)
-
-                # Sort spectra by retention time
-                exp.sortSpectra(True)
-    
-                # Initialize mass trace detection
-                mass_traces = []
-                mtd = oms.MassTraceDetection()
-                mtd_params = mtd.getDefaults()
-    
-                # Set detection parameters
-                mtd_params.setValue("mass_error_ppm", float(mass_error_ppm)) # Mass error in ppm
-                mtd_params.setValue("dalton_error", 0.0)  # Absolute mass error in Da (set to 0 if using ppm)
-                mtd_params.setValue("noise_threshold_int", float(noise_threshold_int))  # Noise threshold
-                mtd.setParameters(mtd_params)
-    
-                # Detect mass traces
-                mtd.run(exp, mass_traces, 0)
-    
-                # Initialize elution peak detection
-                mass_traces_split = []
-                mass_traces_final = []
-                epd = oms.ElutionPeakDetection()
-                epd_params = epd.getDefaults()
-                epd_params.setValue("width_filtering", "fixed")  # Peak width filtering
-                epd.setParameters(epd_params)
-    
-                # Detect elution peaks
-                epd.detectPeaks(mass_traces, mass_traces_split)
-    
-                # If peak width filtering is automatic, filter the traces
-                if epd.getParameters().getValue("width_filtering") == "auto":
-                    epd.filterByPeakWidth(mass_traces_split, mass_traces_final)
-                else: 
-                    mass_traces_final = mass_traces_split
-        
-                # Initialize FeatureFindingMetabo to find features
-                fm = oms.FeatureMap()
-                feat_chrom = []
-                ffm = oms.FeatureFindingMetabo()
-    
-                # Set FeatureFindingMetabo parameters
-                ffm_params = ffm.getDefaults()
-                ffm_params.setValue("isotope_filtering_model", "none")
-                ffm_params.setValue("remove_single_traces", "true")  # Remove single traces
-    
-                # Filter traces with only one peak
-                ffm_params.setValue("mz_scoring_by_elements", "false")
-                ffm_params.setValue("report_convex_hulls", "true")
-                ffm.setParameters(ffm_params)
-    
-                # Run feature detection
-                ffm.run(mass_traces_final, fm, feat_chrom)
-    
-                # Set unique identifiers
-                fm.setUniqueIds()
-                fm.setPrimaryMSRunPath([input_path.encode()])
-    
-                # Define output path
-                output_paths.append(input_path.replace(".mzML", "_Meta.featureXML"))
-    
-                # Save the result to a FeatureXML file
-                oms.FeatureXMLFile().store(output_paths[-1], fm)
-                
-                
+            results = run_parallel(
+                detect_metabolomics_features,
+                [(input_path, mass_error_ppm, noise_threshold_int, isotope_filtering_model, remove_single_traces)
+                 for input_path in file_paths],
+                task_memory=task_memory)
         elif features_type == 'Proteomics':
-            for input_path in file_paths:
-                try:
-                    # Cargar solo espectros MS1 para ahorrar memoria
-                    options = oms.PeakFileOptions()
-                    options.setMSLevels([1])  # Solo MS1
-
-                    # Leer el archivo mzML
-                    fh = oms.MzMLFile()
-                    fh.setOptions(options)
-                    input_map = oms.MSExperiment()
-                    fh.load(input_path, input_map)
-                    input_map.updateRanges()
-
-                    # Verificar que hay espectros MS1
-                    if input_map.getNrSpectra() == 0:
-                        print(f"[ERROR] No MS1 spectra found in {input_path}")
-                        continue
-
-                    # Inicializar y ejecutar FeatureFinderAlgorithmPicked
-                    ff = oms.FeatureFinderAlgorithmPicked()
-                    out_features = oms.FeatureMap()
-                    seeds = oms.FeatureMap()  # No se usan semillas en este caso
-
-                    # Obtener y configurar parámetros
-                    params = ff.getParameters()
-                    # Puedes ajustar parámetros aquí si es necesario
-                    # params.setValue("some_param", value)
-
-                    ff.run(input_map, out_features, params, seeds)
-
-                    # Verificar si se detectaron features
-                    if out_features.size() == 0:
-                        print(f"[WARN] No features detected in {input_path}")
-
-                    # Define output path
-                    output_file = input_path.replace(".mzML", "_Prote.featureXML")
-                    output_paths.append(output_file)
-
-                    # Asignar IDs únicos y guardar en archivo
-                    out_features.setUniqueIds()
-                    oms.FeatureXMLFile().store(output_file, out_features)
-
-                    # Verificar que el archivo se creó
-                    if not os.path.exists(output_file):
-                        print(f"[ERROR] FeatureXML file not created: {output_file}")
-                except Exception as e:
-                    print(f"[ERROR] Exception processing {input_path}: {e}")
-
-
-    return output_paths, all_are_features, features_type
-
-def plot_features(file_paths, mass_error_ppm, noise_threshold_int, input_dir, features_type):
-    output_files, all_are_features, features_type = detect_features(file_paths, mass_error_ppm, noise_threshold_int, features_type)
+            results = run_parallel(detect_proteomics_features, [(input_path,) for input_path in file_paths],
+                                   task_memory=task_memory)
+        # Files that failed are left out (the error was printed by the worker)
+        results = [result for result in results if result[0] is not None]
+        output_paths = [output_file for output_file, _ in results]
+        columns = [file_columns for _, file_columns in results]
+
+    return output_paths, all_are_features, features_type, columns
+
+def plot_features(file_paths, mass_error_ppm, noise_threshold_int, input_dir, features_type,
+                  isotope_filtering_model=DEFAULT_ISOTOPE_FILTERING_MODEL,
+                  remove_single_traces=DEFAULT_REMOVE_SINGLE_TRACES):
+    output_files, all_are_features, features_type, columns = detect_features(
+        file_paths, mass_error_ppm, noise_threshold_int, features_type, isotope_filtering_model, remove_single_traces)
     # Directory containing the input files
     feature_files = output_files
 
-    # Load each FeatureXML file into a FeatureMap
-    original_maps = []
-    for feature_file in feature_files:
-        feature_map = oms.FeatureMap()
-        oms.FeatureXMLFile().load(os.path.join(input_dir, feature_file), feature_map)
-        original_maps.append(feature_map)
+    # RT, m/z and intensity of each map: the detected maps come from the workers, only the
+    # featureXML files given as input are read
+    feature_data = [file_columns if file_columns is not None else load_feature_columns(os.path.join(input_dir, feature_file))
+                    for feature_file, file_columns in zip(feature_files, columns)]
 
     # Set up colors for plotting
     import plotly.colors as pc
@@ -160,35 +356,43 @@ def plot_features(file_paths, mass_error_ppm, noise_threshold_int, input_dir, fe
     # Create the figure
     fig = go.Figure()
 
+    # Points sent to the browser: above MAX_PLOT_FEATURES the budget is shared between the files
+    # in proportion to their size and each file keeps its most intense features
+    total_features = sum(len(data["rt"]) for data in feature_data)
+    budget = min(1.0, MAX_PLOT_FEATURES / total_features) if total_features else 1.0
+
     # Process each feature map
-    for i, feature_map in enumerate(original_maps):
-        rt = [f.getRT() for f in feature_map]
-        mz = [f.getMZ() for f in feature_map]
-        intensity = [f.getIntensity() for f in feature_map]
+    for i, data in enumerate(feature_data):
+        n_features = len(data["rt"])
+        keep = decimate_features(data, max(1, int(n_features * budget)))
+        rt, mz, intensity = data["rt"][keep], data["mz"][keep], data["intensity"][keep]
         # Normalize intensities for point size
-        max_intensity = max(intensity) if intensity else 1
-        normalized_intensity = np.array(intensity) / max_intensity
+        max_intensity = data["intensity"].max() if n_features else 1
+        normalized_intensity = intensity / max_intensity if max_intensity > 0 else np.zeros_like(intensity)
         # Create marker sizes based on intensity
         marker_sizes = normalized_intensity * 15 + 5  # Size between 5 y 20
-        # Add scatter plot for each file
+        name = feature_files[i].split('/')[-1].replace('.featureXML', '')
+        if len(keep) < n_features:
+            name += f" ({len(keep):,} of {n_features:,} most intense)"
+        # Add scatter plot for each file (WebGL: tens of thousands of markers)
         fig.add_trace(
-            go.Scatter(
+            go.Scattergl(
                 x=rt,
                 y=mz,
                 mode='markers',
-                name=feature_files[i].split('/')[-1].replace('.featureXML', ''),
+                name=name,
                 marker=dict(
                     color=colors[i],
                     size=marker_sizes,
                     opacity=0.7,
                     line=dict(width=0.5, color='darkgray')
                 ),
+                customdata=intensity,
                 hovertemplate="<b>%{fullData.name}</b><br>" +
                           "<b>RT:</b> %{x:.2f} s<br>" +
                           "<b>m/z:</b> %{y:.4f}<br>" +
-                          "<b>Intensity:</b> %{text}<br>" +
-                          "<extra></extra>",
-                text=[f"{int_val:.2e}" for int_val in intensity]
+                          "<b>Intensity:</b> %{customdata:.2e}<br>" +
+                          "<extra></extra>"
             )
         )
 
@@ -0,0 +1,208 @@
+import hashlib
+import json
+import os
+
+import numpy as np
+import pyopenms as oms
+
+# Folder holding the mass traces of the feature detection stages, one file per (mzML, RT window, parameters)
+TRACES_DIR = os.environ.get("MS_TRACES_DIR", os.path.join("uploads", "traces"))
+TRACES_VERSION = 2
+
+PEAK_DTYPE = [("rt", np.float64), ("mz", np.float64)]
+
+
+def _source_key(file_path):
+    stat = os.stat(file_path)
+    return (os.path.abspath(file_path), stat.st_size, stat.st_mtime_ns)
+
+
+def stage_params(*params):
+    """
+    Parameters a stage depends on: the Param of every algorithm up to that stage, as dicts
+    """
+    return [sorted(param.asDict().items()) for param in params]
+
+
+def trace_cache_path(file_path, window, params):
+    key = repr((os.path.abspath(file_path), window, params))
+    name = hashlib.sha1(key.encode("utf-8")).hexdigest()
+    return os.path.join(TRACES_DIR, f"{name}.traces.npz")
+
+
+def experiment_peaks(exp):
+    """
+    Peak table (rt, mz, intensity) of an MSExperiment, to look up the intensities of the trace peaks
+    """
+    rt, mz, intensity = [], [], []
+    for spectrum in exp:
+        spectrum_mz, spectrum_intensity = spectrum.get_peaks()
+        rt.append(np.full(len(spectrum_mz), spectrum.getRT()))
+        mz.append(spectrum_mz)
+        intensity.append(spectrum_intensity)
+    if not rt:
+        return {"rt": np.empty(0), "mz": np.empty(0), "intensity": np.empty(0, dtype=np.float32)}
+    return {"rt": np.concatenate(rt), "mz": np.concatenate(mz), "intensity": np.concatenate(intensity)}
+
+
+def _sorted_positions(peaks):
+    positions = np.empty(len(peaks["rt"]), dtype=PEAK_DTYPE)
+    positions["rt"] = peaks["rt"]
+    positions["mz"] = peaks["mz"]
+    order = np.argsort(positions, order=("rt", "mz"), kind="stable")
+    return positions[order], order
+
+
+def traces_to_arrays(traces, peaks):
+    """
+    Flat arrays of a list of MassTrace. The peaks of a trace are only exposed through its convex hull
+    (rt, mz), so their intensities are looked up in peaks (experiment_peaks or the arrays of an
+    earlier stage). Returns None if a trace peak is not in peaks.
+    """
+    sizes = np.array([trace.getSize() for trace in traces], dtype=np.int64)
+    points = [trace.getConvexhull().getHullPointsNPY()[:trace.getSize()] for trace in traces]
+    points = np.concatenate(points) if points else np.empty((0, 2))
+
+    known, order = _sorted_positions(peaks)
+    wanted = np.empty(len(points), dtype=PEAK_DTYPE)
+    wanted["rt"] = points[:, 0]
+    wanted["mz"] = points[:, 1]
+    index = np.minimum(np.searchsorted(known, wanted), max(len(known) - 1, 0))
+    if len(wanted) and (not len(known) or np.any(known[index] != wanted)):
+        return None
+
+    smoothed = [np.asarray(trace.getSmoothedIntensities(), dtype=np.float64) for trace in traces]
+    return {
+        "offsets": np.concatenate(([0], np.cumsum(sizes))),
+        "rt": points[:, 0].copy(),
+        "mz": points[:, 1].copy(),
+        "intensity": np.asarray(peaks["intensity"])[order[index]] if len(wanted) else np.empty(0, dtype=np.float32),
+        # Smoothed intensities of trace i are [smoothed_offsets[i], smoothed_offsets[i + 1]);
+        # none means the trace was not smoothed yet (mass trace detection stage)
+        "smoothed_offsets": np.concatenate(([0], np.cumsum([len(values) for values in smoothed], dtype=np.int64))),
+        "smoothed": np.concatenate(smoothed) if smoothed else np.empty(0),
+        "centroid_sd": np.array([trace.getCentroidSD() for trace in traces], dtype=np.float64),
+        "fwhm_mz_avg": np.array([trace.fwhm_mz_avg for trace in traces], dtype=np.float64),
+        "fwhm_im_avg": np.array([trace.fwhm_im_avg for trace in traces], dtype=np.float64),
+        "label": np.array([trace.getLabel() for trace in traces], dtype=str),
+        # Enum value (older pyopenms return a plain int)
+        "quant_method": np.array([int(getattr(method, "value", method)) for method in
+                                  (trace.getQuantMethod() for trace in traces)], dtype=np.int64),
+        # Checked on rebuild, the centroid has no setter
+        "centroid": np.array([(trace.getCentroidRT(), trace.getCentroidMZ()) for trace in traces],
+                             dtype=np.float64).reshape(-1, 2),
+    }
+
+
+def arrays_to_traces(arrays):
+    """
+    List of MassTrace from traces_to_arrays, with the same centroids, smoothed intensities and FWHM
+    as the originals (None if a centroid cannot be reproduced)
+    """
+    traces = []
+    offsets = arrays["offsets"]
+    smoothed_offsets = arrays["smoothed_offsets"]
+    for i in range(len(offsets) - 1):
+        peaks = []
+        for rt, mz, intensity in zip(arrays["rt"][offsets[i]:offsets[i + 1]],
+                                     arrays["mz"][offsets[i]:offsets[i + 1]],
+                                     arrays["intensity"][offsets[i]:offsets[i + 1]]):
+            peak = oms.Peak2D()
+            peak.setRT(float(rt))
+            peak.setMZ(float(mz))
+            peak.setIntensity(float(intensity))
+            peaks.append(peak)
+        trace = oms.MassTrace(peaks)
+        # Same updates as MassTraceDetection (raw traces) and ElutionPeakDetection (smoothed traces)
+        trace.updateWeightedMeanMZ()
+        if smoothed_offsets[i + 1] > smoothed_offsets[i]:
+            trace.setSmoothedIntensities(arrays["smoothed"][smoothed_offsets[i]:smoothed_offsets[i + 1]].tolist())
+            trace.updateSmoothedMaxRT()
+            trace.estimateFWHM(True)
+        else:
+            trace.updateWeightedMeanRT()
+        trace.setCentroidSD(float(arrays["centroid_sd"][i]))
+        trace.fwhm_mz_avg = float(arrays["fwhm_mz_avg"][i])
+        trace.fwhm_im_avg = float(arrays["fwhm_im_avg"][i])
+        trace.setLabel(str(arrays["label"][i]))
+        trace.setQuantMethod(int(arrays["quant_method"][i]))
+        if (trace.getCentroidRT(), trace.getCentroidMZ()) != tuple(arrays["centroid"][i]):
+            return None
+        traces.append(trace)
+    return traces
+
+
+def _read_header(cache):
+    """
+    JSON header of a cached .npz (version and source key of the mzML)
+    """
+    return json.loads(str(cache["header"]))
+
+
+def load_traces(file_path, window, params):
+    """
+    Mass traces of a stage cached for this file, RT window (None: whole file) and stage_params.
+    Returns (traces, arrays), or (None, None) if they were never stored or the file changed.
+    """
+    cache_file = trace_cache_path(file_path, window, params)
+    if not os.path.exists(cache_file):
+        return None, None
+    try:
+        # Plain arrays only: a file planted in the cache folder cannot run code when loaded
+        with np.load(cache_file, allow_pickle=False) as cache:
+            header = _read_header(cache)
+            if header.get("version") != TRACES_VERSION or tuple(header.get("source", ())) != _source_key(file_path):
+                return None, None
+            arrays = {name: cache[name] for name in cache.files if name != "header"}
+    except Exception as e:
+        print(f"Error reading cached mass traces {cache_file}: {e}")
+        return None, None
+    traces = arrays_to_traces(arrays)
+    if traces is None:
+        print(f"[WARN] Cached mass traces {cache_file} could not be rebuilt")
+        return None, None
+    return traces, arrays
+
+
+def store_traces(file_path, window, params, traces, peaks):
+    """
+    Save the mass traces of a stage (see load_traces). peaks is the peak table their intensities
+    are taken from. Returns their arrays (the peak table of the next stage), or None if not stored.
+    """
+    arrays = traces_to_arrays(traces, peaks)
+    if arrays is None:
+        print(f"[WARN] Mass traces of {file_path} not cached: peaks not found in the input")
+        return None
+    cache_file = trace_cache_path(file_path, window, params)
+    os.makedirs(TRACES_DIR, exist_ok=True)
+    temp_file = f"{cache_file}.{os.getpid()}.tmp"
+    header = {"version": TRACES_VERSION, "source": list(_source_key(file_path))}
+    with open(temp_file, "wb") as f:
+        np.savez(f, header=np.array(json.dumps(header)), **arrays)
+    os.replace(temp_file, cache_file)
+    return arrays
+
+
+def prune_traces():
+    """
+    Remove the cached mass traces whose mzML file no longer exists or has changed
+    """
+    removed = 0
+    if not os.path.isdir(TRACES_DIR):
+        return removed
+    for name in os.listdir(TRACES_DIR):
+        cache_file = os.path.join(TRACES_DIR, name)
+        if name.endswith(".tmp"):
+            # Skip traces still being written
+            continue
+        try:
+            # Only the header is read (members of an .npz are loaded on access)
+            with np.load(cache_file, allow_pickle=False) as cache:
+                source = tuple(_read_header(cache)["source"])
+            current = os.path.exists(source[0]) and _source_key(source[0]) == source
+        except Exception:
+            current = False
+        if not current:
+            os.remove(cache_file)
+            removed += 1
+    return removed
@@ -1,14 +1,15 @@
 import pyopenms as oms
 import os
+from experiments.loaders.mzml_peek import peek_mzml
+from experiments.uploads.blob_store import replaced_output
 
 def get_gnps_files(mzML_file_paths, consensus_file, output_dir):
     not_ms2 = []
     output_files = []
     alert = None
     for mzML in mzML_file_paths:
-        exp = oms.MSExperiment()
-        oms.MzMLFile().load(mzML, exp)
-        ms_levels = exp.getMSLevels()
+        # Only the MS levels are checked: read the spectrum headers, not the peaks
+        ms_levels = peek_mzml(mzML)["ms_levels"]
         
         if 2 not in ms_levels:
             not_ms2.append(os.path.basename(mzML))
@@ -33,7 +34,9 @@ def get_gnps_files(mzML_file_paths, consensus_file, output_dir):
         base_no_ext = os.path.splitext(basename)[0]
 
         consensusXML_file = os.path.join(output_dir, f"filtered_{base_no_ext}.consensusXML")
-        oms.ConsensusXMLFile().store(consensusXML_file, filtered_map)
+        # Outputs are renamed into place: a file with the same name may be a link to an uploaded blob
+        with replaced_output(consensusXML_file) as temp_path:
+            oms.ConsensusXMLFile().store(temp_path, filtered_map)
 
         mgf_file = os.path.join(output_dir, f"MS2data_{base_no_ext}.mgf")
     # Debugging/validation prints to help diagnose empty MGF output
@@ -64,11 +67,12 @@ def get_gnps_files(mzML_file_paths, consensus_file, output_dir):
     # GNPSMGFFile.store in pyOpenMS is picky about types: use oms.String for strings and
     # a list of encoded paths (bytes) for mzML list as used elsewhere in the codebase.
         try:
-            oms.GNPSMGFFile().store(
-                oms.String(consensusXML_file),
-                [file.encode() for file in mzML_file_paths],
-                oms.String(mgf_file),
-            )
+            with replaced_output(mgf_file) as temp_path:
+                oms.GNPSMGFFile().store(
+                    oms.String(consensusXML_file),
+                    [file.encode() for file in mzML_file_paths],
+                    oms.String(temp_path),
+                )
         except AssertionError as ae:
             print(f"AssertionError calling GNPSMGFFile.store: {ae}")
             raise
@@ -77,16 +81,19 @@ def get_gnps_files(mzML_file_paths, consensus_file, output_dir):
             raise
 
         quant_file = os.path.join(output_dir, f"{basename}_FeatureQuantificationTable.txt")
-        oms.GNPSQuantificationFile().store(filtered_map, quant_file)
+        with replaced_output(quant_file) as temp_path:
+            oms.GNPSQuantificationFile().store(filtered_map, temp_path)
 
         meta_file = os.path.join(output_dir, f"{basename}_MetaValueTable.tsv")
-        oms.GNPSMetaValueFile().store(filtered_map, meta_file)
+        with replaced_output(meta_file) as temp_path:
+            oms.GNPSMetaValueFile().store(filtered_map, temp_path)
 
     # Annotate using the filtered map
         ion_net = oms.IonIdentityMolecularNetworking()
         ion_net.annotateConsensusMap(filtered_map)
         supp_file = os.path.join(output_dir, f"{basename}_SupplementaryPairTable.csv")
-        ion_net.writeSupplementaryPairTable(filtered_map, supp_file)
+        with replaced_output(supp_file) as temp_path:
+            ion_net.writeSupplementaryPairTable(filtered_map, temp_path)
 
         output_files = [
             consensusXML_file,
@@ -0,0 +1,126 @@
+import os
+import threading
+from collections import OrderedDict
+
+import pyopenms as oms
+
+from experiments.loaders.load_options import ALL_DATA, peak_file_options
+
+# Memory budget of the cache (MB), configurable through the environment
+MAX_CACHE_MB = int(os.environ.get("MS_EXPERIMENT_CACHE_MB", 2048))
+
+# Rough in-memory cost of a peak (m/z + intensity as doubles) and of the per-spectrum metadata
+PEAK_BYTES = 16
+SPECTRUM_OVERHEAD_BYTES = 1024
+
+# (absolute path, size, mtime, LoadOptions) -> (MSExperiment, estimated bytes), least recently used first
+_experiments = OrderedDict()
+_cache_lock = threading.Lock()
+# One lock per key, so two requests for the same file parse it only once
+_loading_locks = {}
+_stats = {"hits": 0, "misses": 0, "evictions": 0, "bytes": 0}
+
+
+def _cache_key(file_path, options):
+    stat = os.stat(file_path)
+    return (os.path.abspath(file_path), stat.st_size, stat.st_mtime_ns, options)
+
+
+def _estimate_bytes(exp):
+    chromatogram_peaks = sum(exp.getChromatogram(i).size() for i in range(exp.getNrChromatograms()))
+    return (exp.getSize() + chromatogram_peaks) * PEAK_BYTES + exp.size() * SPECTRUM_OVERHEAD_BYTES
+
+
+def _evict(max_bytes):
+    while _experiments and _stats["bytes"] > max_bytes:
+        _, (_, nbytes) = _experiments.popitem(last=False)
+        _stats["bytes"] -= nbytes
+        _stats["evictions"] += 1
+
+
+def _get_experiment(file_path, options):
+    """
+    get_experiment, also telling whether the returned object is held by the cache (shared)
+    """
+    key = _cache_key(file_path, options)
+    with _cache_lock:
+        entry = _experiments.get(key)
+        if entry is not None:
+            _experiments.move_to_end(key)
+            _stats["hits"] += 1
+            return entry[0], True
+        loading_lock = _loading_locks.setdefault(key, threading.Lock())
+
+    with loading_lock:
+        with _cache_lock:
+            # Another thread may have finished parsing the same file meanwhile
+            entry = _experiments.get(key)
+            if entry is not None:
+                _experiments.move_to_end(key)
+                _stats["hits"] += 1
+                return entry[0], True
+            _stats["misses"] += 1
+        exp = oms.MSExperiment()
+        mzml_file = oms.MzMLFile()
+        if options != ALL_DATA:
+            mzml_file.setOptions(peak_file_options(options))
+        mzml_file.load(file_path, exp)
+        if options != ALL_DATA:
+            exp.updateRanges()
+        nbytes = _estimate_bytes(exp)
+        max_bytes = MAX_CACHE_MB * 1024 * 1024
+        cached = nbytes <= max_bytes
+        with _cache_lock:
+            _loading_locks.pop(key, None)
+            # Drop stale versions of the same file (it was overwritten)
+            for old_key in [k for k in _experiments if k[0] == key[0] and k[1:3] != key[1:3]]:
+                _stats["bytes"] -= _experiments.pop(old_key)[1]
+            if cached:
+                _experiments[key] = (exp, nbytes)
+                _stats["bytes"] += nbytes
+                _evict(max_bytes)
+    return exp, cached
+
+
+def get_experiment(file_path, options=ALL_DATA):
+    """
+    Return the MSExperiment of an mzML file, parsing it only if it is not cached.
+
+    options (LoadOptions) selects the MS levels, RT/m/z ranges or metadata only, so the
+    parser skips what the caller does not need; each selection is cached separately.
+    The returned object is shared with every other caller: treat it as read-only.
+    Use load_experiment() to get a copy that can be modified in place.
+    """
+    return _get_experiment(file_path, options)[0]
+
+
+def load_experiment(file_path, options=ALL_DATA):
+    """
+    Return a private copy of the cached MSExperiment, for filters that modify it in place.
+    An experiment the cache did not keep (worker processes, files over the budget) is returned
+    as parsed, without a copy.
+    """
+    exp, cached = _get_experiment(file_path, options)
+    return oms.MSExperiment(exp) if cached else exp
+
+
+def invalidate(file_path=None):
+    """
+    Remove a file from the cache (or every file if no path is given)
+    """
+    with _cache_lock:
+        if file_path is None:
+            _experiments.clear()
+            _stats["bytes"] = 0
+            return
+        path = os.path.abspath(file_path)
+        for key in [k for k in _experiments if k[0] == path]:
+            _stats["bytes"] -= _experiments.pop(key)[1]
+
+
+def cache_stats():
+    """
+    Hit/miss counters and memory usage of the cache
+    """
+    with _cache_lock:
+        return dict(_stats, entries=len(_experiments), max_bytes=MAX_CACHE_MB * 1024 * 1024)
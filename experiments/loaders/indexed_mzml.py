@@ -0,0 +1,133 @@
+import os
+import threading
+
+import numpy as np
+import pyopenms as oms
+
+from experiments.loaders.mzml_peek import peek_mzml
+from experiments.loaders.peak_sidecar import get_sidecar, spectrum_peaks
+
+# Opened indexed files: (absolute path, size, mtime) -> state dict (None if the file has no index)
+_indexed = {}
+_indexed_lock = threading.Lock()
+
+
+def _scan_table_from_metadata(file_path):
+    on_disc = oms.OnDiscMSExperiment()
+    on_disc.openFile(file_path, False)
+    meta = on_disc.getMetaData()
+    n_spectra = on_disc.getNrSpectra()
+    rt = np.empty(n_spectra, dtype=np.float64)
+    ms_level = np.empty(n_spectra, dtype=np.int8)
+    precursor_mz = np.full(n_spectra, np.nan)
+    for i in range(n_spectra):
+        spectrum = meta.getSpectrum(i)
+        rt[i] = spectrum.getRT()
+        ms_level[i] = spectrum.getMSLevel()
+        precursors = spectrum.getPrecursors()
+        if precursors:
+            precursor_mz[i] = precursors[0].getMZ()
+    return rt, ms_level, precursor_mz
+
+
+def _open_indexed(file_path):
+    """
+    Open an indexed mzML with OnDiscMSExperiment, keeping its scan table (RT, MS level, precursor).
+    Returns None if the file has no index (in that case the peak sidecar is used).
+    """
+    stat = os.stat(file_path)
+    key = (os.path.abspath(file_path), stat.st_size, stat.st_mtime_ns)
+    with _indexed_lock:
+        if key in _indexed:
+            return _indexed[key]
+
+    on_disc = oms.OnDiscMSExperiment()
+    state = None
+    # The scan table comes from the spectrum headers (peek_mzml), so OpenMS skips its metadata parse
+    if on_disc.openFile(file_path, True):
+        peek = peek_mzml(file_path)
+        if peek["indexed"] and peek["n_spectra"] == on_disc.getNrSpectra():
+            rt, ms_level, precursor_mz = peek["rt"], peek["ms_level"], peek["precursor_mz"]
+        else:
+            rt, ms_level, precursor_mz = _scan_table_from_metadata(file_path)
+        state = {
+            "on_disc": on_disc,
+            "rt": rt,
+            "ms_level": ms_level,
+            "precursor_mz": precursor_mz,
+            # OnDiscMSExperiment reads through a single file handle
+            "lock": threading.Lock(),
+        }
+    else:
+        print(f"[INDEXED] {file_path} has no mzML index, using the peak sidecar")
+
+    with _indexed_lock:
+        for old_key in [k for k in _indexed if k[0] == key[0]]:
+            del _indexed[old_key]
+        _indexed[key] = state
+    return state
+
+
+def _scan_table(file_path):
+    state = _open_indexed(file_path)
+    if state is not None:
+        return state
+    return get_sidecar(file_path)
+
+
+def count_spectra(file_path):
+    return len(_scan_table(file_path)["rt"])
+
+
+def nearest_spectrum_index(file_path, rt, ms_level=None):
+    """
+    Index of the spectrum closest to a retention time (seconds), optionally of a given MS level
+    """
+    table = _scan_table(file_path)
+    candidates = np.arange(len(table["rt"]))
+    if ms_level is not None:
+        candidates = candidates[table["ms_level"] == ms_level]
+    if len(candidates) == 0:
+        return None
+    return int(candidates[np.argmin(np.abs(table["rt"][candidates] - rt))])
+
+
+def read_spectrum(file_path, index):
+    """
+    Decode a single spectrum by index, without loading the rest of the file.
+
+    Returns a dict with 'index', 'rt', 'ms_level', 'precursor_mz', 'mz' and 'intensity'
+    (numpy arrays), or None if the index is out of range.
+    """
+    state = _open_indexed(file_path)
+    table = state if state is not None else get_sidecar(file_path)
+    if not 0 <= index < len(table["rt"]):
+        return None
+    if state is not None:
+        with state["lock"]:
+            spectrum = state["on_disc"].getSpectrum(index)
+        mz, intensity = spectrum.get_peaks()
+    else:
+        mz, intensity = spectrum_peaks(table, index)
+    precursor_mz = table["precursor_mz"][index]
+    return {
+        "index": index,
+        "rt": float(table["rt"][index]),
+        "ms_level": int(table["ms_level"][index]),
+        "precursor_mz": None if np.isnan(precursor_mz) else float(precursor_mz),
+        "mz": np.asarray(mz),
+        "intensity": np.asarray(intensity),
+    }
+
+
+def read_chromatogram(file_path, index):
+    """
+    Decode a single chromatogram by index through the mzML index, without reading any spectrum.
+    Returns (rt, intensity) arrays, or None if the file has no index.
+    """
+    on_disc = oms.OnDiscMSExperiment()
+    # Skip the spectrum metadata: only the chromatogram is read
+    if not on_disc.openFile(file_path, True) or not 0 <= index < on_disc.getNrChromatograms():
+        return None
+    rt, intensity = on_disc.getChromatogram(index).get_peaks()
+    return np.asarray(rt), np.asarray(intensity)
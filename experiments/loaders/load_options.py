@@ -0,0 +1,45 @@
+from collections import namedtuple
+
+import numpy as np
+import pyopenms as oms
+
+# What part of an mzML file a module needs. Every module declares its own options
+# so the parser (or the sidecar reader) skips the data it would throw away anyway.
+# - ms_levels: tuple of MS levels to keep (None keeps all of them)
+# - rt_range: (min, max) retention time in seconds
+# - mz_range: (min, max) m/z of the peaks to keep
+# - metadata_only: keep the spectrum headers (RT, MS level, precursors) but no peaks
+LoadOptions = namedtuple("LoadOptions", ["ms_levels", "rt_range", "mz_range", "metadata_only"],
+                         defaults=(None, None, None, False))
+
+ALL_DATA = LoadOptions()
+MS1_ONLY = LoadOptions(ms_levels=(1,))
+
+
+def peak_file_options(options):
+    """
+    PeakFileOptions for MzMLFile equivalent to the given LoadOptions
+    """
+    file_options = oms.PeakFileOptions()
+    if options.ms_levels:
+        file_options.setMSLevels(list(options.ms_levels))
+    if options.rt_range:
+        file_options.setRTRange(oms.DRange1(float(options.rt_range[0]), float(options.rt_range[1])))
+    if options.mz_range:
+        file_options.setMZRange(oms.DRange1(float(options.mz_range[0]), float(options.mz_range[1])))
+    if options.metadata_only:
+        # setMetadataOnly() would also drop the spectra: only skip decoding their peaks
+        file_options.setFillData(False)
+    return file_options
+
+
+def select_spectra(scan_table, options):
+    """
+    Indices of the spectra of a scan table (peak sidecar or mzML index) matching the MS levels and RT range
+    """
+    mask = np.ones(len(scan_table["rt"]), dtype=bool)
+    if options.ms_levels:
+        mask &= np.isin(scan_table["ms_level"], options.ms_levels)
+    if options.rt_range:
+        mask &= (scan_table["rt"] >= options.rt_range[0]) & (scan_table["rt"] <= options.rt_range[1])
+    return np.flatnonzero(mask)
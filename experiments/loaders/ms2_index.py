@@ -0,0 +1,90 @@
+import os
+import threading
+
+import numpy as np
+
+from experiments.loaders.mzml_peek import peek_mzml
+
+# Precursor tolerance (ppm) used when an MS2 spectrum is selected by its precursor m/z
+PRECURSOR_TOLERANCE_PPM = 10.0
+# MS2 spectrum (position among the MS2 spectra) shown when nothing is selected
+DEFAULT_MS2 = 80
+
+# (absolute path, size, mtime) -> MS2 browsing index
+_indexes = {}
+_indexes_lock = threading.Lock()
+
+
+def ms2_index(file_path):
+    """
+    MS2 browsing index of an mzML file, built once from the spectrum headers (no peak is decoded).
+
+    Returns a dict of arrays: 'ms1' (file indices of the MS1 spectra) and, one value per MS2
+    spectrum, 'ms2' (file index), 'rt', 'precursor_mz', 'precursor_charge' and 'parent'
+    (file index of the last MS1 spectrum before it, -1 if there is none).
+    """
+    stat = os.stat(file_path)
+    key = (os.path.abspath(file_path), stat.st_size, stat.st_mtime_ns)
+    with _indexes_lock:
+        index = _indexes.get(key)
+    if index is not None:
+        return index
+
+    peek = peek_mzml(file_path)
+    ms1 = np.flatnonzero(peek["ms_level"] == 1)
+    ms2 = np.flatnonzero(peek["ms_level"] == 2)
+    # Parent MS1: the closest MS1 spectrum acquired before each MS2 spectrum
+    position = np.searchsorted(ms1, ms2) - 1
+    index = {
+        "ms1": ms1,
+        "ms2": ms2,
+        "rt": peek["rt"][ms2],
+        "precursor_mz": peek["precursor_mz"][ms2],
+        "precursor_charge": peek["precursor_charge"][ms2],
+        "parent": np.where(position >= 0, ms1[np.maximum(position, 0)], -1) if len(ms1) else np.full(len(ms2), -1),
+    }
+
+    with _indexes_lock:
+        for old_key in [k for k in _indexes if k[0] == key[0]]:
+            del _indexes[old_key]
+        _indexes[key] = index
+    return index
+
+
+def select_ms2(index, precursor_mz=None, rt=None, tolerance_ppm=PRECURSOR_TOLERANCE_PPM):
+    """
+    Position (in index['ms2']) of the MS2 spectrum to show.
+
+    With precursor_mz, the MS2 spectra whose precursor is within tolerance_ppm (or else the
+    nearest precursor) are candidates; with rt, the closest one in retention time is chosen,
+    otherwise the first one. Without any of them the DEFAULT_MS2 spectrum is shown.
+    Returns None if the file has no MS2 spectra.
+    """
+    n_ms2 = len(index["ms2"])
+    if n_ms2 == 0:
+        return None
+    candidates = np.arange(n_ms2)
+    if precursor_mz is not None:
+        error = np.abs(index["precursor_mz"] - precursor_mz)
+        error = np.where(np.isnan(error), np.inf, error)
+        within = np.flatnonzero(error <= precursor_mz * tolerance_ppm * 1e-6)
+        candidates = within if len(within) else np.flatnonzero(error == error.min())
+    if rt is not None:
+        return int(candidates[np.argmin(np.abs(index["rt"][candidates] - rt))])
+    if precursor_mz is not None:
+        return int(candidates[0])
+    return min(DEFAULT_MS2, n_ms2 - 1)
+
+
+def precursor_list(index, max_items=500):
+    """
+    Distinct precursor m/z values (4 decimals) with the number of MS2 spectra of each one,
+    sorted by m/z, for the precursor selector of the MS2 views
+    """
+    precursors = index["precursor_mz"][~np.isnan(index["precursor_mz"])]
+    values, counts = np.unique(np.round(precursors, 4), return_counts=True)
+    if len(values) > max_items:
+        # The most fragmented precursors first
+        keep = np.sort(np.argsort(counts, kind="stable")[::-1][:max_items])
+        values, counts = values[keep], counts[keep]
+    return [(float(value), int(count)) for value, count in zip(values, counts)]
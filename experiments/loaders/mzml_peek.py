@@ -0,0 +1,312 @@
+import os
+import re
+import threading
+
+import numpy as np
+import pyopenms as oms
+
+from experiments.loaders.peak_sidecar import SCAN_ARRAYS
+
+# Bytes read at a time from the start of a spectrum until its binary arrays begin
+HEADER_CHUNK = 2048
+# The mzML header (everything before <run>) is never expected to be larger than this
+MAX_HEADER_BYTES = 16 * 1024 * 1024
+
+# PSI-MS accessions read from the spectrum headers
+MS_LEVEL = "MS:1000511"
+SCAN_START_TIME = "MS:1000016"
+CENTROID_SPECTRUM = "MS:1000127"
+PROFILE_SPECTRUM = "MS:1000128"
+POSITIVE_SCAN = "MS:1000130"
+NEGATIVE_SCAN = "MS:1000129"
+SELECTED_ION_MZ = "MS:1000744"
+CHARGE_STATE = "MS:1000041"
+LOWEST_OBSERVED_MZ = "MS:1000528"
+HIGHEST_OBSERVED_MZ = "MS:1000527"
+SCAN_WINDOW_LOWER = "MS:1000501"
+SCAN_WINDOW_UPPER = "MS:1000500"
+TIC_CHROMATOGRAM = "MS:1000235"
+BPC_CHROMATOGRAM = "MS:1000628"
+# Instrument configuration params that are not the instrument model
+NOT_INSTRUMENT_MODEL = {"MS:1000529", "MS:1000031"}  # serial number, generic "instrument model"
+
+_CV_PARAM = re.compile(rb"<cvParam\b([^>]*)>")
+_ACCESSION = re.compile(rb'\baccession="([^"]*)"')
+_PARAM_GROUP = re.compile(rb'<referenceableParamGroup\s+id="([^"]+)"(.*?)</referenceableParamGroup>', re.S)
+_PARAM_GROUP_REF = re.compile(rb'<referenceableParamGroupRef\s+ref="([^"]+)"')
+_INDEX_LIST_OFFSET = re.compile(rb"<indexListOffset>\s*(\d+)\s*</indexListOffset>")
+_OFFSET = re.compile(rb"<offset\b[^>]*>\s*(\d+)\s*</offset>")
+_ELEMENT_ID = re.compile(rb'\bid="([^"]*)"')
+
+# (absolute path, size, mtime) -> peek dict
+_peeks = {}
+_peeks_lock = threading.Lock()
+
+
+def _cv_params(text, param_groups=None):
+    """
+    accession -> raw attributes of every cvParam in a piece of mzML (first occurrence wins),
+    including the referenced param groups. The attributes are only parsed on demand (_attribute)
+    """
+    params = {}
+    if param_groups:
+        for ref in _PARAM_GROUP_REF.findall(text):
+            text += param_groups.get(ref, b"")
+    for match in _CV_PARAM.finditer(text):
+        accession = _ACCESSION.search(match.group(1))
+        if accession:
+            params.setdefault(accession.group(1).decode("latin-1"), match.group(1))
+    return params
+
+
+def _attribute(params, accession, name):
+    raw = params.get(accession)
+    if raw is None:
+        return None
+    match = re.search(rb'\b' + name.encode() + rb'="([^"]*)"', raw)
+    return match.group(1).decode("latin-1") if match else None
+
+
+def _read_header(f):
+    header = b""
+    while b"<run" not in header and len(header) < MAX_HEADER_BYTES:
+        chunk = f.read(64 * 1024)
+        if not chunk:
+            break
+        header += chunk
+    return header.split(b"<run", 1)[0]
+
+
+def _instrument_name(header, param_groups):
+    configuration = header.split(b"<instrumentConfiguration ", 1)
+    if len(configuration) < 2:
+        return None
+    configuration = configuration[1].split(b"<componentList", 1)[0].split(b"</instrumentConfiguration>", 1)[0]
+    params = _cv_params(configuration, param_groups)
+    for accession in params:
+        if accession not in NOT_INSTRUMENT_MODEL:
+            return _attribute(params, accession, "name") or None
+    return None
+
+
+def _read_index(f, file_size):
+    """
+    Spectrum and chromatogram offsets of an indexed mzML, or None if the file has no index
+    """
+    f.seek(max(0, file_size - 4096))
+    match = _INDEX_LIST_OFFSET.search(f.read())
+    if not match or int(match.group(1)) >= file_size:
+        return None
+    f.seek(int(match.group(1)))
+    index_list = f.read()
+    offsets = {}
+    for name in (b"spectrum", b"chromatogram"):
+        section = index_list.split(b'<index name="' + name + b'">', 1)
+        section = section[1].split(b"</index>", 1)[0] if len(section) == 2 else b""
+        offsets[name.decode()] = [int(offset) for offset in _OFFSET.findall(section)]
+    return offsets
+
+
+def mzml_index(file_path):
+    """
+    Byte offsets of the spectra and chromatograms ({'spectrum': [...], 'chromatogram': [...]})
+    of an indexed mzML, or None if the file has no index
+    """
+    with open(file_path, "rb") as f:
+        return _read_index(f, os.path.getsize(file_path))
+
+
+def _spectrum_header(f, offset, end_tag=b"</spectrum>"):
+    """
+    Text of a spectrum (or chromatogram) up to its binary data arrays (the peaks are never read)
+    """
+    f.seek(offset)
+    text = b""
+    while True:
+        chunk = f.read(HEADER_CHUNK)
+        text += chunk
+        # Spectra without peaks have no binary arrays: stop at whichever comes first
+        ends = [end for end in (text.find(b"<binaryDataArrayList"), text.find(end_tag)) if end != -1]
+        if ends:
+            return text[:min(ends)]
+        if not chunk:
+            return text
+
+
+def _float(params, accession):
+    value = _attribute(params, accession, "value")
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return np.nan
+
+
+def chromatogram_kind(native_id, params=()):
+    """
+    'tic', 'bpc' or None, from the chromatogram type cvParam or else its native ID
+    """
+    if TIC_CHROMATOGRAM in params:
+        return "tic"
+    if BPC_CHROMATOGRAM in params:
+        return "bpc"
+    native_id = native_id.lower()
+    if "bpc" in native_id or "basepeak" in native_id.replace(" ", ""):
+        return "bpc"
+    if "tic" in native_id:
+        return "tic"
+    return None
+
+
+def _chromatogram_from_header(text, param_groups):
+    match = _ELEMENT_ID.search(text)
+    native_id = match.group(1).decode("latin-1") if match else ""
+    return {"native_id": native_id, "kind": chromatogram_kind(native_id, _cv_params(text, param_groups))}
+
+
+def _scan_from_cv_params(params):
+    rt = _float(params, SCAN_START_TIME)
+    if _attribute(params, SCAN_START_TIME, "unitName") == "minute":
+        rt *= 60
+    lowest = _float(params, LOWEST_OBSERVED_MZ)
+    highest = _float(params, HIGHEST_OBSERVED_MZ)
+    if np.isnan(lowest) or np.isnan(highest):
+        lowest, highest = _float(params, SCAN_WINDOW_LOWER), _float(params, SCAN_WINDOW_UPPER)
+    ms_level = _float(params, MS_LEVEL)
+    charge = _float(params, CHARGE_STATE)
+    return {
+        "rt": rt,
+        "ms_level": 0 if np.isnan(ms_level) else int(ms_level),
+        "precursor_mz": _float(params, SELECTED_ION_MZ),
+        "precursor_charge": 0 if np.isnan(charge) else int(charge),
+        "polarity": 1 if POSITIVE_SCAN in params else 2 if NEGATIVE_SCAN in params else 0,
+        "spectrum_type": 1 if CENTROID_SPECTRUM in params else 2 if PROFILE_SPECTRUM in params else 0,
+        "mz_low": lowest,
+        "mz_high": highest,
+    }
+
+
+def _peek_indexed(file_path):
+    """
+    Read the spectrum headers through the mzML index: only a few KB per spectrum are read
+    """
+    file_size = os.path.getsize(file_path)
+    with open(file_path, "rb") as f:
+        index = _read_index(f, file_size)
+        if index is None:
+            return None
+        f.seek(0)
+        header = _read_header(f)
+        param_groups = dict(_PARAM_GROUP.findall(header))
+        scans = [_scan_from_cv_params(_cv_params(_spectrum_header(f, offset), param_groups))
+                 for offset in index["spectrum"]]
+        chromatograms = [_chromatogram_from_header(_spectrum_header(f, offset, b"</chromatogram>"), param_groups)
+                         for offset in index["chromatogram"]]
+    return {
+        "indexed": True,
+        "instrument": _instrument_name(header, param_groups),
+        "chromatograms": chromatograms,
+        "scans": scans,
+    }
+
+
+class _HeaderReader:
+    """
+    MzMLFile.transform consumer for files without index (the binary arrays are not decoded)
+    """
+
+    def __init__(self):
+        self.scans = []
+        self.instrument = None
+        self.chromatograms = []
+
+    def setExpectedSize(self, n_spectra, n_chromatograms):
+        pass
+
+    def setExperimentalSettings(self, settings):
+        self.instrument = settings.getInstrument().getName() or None
+
+    def consumeSpectrum(self, spectrum):
+        precursors = spectrum.getPrecursors()
+        windows = spectrum.getInstrumentSettings().getScanWindows()
+        self.scans.append({
+            "rt": spectrum.getRT(),
+            "ms_level": spectrum.getMSLevel(),
+            "precursor_mz": precursors[0].getMZ() if precursors else np.nan,
+            "precursor_charge": precursors[0].getCharge() if precursors else 0,
+            "polarity": spectrum.getInstrumentSettings().getPolarity().value,
+            "spectrum_type": spectrum.getType().value,
+            "mz_low": windows[0].begin if windows else np.nan,
+            "mz_high": windows[0].end if windows else np.nan,
+        })
+
+    def consumeChromatogram(self, chromatogram):
+        types = oms.ChromatogramSettings.ChromatogramType
+        params = {types.TOTAL_ION_CURRENT_CHROMATOGRAM: (TIC_CHROMATOGRAM,),
+                  types.BASEPEAK_CHROMATOGRAM: (BPC_CHROMATOGRAM,)}.get(chromatogram.getChromatogramType(), ())
+        native_id = chromatogram.getNativeID()
+        self.chromatograms.append({"native_id": native_id, "kind": chromatogram_kind(native_id, params)})
+
+
+def _peek_stream(file_path):
+    mzml_file = oms.MzMLFile()
+    options = mzml_file.getOptions()
+    options.setFillData(False)
+    mzml_file.setOptions(options)
+    reader = _HeaderReader()
+    mzml_file.transform(file_path.encode("utf-8"), reader)
+    return {
+        "indexed": False,
+        "instrument": reader.instrument,
+        "chromatograms": reader.chromatograms,
+        "scans": reader.scans,
+    }
+
+
+def peek_mzml(file_path):
+    """
+    Metadata of an mzML file without decoding any peak.
+
+    Indexed files are read through the index (a few KB per spectrum header); files without
+    index are streamed by OpenMS skipping the binary arrays. Returns a dict with:
+    'n_spectra', 'n_chromatograms', 'chromatograms' ([{'native_id', 'kind'}], kind 'tic', 'bpc' or None),
+    'ms_levels' ({level: spectra}), 'rt_range' (seconds),
+    'mz_range' (from the observed m/z or scan window params, None if the file has neither),
+    'instrument', 'polarities', 'spectrum_types' ({'centroid', 'profile', 'unknown'}: spectra),
+    'indexed' and the scan table arrays (same names and types as the peak sidecar).
+    """
+    stat = os.stat(file_path)
+    key = (os.path.abspath(file_path), stat.st_size, stat.st_mtime_ns)
+    with _peeks_lock:
+        peek = _peeks.get(key)
+    if peek is not None:
+        return peek
+
+    raw = _peek_indexed(file_path) or _peek_stream(file_path)
+    scans = raw.pop("scans")
+    peek = dict(raw)
+    peek["n_spectra"] = len(scans)
+    peek["n_chromatograms"] = len(peek["chromatograms"])
+    for name, dtype in SCAN_ARRAYS.items():
+        peek[name] = np.array([scan[name] for scan in scans], dtype=dtype)
+    mz_low = np.array([scan["mz_low"] for scan in scans], dtype=np.float64)
+    mz_high = np.array([scan["mz_high"] for scan in scans], dtype=np.float64)
+
+    levels, counts = np.unique(peek["ms_level"], return_counts=True)
+    peek["ms_levels"] = {int(level): int(count) for level, count in zip(levels, counts)}
+    rt = peek["rt"][~np.isnan(peek["rt"])]
+    peek["rt_range"] = (float(rt.min()), float(rt.max())) if len(rt) else None
+    valid = ~np.isnan(mz_low) & ~np.isnan(mz_high)
+    peek["mz_range"] = (float(mz_low[valid].min()), float(mz_high[valid].max())) if valid.any() else None
+    peek["polarities"] = sorted({str(oms.IonSource.Polarity(int(code))) for code in np.unique(peek["polarity"])})
+    types = peek["spectrum_type"]
+    peek["spectrum_types"] = {
+        "centroid": int(np.count_nonzero(types == 1)),
+        "profile": int(np.count_nonzero(types == 2)),
+        "unknown": int(np.count_nonzero(types == 0)),
+    }
+
+    with _peeks_lock:
+        for old_key in [k for k in _peeks if k[0] == key[0]]:
+            del _peeks[old_key]
+        _peeks[key] = peek
+    return peek
@@ -0,0 +1,254 @@
+import hashlib
+import json
+import os
+import shutil
+import threading
+import uuid
+
+import numpy as np
+import pyopenms as oms
+
+# Folder holding one sidecar directory per converted mzML
+PEAKS_DIR = os.environ.get("MS_PEAKS_DIR", os.path.join("uploads", "peaks"))
+SIDECAR_VERSION = 1
+
+# Flat peak arrays, written incrementally while the mzML is streamed
+PEAK_ARRAYS = {"mz": np.float64, "intensity": np.float32}
+# Scan table, one value per spectrum
+SCAN_ARRAYS = {
+    "rt": np.float64,
+    "ms_level": np.int8,
+    "precursor_mz": np.float64,  # NaN when the spectrum has no precursor
+    "precursor_charge": np.int16,
+    "polarity": np.int8,  # IonSource.Polarity: 0 unknown, 1 positive, 2 negative
+    "spectrum_type": np.int8,  # SpectrumType: 0 unknown, 1 centroid, 2 profile
+}
+
+# Opened sidecars: (absolute path, size, mtime) -> dict of arrays
+_sidecars = {}
+_sidecars_lock = threading.Lock()
+_building_locks = {}
+
+
+def sidecar_path(file_path):
+    """
+    Directory of the sidecar of an mzML file (named after the hash of its absolute path)
+    """
+    name = hashlib.sha1(os.path.abspath(file_path).encode("utf-8")).hexdigest()
+    return os.path.join(PEAKS_DIR, f"{name}.peaks")
+
+
+def _read_meta(folder):
+    meta_file = os.path.join(folder, "meta.json")
+    if not os.path.exists(meta_file):
+        return None
+    with open(meta_file, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def _is_current(meta, file_path):
+    stat = os.stat(file_path)
+    return (meta is not None
+            and meta.get("version") == SIDECAR_VERSION
+            and meta.get("source_size") == stat.st_size
+            and meta.get("source_mtime_ns") == stat.st_mtime_ns)
+
+
+class _SidecarWriter:
+    """
+    MzMLFile.transform consumer: appends every spectrum to the peak files and the scan table,
+    so the conversion never holds more than one spectrum in memory.
+    """
+
+    def __init__(self, folder):
+        self.peak_files = {name: open(os.path.join(folder, f"{name}.bin"), "wb") for name in PEAK_ARRAYS}
+        self.scans = {name: [] for name in SCAN_ARRAYS}
+        self.offsets = [0]
+        self.activation_methods = set()
+        self.chromatograms = []
+        self.instrument = None
+        self.ionization_methods = []
+        self.analyzers = []
+
+    def setExpectedSize(self, n_spectra, n_chromatograms):
+        pass
+
+    def setExperimentalSettings(self, settings):
+        instrument = settings.getInstrument()
+        self.instrument = instrument.getName() or None
+        self.ionization_methods = [str(source.getIonizationMethod()) for source in instrument.getIonSources()]
+        self.analyzers = [{"type": str(analyzer.getType()), "resolution": analyzer.getResolution()}
+                          for analyzer in instrument.getMassAnalyzers()]
+
+    def consumeSpectrum(self, spectrum):
+        mz, intensity = spectrum.get_peaks()
+        self.peak_files["mz"].write(np.asarray(mz, dtype=np.float64).tobytes())
+        self.peak_files["intensity"].write(np.asarray(intensity, dtype=np.float32).tobytes())
+        self.offsets.append(self.offsets[-1] + len(mz))
+
+        precursors = spectrum.getPrecursors()
+        self.scans["rt"].append(spectrum.getRT())
+        self.scans["ms_level"].append(spectrum.getMSLevel())
+        self.scans["precursor_mz"].append(precursors[0].getMZ() if precursors else np.nan)
+        self.scans["precursor_charge"].append(precursors[0].getCharge() if precursors else 0)
+        self.scans["polarity"].append(spectrum.getInstrumentSettings().getPolarity().value)
+        self.scans["spectrum_type"].append(spectrum.getType().value)
+        for precursor in precursors:
+            for method in precursor.getActivationMethods():
+                self.activation_methods.add(str(method))
+
+    def consumeChromatogram(self, chromatogram):
+        self.chromatograms.append({"native_id": chromatogram.getNativeID(), "size": chromatogram.size()})
+
+    def close(self, folder, file_path):
+        for f in self.peak_files.values():
+            f.close()
+        np.save(os.path.join(folder, "offsets.npy"), np.asarray(self.offsets, dtype=np.int64))
+        for name, dtype in SCAN_ARRAYS.items():
+            np.save(os.path.join(folder, f"{name}.npy"), np.asarray(self.scans[name], dtype=dtype))
+        stat = os.stat(file_path)
+        meta = {
+            "version": SIDECAR_VERSION,
+            "source": os.path.abspath(file_path),
+            "source_size": stat.st_size,
+            "source_mtime_ns": stat.st_mtime_ns,
+            "n_spectra": len(self.offsets) - 1,
+            "n_peaks": self.offsets[-1],
+            "instrument": self.instrument,
+            "ionization_methods": self.ionization_methods,
+            "analyzers": self.analyzers,
+            "activation_methods": sorted(self.activation_methods),
+            "chromatograms": self.chromatograms,
+        }
+        with open(os.path.join(folder, "meta.json"), "w", encoding="utf-8") as f:
+            json.dump(meta, f)
+
+
+def build_sidecar(file_path):
+    """
+    Convert an mzML file into its sidecar directory (streaming, one spectrum at a time).
+    The sidecar is written to a temporary folder and renamed into place when complete.
+    """
+    folder = sidecar_path(file_path)
+    os.makedirs(PEAKS_DIR, exist_ok=True)
+    temp_folder = f"{folder}.{uuid.uuid4().hex}.tmp"
+    os.makedirs(temp_folder)
+    try:
+        writer = _SidecarWriter(temp_folder)
+        try:
+            oms.MzMLFile().transform(file_path.encode("utf-8"), writer)
+        finally:
+            writer.close(temp_folder, file_path)
+        if os.path.exists(folder):
+            shutil.rmtree(folder, ignore_errors=True)
+        os.replace(temp_folder, folder)
+    finally:
+        if os.path.exists(temp_folder):
+            shutil.rmtree(temp_folder, ignore_errors=True)
+    return folder
+
+
+def _open_peak_array(folder, name, length):
+    if length == 0:
+        # np.memmap cannot map an empty file
+        return np.zeros(0, dtype=PEAK_ARRAYS[name])
+    return np.memmap(os.path.join(folder, f"{name}.bin"), dtype=PEAK_ARRAYS[name], mode="r", shape=(length,))
+
+
+def get_sidecar(file_path):
+    """
+    Open the sidecar of an mzML file, converting the file first if there is no up to date sidecar.
+
+    Returns a dict with the memory-mapped 'mz' and 'intensity' arrays, the 'offsets' array
+    (peaks of spectrum i are [offsets[i], offsets[i + 1])), the scan table arrays and 'meta'.
+    Opening is O(1): only the pages actually read are loaded from disk.
+    """
+    stat = os.stat(file_path)
+    key = (os.path.abspath(file_path), stat.st_size, stat.st_mtime_ns)
+    with _sidecars_lock:
+        sidecar = _sidecars.get(key)
+        if sidecar is not None:
+            return sidecar
+        building_lock = _building_locks.setdefault(key[0], threading.Lock())
+
+    with building_lock:
+        with _sidecars_lock:
+            sidecar = _sidecars.get(key)
+            if sidecar is not None:
+                return sidecar
+        folder = sidecar_path(file_path)
+        meta = _read_meta(folder)
+        if not _is_current(meta, file_path):
+            print(f"[PEAKS] Converting {file_path} to {folder}")
+            build_sidecar(file_path)
+            meta = _read_meta(folder)
+
+        sidecar = {"meta": meta, "folder": folder}
+        sidecar["offsets"] = np.load(os.path.join(folder, "offsets.npy"), mmap_mode="r")
+        for name in PEAK_ARRAYS:
+            sidecar[name] = _open_peak_array(folder, name, meta["n_peaks"])
+        for name in SCAN_ARRAYS:
+            sidecar[name] = np.load(os.path.join(folder, f"{name}.npy"))
+        with _sidecars_lock:
+            # Forget older versions of the same file
+            for old_key in [k for k in _sidecars if k[0] == key[0]]:
+                del _sidecars[old_key]
+            _sidecars[key] = sidecar
+    return sidecar
+
+
+def spectrum_peaks(sidecar, index):
+    """
+    m/z and intensity arrays of one spectrum (views on the memory-mapped arrays, no copy)
+    """
+    start, end = sidecar["offsets"][index], sidecar["offsets"][index + 1]
+    return sidecar["mz"][start:end], sidecar["intensity"][start:end]
+
+
+def gather_peaks(sidecar, indices, mz_range=None):
+    """
+    Copy the peaks of the given spectra into two contiguous arrays.
+
+    The output is preallocated from the offsets and only the selected spectra are read,
+    so the pages of the other spectra are never touched. mz_range (min, max) keeps only
+    the peaks inside that window.
+    """
+    offsets = sidecar["offsets"]
+    indices = np.asarray(indices, dtype=np.int64)
+    starts = np.asarray(offsets[indices])
+    ends = np.asarray(offsets[indices + 1])
+    total = int((ends - starts).sum())
+    mz = np.empty(total, dtype=np.float64)
+    intensity = np.empty(total, dtype=np.float32)
+    position = 0
+    for start, end in zip(starts, ends):
+        count = end - start
+        mz[position:position + count] = sidecar["mz"][start:end]
+        intensity[position:position + count] = sidecar["intensity"][start:end]
+        position += count
+    if mz_range is not None:
+        keep = (mz >= mz_range[0]) & (mz <= mz_range[1])
+        mz, intensity = mz[keep], intensity[keep]
+    return mz, intensity
+
+
+def prune_sidecars():
+    """
+    Remove the sidecars whose mzML file no longer exists
+    """
+    removed = 0
+    if not os.path.isdir(PEAKS_DIR):
+        return removed
+    for name in os.listdir(PEAKS_DIR):
+        folder = os.path.join(PEAKS_DIR, name)
+        if not os.path.isdir(folder) or name.endswith(".tmp"):
+            # Skip sidecars still being written
+            continue
+        meta = _read_meta(folder)
+        if meta is None or not os.path.exists(meta.get("source", "")):
+            shutil.rmtree(folder, ignore_errors=True)
+            removed += 1
+    with _sidecars_lock:
+        for key in [k for k in _sidecars if not os.path.exists(k[0])]:
+            del _sidecars[key]
+    return removed
@@ -0,0 +1,137 @@
+import threading
+
+import numpy as np
+
+from experiments.loaders.peak_sidecar import get_sidecar
+from experiments.loaders.load_options import MS1_ONLY, select_spectra
+from experiments.loaders.mzml_peek import peek_mzml
+from experiments.loaders.indexed_mzml import read_chromatogram
+
+# Largest RT difference (seconds) between a stored chromatogram and the spectra it should come from
+RT_TOLERANCE = 1e-3
+
+# Peaks read per block in the single pass over the sidecar (bounds the extra memory)
+BLOCK_PEAKS = 4_000_000
+
+# (sidecar folder, source size, source mtime) -> scan_peaks() result
+_stats = {}
+_stats_lock = threading.Lock()
+
+
+def _block_stats(mz, intensity, counts):
+    """
+    Per-spectrum statistics of a block of whole spectra (all of them with peaks),
+    using reductions over the flat arrays instead of a loop over the spectra
+    """
+    starts = np.concatenate(([0], np.cumsum(counts)[:-1]))
+    tic = np.add.reduceat(intensity, starts, dtype=np.float64)
+    bpc = np.maximum.reduceat(intensity, starts)
+    # Base peak position: first peak of each spectrum equal to its maximum (same as argmax)
+    spectrum_of_peak = np.repeat(np.arange(len(counts)), counts)
+    candidates = np.flatnonzero(intensity == bpc[spectrum_of_peak])
+    _, first = np.unique(spectrum_of_peak[candidates], return_index=True)
+    return {
+        "tic": tic,
+        "bpc": bpc,
+        "base_peak_mz": mz[candidates[first]],
+        "mz_sum": np.add.reduceat(mz, starts),
+        "first_mz": mz[starts],
+        "last_mz": mz[starts + counts - 1],
+    }
+
+
+def scan_peaks(sidecar):
+    """
+    Single pass over the peaks of a sidecar, one block of whole spectra at a time.
+
+    Returns per-spectrum arrays ('tic', 'bpc', 'base_peak_mz', 'peak_count', 'mz_sum',
+    'first_mz', 'last_mz'; NaN or 0 for spectra without peaks) and the global m/z and
+    intensity ranges, computed with running NumPy reductions. The result is cached per sidecar.
+    """
+    meta = sidecar["meta"]
+    key = (sidecar["folder"], meta["source_size"], meta["source_mtime_ns"])
+    with _stats_lock:
+        stats = _stats.get(key)
+    if stats is not None:
+        return stats
+
+    offsets = np.asarray(sidecar["offsets"])
+    n_spectra = len(offsets) - 1
+    peak_count = np.diff(offsets)
+    stats = {
+        "tic": np.zeros(n_spectra),
+        "bpc": np.zeros(n_spectra),
+        "base_peak_mz": np.full(n_spectra, np.nan),
+        "peak_count": peak_count,
+        "mz_sum": np.zeros(n_spectra),
+        "first_mz": np.full(n_spectra, np.nan),
+        "last_mz": np.full(n_spectra, np.nan),
+    }
+    mz_min = int_min = np.inf
+    mz_max = int_max = -np.inf
+
+    start = 0
+    while start < n_spectra:
+        end = int(np.searchsorted(offsets, offsets[start] + BLOCK_PEAKS, side="right")) - 1
+        end = min(max(end, start + 1), n_spectra)
+        first, last = offsets[start], offsets[end]
+        if last > first:
+            mz = sidecar["mz"][first:last]
+            intensity = sidecar["intensity"][first:last]
+            mz_min, mz_max = min(mz_min, mz.min()), max(mz_max, mz.max())
+            int_min, int_max = min(int_min, intensity.min()), max(int_max, intensity.max())
+            # Only spectra with peaks (reduceat needs non-empty segments)
+            index = start + np.flatnonzero(peak_count[start:end] > 0)
+            for name, values in _block_stats(mz, intensity, peak_count[index]).items():
+                stats[name][index] = values
+        start = end
+
+    has_peaks = offsets[-1] > 0
+    stats["mz_range"] = (float(mz_min), float(mz_max)) if has_peaks else (None, None)
+    stats["intensity_range"] = (float(int_min), float(int_max)) if has_peaks else (None, None)
+    with _stats_lock:
+        for old_key in [k for k in _stats if k[0] == key[0]]:
+            del _stats[old_key]
+        _stats[key] = stats
+    return stats
+
+
+def ms1_chromatograms(file_path, options=MS1_ONLY):
+    """
+    TIC, BPC, base peak m/z and peak count of the MS1 spectra of an mzML file.
+
+    Returns a dict of arrays ('index', 'rt' in seconds, 'tic', 'bpc', 'base_peak_mz', 'peak_count')
+    shared by the Summary and Chromatogram pages.
+    """
+    sidecar = get_sidecar(file_path)
+    stats = scan_peaks(sidecar)
+    index = select_spectra(sidecar, options)
+    chromatograms = {"index": index, "rt": sidecar["rt"][index]}
+    for name in ("tic", "bpc", "base_peak_mz", "peak_count"):
+        chromatograms[name] = stats[name][index]
+    return chromatograms
+
+
+def stored_chromatogram(file_path, kind, ms_level=1):
+    """
+    TIC ('tic') or BPC ('bpc') chromatogram embedded in the mzML, read through the mzML index.
+
+    It is only used if it has one point per spectrum of the requested MS level at the same
+    retention times (vendor TICs often mix MS1 and MS2 scans). Returns a dict with 'index'
+    (spectra of that level), 'rt' and 'intensity', or None when it has to be computed from the peaks.
+    """
+    peek = peek_mzml(file_path)
+    if not peek["indexed"]:
+        return None
+    index = np.flatnonzero(peek["ms_level"] == ms_level)
+    for position, chromatogram in enumerate(peek["chromatograms"]):
+        if chromatogram["kind"] != kind:
+            continue
+        data = read_chromatogram(file_path, position)
+        if data is None:
+            return None
+        rt, intensity = data
+        if len(rt) == len(index) and np.allclose(rt, peek["rt"][index], rtol=0, atol=RT_TOLERANCE):
+            print(f"[CHROMATOGRAM] Using the stored {kind.upper()} '{chromatogram['native_id']}' of {file_path}")
+            return {"index": index, "rt": rt, "intensity": intensity}
+    return None
@@ -0,0 +1,48 @@
+import pyopenms as oms
+
+from experiments.uploads.blob_store import replaced_output
+
+
+class _FilterConsumer:
+    """
+    MzMLFile.transform consumer: filters every spectrum (and chromatogram) as it is read and
+    hands it straight to an mzML writer, so only one spectrum is in memory at a time.
+    """
+
+    def __init__(self, output_path, process_spectrum, process_chromatogram=None):
+        self.writer = oms.PlainMSDataWritingConsumer(output_path)
+        self.process_spectrum = process_spectrum
+        self.process_chromatogram = process_chromatogram
+
+    def setExpectedSize(self, n_spectra, n_chromatograms):
+        self.writer.setExpectedSize(n_spectra, n_chromatograms)
+
+    def setExperimentalSettings(self, settings):
+        self.writer.setExperimentalSettings(settings)
+
+    def consumeSpectrum(self, spectrum):
+        self.writer.consumeSpectrum(self.process_spectrum(spectrum))
+
+    def consumeChromatogram(self, chromatogram):
+        if self.process_chromatogram is not None:
+            chromatogram = self.process_chromatogram(chromatogram)
+        self.writer.consumeChromatogram(chromatogram)
+
+
+def stream_filter(input_path, output_path, process_spectrum, process_chromatogram=None):
+    """
+    Read an mzML file spectrum by spectrum, apply process_spectrum and write the result to output_path.
+
+    process_spectrum (and process_chromatogram, if given) receives an MSSpectrum / MSChromatogram
+    and returns the one to write (it can modify the input in place and return it).
+    Peak memory is bounded by one spectrum instead of the whole run.
+    Returns the number of spectra written.
+    """
+    # Written next to output_path and renamed over it (output_path may be a link to an uploaded blob)
+    with replaced_output(output_path) as temp_path:
+        consumer = _FilterConsumer(temp_path, process_spectrum, process_chromatogram)
+        oms.MzMLFile().transform(input_path.encode("utf-8"), consumer)
+        n_spectra = consumer.writer.getNrSpectraWritten()
+        # The writer closes the mzML (index and footer) when it is destroyed
+        del consumer
+    return n_spectra
@@ -0,0 +1,114 @@
+import os
+
+import plotly.graph_objects as go
+import pyopenms as oms
+
+from experiments.parallel.pool import file_task_memory, run_parallel
+from experiments.parallel.sharded import first_spectrum, sharded_filter
+from experiments.spectra.stick_traces import create_stick_traces
+
+# Default output folder of the normalized files
+NORMALIZE_DIR = os.path.join("uploads", "normalize")
+
+# Normalizer method -> suffix of the output file
+NORMALIZE_SUFFIXES = {
+    "to_one": "_TO_ONE_normalized.mzML",
+    "to_TIC": "_TO_TIC_normalized.mzML",
+}
+
+
+def normalized_path(input_path, method, output_dir=NORMALIZE_DIR):
+    base_name = os.path.basename(input_path).replace(".mzML", NORMALIZE_SUFFIXES[method])
+    return os.path.join(output_dir, base_name)
+
+
+def normalizer_filters(method):
+    """
+    Normalizer ('to_one' or 'to_TIC') for the spectra (built again in every worker process)
+    """
+    # Create a Normalizer object
+    normalizer = oms.Normalizer()
+
+    # Get and set parameters for normalization
+    param = normalizer.getParameters()
+    param.setValue("method", method)
+    normalizer.setParameters(param)
+
+    def normalize_spectrum(spectrum):
+        normalizer.filterSpectrum(spectrum)
+        return spectrum
+
+    return normalize_spectrum, None
+
+
+def normalize_file(input_path, output_path, method):
+    """
+    Normalize every spectrum of an mzML file ('to_one' or 'to_TIC') in a single streaming pass
+    (large files are split by spectra across the worker processes).
+
+    Returns (output_path, preview): preview holds the peaks of the first spectrum before
+    ('original') and after ('normalized') the normalization, or is None if the file has no spectra.
+    """
+    # Snapshot of the first spectrum for the plots, read before filtering (the rest of the file is not parsed)
+    preview = None
+    spectrum = first_spectrum(input_path)
+    if spectrum is not None:
+        normalize_spectrum, _ = normalizer_filters(method)
+        preview = {"original": spectrum.get_peaks()}
+        preview["normalized"] = normalize_spectrum(spectrum).get_peaks()
+
+    os.makedirs(os.path.dirname(output_path) or ".", exist_ok=True)
+    sharded_filter(input_path, output_path, normalizer_filters, method)
+    return output_path, preview
+
+
+def normalize_files(file_paths, method, output_dir=NORMALIZE_DIR):
+    """
+    Normalize a batch of mzML files into output_dir, one file per worker process
+    (one read and one write per file). Returns a list of (output_path, preview), see normalize_file.
+    """
+    tasks = [(file_path, normalized_path(file_path, method, output_dir), method) for file_path in file_paths]
+    # Streaming keeps a single spectrum in memory, whatever the file size
+    return run_parallel(normalize_file, tasks, task_memory=file_task_memory())
+
+
+def normalization_plots(preview, method_label):
+    """
+    Plots of the preview spectrum before and after the normalization (None, None without preview)
+    """
+    if preview is None:
+        return None, None
+
+    # Create a plot of the first spectrum before and after normalization
+    fig = go.Figure()
+    original_stick, original_hover = create_stick_traces(
+        preview["original"][0], preview["original"][1], 'Original Spectrum', 'blue')
+    fig.add_trace(original_stick)
+    fig.add_trace(original_hover)
+
+
+    # Add the normalized spectrum to the plot
+    fig2 =  go.Figure()
+    normalized_stick, normalized_hover = create_stick_traces(
+        preview["normalized"][0], preview["normalized"][1], 'Normalized Spectrum', 'red', y_format='.4g')
+    fig2.add_trace(normalized_stick)
+    fig2.add_trace(normalized_hover)
+    for figure, title in ((fig, f'Spectrum Before Normalization to {method_label}'),
+                          (fig2, f'Spectrum After Normalization to {method_label}')):
+        figure.update_layout(
+            title={
+                'text': title,
+                'x': 0.5,
+                'xanchor': 'center',
+                'font': {'size': 16}
+            },
+            margin=dict(t=50),
+            xaxis_title='m/z',
+            yaxis_title='Intensity',
+            width=600,
+            height=450,
+            legend=dict(x=0.01, y=0.99, bgcolor='white', bordercolor='rgba(0,0,0,0)'),
+            template='plotly_white',
+            showlegend=True
+        )
+    return fig, fig2
@@ -0,0 +1,131 @@
+import multiprocessing
+import os
+import threading
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+
+# Worker processes of the shared pool (default: one per CPU), configurable through the environment
+MAX_WORKERS = int(os.environ.get("MS_WORKERS", 0)) or os.cpu_count() or 1
+# RAM (MB) kept free for the web server and the OS when the number of parallel tasks is chosen
+RESERVED_RAM_MB = int(os.environ.get("MS_RESERVED_RAM_MB", 1024))
+# Estimated RAM of a task per MB of its input file (a loaded mzML takes several times its size)
+TASK_RAM_FACTOR = float(os.environ.get("MS_TASK_RAM_FACTOR", 4))
+MIN_TASK_RAM_MB = 256
+# "spawn" starts clean workers (fork is unsafe in the threaded Flask server)
+START_METHOD = os.environ.get("MS_POOL_START_METHOD", "spawn")
+
+_executor = None
+_executor_lock = threading.Lock()
+_in_worker = False
+
+
+def _init_worker():
+    global _in_worker
+    _in_worker = True
+    # Workers do not keep parsed experiments: every task reads its own file once
+    from experiments.loaders import experiment_cache
+    experiment_cache.MAX_CACHE_MB = 0
+
+
+def in_worker():
+    """
+    True inside a worker process of the pool (work started there is not parallelized again)
+    """
+    return _in_worker
+
+
+def get_executor():
+    """
+    Shared ProcessPoolExecutor, created on first use
+    """
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ProcessPoolExecutor(max_workers=MAX_WORKERS,
+                                            mp_context=multiprocessing.get_context(START_METHOD),
+                                            initializer=_init_worker)
+        return _executor
+
+
+def _reset_executor():
+    global _executor
+    with _executor_lock:
+        if _executor is not None:
+            _executor.shutdown(wait=False, cancel_futures=True)
+        _executor = None
+
+
+def available_memory():
+    """
+    Available RAM in bytes, or None if it cannot be read on this system
+    """
+    try:
+        with open("/proc/meminfo", "r", encoding="utf-8") as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    try:
+        return os.sysconf("SC_AVPHYS_PAGES") * os.sysconf("SC_PAGE_SIZE")
+    except (AttributeError, ValueError, OSError):
+        return None
+
+
+def file_task_memory(*file_paths):
+    """
+    Estimated RAM (bytes) of a task that loads the given files
+    """
+    size = sum(os.path.getsize(path) for path in file_paths if os.path.exists(path))
+    return max(int(size * TASK_RAM_FACTOR), MIN_TASK_RAM_MB * 1024 * 1024)
+
+
+def parallel_workers(n_tasks, task_memory=None):
+    """
+    Number of tasks to run at the same time: bounded by MAX_WORKERS, the number of tasks
+    and, if task_memory (bytes per task) is given, the RAM available right now
+    """
+    workers = min(MAX_WORKERS, n_tasks)
+    free = available_memory()
+    if task_memory and free is not None:
+        usable = free - RESERVED_RAM_MB * 1024 * 1024
+        workers = min(workers, max(1, usable // task_memory))
+    return max(1, int(workers))
+
+
+def run_parallel(function, tasks, task_memory=None):
+    """
+    Run function(*args) for every tuple of args in tasks on the shared process pool.
+
+    function must be defined at module level (it is sent to the workers by name) and its
+    arguments and result must be picklable (paths, numbers, lists...). task_memory is the
+    estimated RAM of one task (see file_task_memory). Returns the results in the order of
+    tasks. An exception in a task is raised here, as in a sequential loop.
+    A single task (or a single worker) runs in the calling process.
+    """
+    tasks = [tuple(args) for args in tasks]
+    workers = parallel_workers(len(tasks), task_memory)
+    if workers <= 1 or len(tasks) <= 1:
+        return [function(*args) for args in tasks]
+
+    executor = get_executor()
+    results = [None] * len(tasks)
+    pending = {}
+    next_task = 0
+    try:
+        while next_task < len(tasks) or pending:
+            # Keep at most 'workers' tasks in flight (RAM bound)
+            while next_task < len(tasks) and len(pending) < workers:
+                pending[executor.submit(function, *tasks[next_task])] = next_task
+                next_task += 1
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                results[pending.pop(future)] = future.result()
+    except BrokenProcessPool:
+        # A worker died (e.g. out of memory): start a new pool for the next request
+        _reset_executor()
+        raise
+    finally:
+        for future in pending:
+            future.cancel()
+    return results
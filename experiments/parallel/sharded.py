@@ -0,0 +1,299 @@
+import os
+import re
+import shutil
+import tempfile
+
+import numpy as np
+import pyopenms as oms
+
+from experiments.loaders.load_options import ALL_DATA, peak_file_options
+from experiments.loaders.mzml_peek import mzml_index
+from experiments.loaders.streaming import stream_filter
+from experiments.parallel.pool import file_task_memory, in_worker, parallel_workers, run_parallel
+from experiments.uploads.blob_store import replaced_output
+
+# Files smaller than this are filtered in a single stream (sharding would not pay off)
+MIN_SHARD_MB = int(os.environ.get("MS_SHARD_MIN_MB", 64))
+# mzML text parsed at a time by a worker (bounds its memory, whatever the shard size)
+SHARD_BLOCK_BYTES = 32 * 1024 * 1024
+# Bytes read at a time while looking for a tag
+FIND_CHUNK = 1024 * 1024
+
+_XML_DECLARATION = re.compile(r"<\?xml[^>]*\?>")
+_XML_ENCODING = re.compile(rb'<\?xml[^>]*encoding="([^"]+)"')
+_LIST_COUNT = re.compile(rb'\bcount="\d+"')
+_SPECTRUM_INDEX = re.compile(rb'(<spectrum\b[^>]*?\sindex=")\d+(")')
+_DATA_PROCESSING_REF = re.compile(rb'(<spectrum\b[^>]*?)\sdataProcessingRef="[^"]*"')
+_INDEX_LIST_OFFSET = re.compile(rb"<indexListOffset>\s*(\d+)\s*</indexListOffset>")
+_INDEX_OFFSET = re.compile(rb'<offset\s+idRef="([^"]*)"\s*>\s*(\d+)\s*</offset>')
+
+
+def _find(f, start, token):
+    """
+    Absolute position of the first token at or after start, or None
+    """
+    f.seek(start)
+    position = start
+    tail = b""
+    while True:
+        chunk = f.read(FIND_CHUNK)
+        if not chunk:
+            return None
+        data = tail + chunk
+        found = data.find(token)
+        if found != -1:
+            return position - len(tail) + found
+        tail = data[-(len(token) - 1):]
+        position += len(chunk)
+
+
+def _closing(prefix):
+    return b"</run>\n</mzML>\n" + (b"</indexedmzML>\n" if b"<indexedmzML" in prefix else b"")
+
+
+def _load_document(prefix, n_spectra, body, closing, options=ALL_DATA):
+    """
+    Parse a piece of an mzML file: the header of the file (prefix, up to the first spectrum),
+    some of its <spectrum> elements (or its chromatogram list) and the closing tags.
+    options (LoadOptions) filters the spectra as in get_experiment.
+    """
+    list_start = prefix.rfind(b"<spectrumList")
+    prefix = prefix[:list_start] + _LIST_COUNT.sub(b'count="%d"' % n_spectra, prefix[list_start:], count=1)
+    match = _XML_ENCODING.search(prefix[:200])
+    text = (prefix + body + closing).decode(match.group(1).decode() if match else "utf-8")
+    # The text is handed to OpenMS as UTF-8
+    text = _XML_DECLARATION.sub('<?xml version="1.0" encoding="UTF-8"?>', text, count=1)
+    exp = oms.MSExperiment()
+    mzml_file = oms.MzMLFile()
+    if options != ALL_DATA:
+        mzml_file.setOptions(peak_file_options(options))
+    mzml_file.loadBuffer(text, exp)
+    return exp
+
+
+def _spectrum_blocks(f, prefix, offsets, options=ALL_DATA):
+    """
+    Parse the spectra between offsets[0] and offsets[-1] of an open mzML file, yielding one
+    MSExperiment per block of about SHARD_BLOCK_BYTES
+    """
+    offsets = np.asarray(offsets)
+    n_spectra = len(offsets) - 1
+    closing = b"</spectrumList>\n" + _closing(prefix)
+    start = 0
+    while start < n_spectra:
+        end = int(np.searchsorted(offsets, offsets[start] + SHARD_BLOCK_BYTES, side="right")) - 1
+        end = min(max(end, start + 1), n_spectra)
+        f.seek(offsets[start])
+        yield _load_document(prefix, end - start, f.read(offsets[end] - offsets[start]), closing, options)
+        start = end
+
+
+def first_spectrum(file_path):
+    """
+    First spectrum (metadata and peaks) of an mzML file, parsed without reading the rest of the file.
+    Returns None if the file has no spectra.
+    """
+    with open(file_path, "rb") as f:
+        start = _find(f, 0, b"<spectrum ")
+        end = _find(f, start, b"</spectrum>") if start is not None else None
+        if end is None:
+            return None
+        f.seek(0)
+        prefix = f.read(start)
+        body = f.read(end + len(b"</spectrum>") - start)
+    exp = _load_document(prefix, 1, body, b"</spectrumList>\n" + _closing(prefix))
+    return exp[0] if exp.size() else None
+
+
+def _layout(file_path):
+    """
+    Byte layout of an indexed mzML: header up to the first spectrum, spectrum offsets (plus the end
+    of the spectrum list) and the chromatogram section. None if the file has no index or no spectra.
+    """
+    index = mzml_index(file_path)
+    if index is None or not index["spectrum"]:
+        return None
+    with open(file_path, "rb") as f:
+        list_end = _find(f, index["spectrum"][-1], b"</spectrumList>")
+        run_end = _find(f, list_end, b"</run>") if list_end is not None else None
+        if run_end is None:
+            return None
+        f.seek(0)
+        prefix = f.read(index["spectrum"][0])
+    return {
+        "prefix": prefix,
+        "offsets": np.array(index["spectrum"] + [list_end], dtype=np.int64),
+        "chromatograms": (list_end, run_end),
+        "n_chromatograms": len(index["chromatogram"]),
+    }
+
+
+def read_spectra(file_path, first, last, options=ALL_DATA):
+    """
+    Spectra first..last-1 (file order) of an indexed mzML as an MSExperiment, parsed from their
+    own bytes only (the rest of the file is not read). options (LoadOptions) filters them as in
+    get_experiment. Returns None if the file has no index.
+    """
+    layout = _layout(file_path)
+    if layout is None:
+        return None
+    exp = oms.MSExperiment()
+    with open(file_path, "rb") as f:
+        for block in _spectrum_blocks(f, layout["prefix"], layout["offsets"][first:last + 1], options):
+            for spectrum in block:
+                exp.addSpectrum(spectrum)
+    return exp
+
+
+def _filter_shard(input_path, shard_path, prefix, offsets, chromatograms, make_filters, filter_args):
+    """
+    Filter the spectra between offsets[0] and offsets[-1] of input_path (and its chromatograms
+    if chromatograms = (start, end, count) is given) into shard_path, one block at a time.
+    Runs in a worker process of the shared pool.
+    """
+    process_spectrum, process_chromatogram = make_filters(*filter_args)
+    n_spectra = len(offsets) - 1
+    writer = oms.PlainMSDataWritingConsumer(shard_path)
+    writer.setExpectedSize(n_spectra, chromatograms[2] if chromatograms else 0)
+
+    first_processing = None
+    with open(input_path, "rb") as f:
+        for block, exp in enumerate(_spectrum_blocks(f, prefix, offsets)):
+            if block == 0:
+                writer.setExperimentalSettings(exp)
+            for spectrum in exp:
+                if first_processing is None:
+                    first_processing = spectrum.getDataProcessing()
+                elif block > 0 and spectrum.getDataProcessing() == first_processing:
+                    # Every block is parsed into its own DataProcessing objects: without sharing those
+                    # of the first block the writer would add a dataProcessingRef to each spectrum
+                    spectrum.setDataProcessing(first_processing)
+                writer.consumeSpectrum(process_spectrum(spectrum))
+
+        if chromatograms:
+            f.seek(chromatograms[0])
+            exp = _load_document(prefix, 0, f.read(chromatograms[1] - chromatograms[0]), _closing(prefix))
+            for chromatogram in exp.getChromatograms():
+                if process_chromatogram is not None:
+                    chromatogram = process_chromatogram(chromatogram)
+                writer.consumeChromatogram(chromatogram)
+
+    # The writer closes the mzML (index and footer) when it is destroyed
+    del writer
+    return n_spectra
+
+
+def _shard_index(f):
+    """
+    Offset of the indexList of a shard and its entries: {'spectrum': [(idRef, offset)], 'chromatogram': [...]}
+    """
+    f.seek(max(0, os.fstat(f.fileno()).st_size - 4096))
+    index_offset = int(_INDEX_LIST_OFFSET.search(f.read()).group(1))
+    f.seek(index_offset)
+    index_list = f.read()
+    entries = {}
+    for name in (b"spectrum", b"chromatogram"):
+        section = index_list.split(b'<index name="' + name + b'">', 1)
+        section = section[1].split(b"</index>", 1)[0] if len(section) == 2 else b""
+        entries[name.decode()] = [(id_ref, int(offset)) for id_ref, offset in _INDEX_OFFSET.findall(section)]
+    return index_offset, entries
+
+
+def _merge_shards(shard_paths, output_path):
+    """
+    Concatenate the spectra of the shards (in order) into one indexed mzML, copying their bytes:
+    the spectra are renumbered and the offset index is written again
+    """
+    shards = []
+    for shard_path in shard_paths:
+        with open(shard_path, "rb") as f:
+            shards.append(_shard_index(f))
+    total = sum(len(entries["spectrum"]) for _, entries in shards)
+
+    spectrum_index = []
+    chromatogram_index = []
+    with open(output_path, "wb") as out:
+        for k, (shard_path, (index_offset, entries)) in enumerate(zip(shard_paths, shards)):
+            with open(shard_path, "rb") as f:
+                offsets = [offset for _, offset in entries["spectrum"]]
+                if k == 0:
+                    # Header of the first shard, with the spectrum count of the whole run
+                    head = f.read(offsets[0])
+                    list_start = head.rfind(b"<spectrumList")
+                    out.write(head[:list_start] + _LIST_COUNT.sub(b'count="%d"' % total, head[list_start:], count=1))
+                    indent = head[head.rfind(b"\n"):]
+                list_end = _find(f, offsets[-1], b"</spectrumList>")
+                bounds = offsets + [list_end]
+                for i, (id_ref, _) in enumerate(entries["spectrum"]):
+                    f.seek(bounds[i])
+                    spectrum = f.read(bounds[i + 1] - bounds[i])
+                    spectrum = _SPECTRUM_INDEX.sub(rb"\g<1>%d\g<2>" % len(spectrum_index), spectrum, count=1)
+                    if i == 0 and k > 0:
+                        # Every writer marks its first spectrum with the default data processing
+                        spectrum = _DATA_PROCESSING_REF.sub(rb"\g<1>", spectrum, count=1)
+                    if i == len(bounds) - 2 and k < len(shards) - 1:
+                        # Same indentation as between the spectra of a single file
+                        spectrum = spectrum.rstrip() + indent
+                    spectrum_index.append((id_ref, out.tell()))
+                    out.write(spectrum)
+                if k == len(shards) - 1:
+                    # End of the run (chromatograms) from the last shard
+                    shift = out.tell() - list_end
+                    f.seek(list_end)
+                    out.write(f.read(index_offset - list_end))
+                    chromatogram_index = [(id_ref, offset + shift) for id_ref, offset in entries["chromatogram"]]
+
+        index_offset = out.tell()
+        sections = [(b"spectrum", spectrum_index)]
+        if chromatogram_index:
+            sections.append((b"chromatogram", chromatogram_index))
+        out.write(b'\n<indexList count="%d">\n' % len(sections))
+        for name, entries in sections:
+            out.write(b'\t<index name="' + name + b'">\n')
+            out.write(b"".join(b'\t\t<offset idRef="%s">%d</offset>\n' % entry for entry in entries))
+            out.write(b"\t</index>\n")
+        out.write(b"</indexList>\n<indexListOffset>%d</indexListOffset>\n" % index_offset)
+        out.write(b"<fileChecksum>0</fileChecksum>\n</indexedmzML>")
+    return total
+
+
+def sharded_filter(input_path, output_path, make_filters, *filter_args):
+    """
+    Apply a per-spectrum filter to an mzML file with the spectra split across the worker processes.
+
+    make_filters(*filter_args) must be a module-level function returning (process_spectrum,
+    process_chromatogram), as for stream_filter; every worker builds its own filters with it.
+    The indexed file is cut into contiguous spectrum ranges of similar size, every worker filters
+    one range into a shard and the shards are joined in order into output_path.
+    Small or non-indexed files (and calls from a worker process) use a single stream_filter pass.
+    Returns the number of spectra written.
+    """
+    layout = None
+    if not in_worker() and os.path.getsize(input_path) >= MIN_SHARD_MB * 1024 * 1024:
+        layout = _layout(input_path)
+    workers = parallel_workers(len(layout["offsets"]) - 1, file_task_memory()) if layout else 1
+    if workers <= 1:
+        return stream_filter(input_path, output_path, *make_filters(*filter_args))
+
+    # Contiguous spectrum ranges with about the same number of bytes
+    offsets = layout["offsets"]
+    targets = offsets[0] + (offsets[-1] - offsets[0]) * np.arange(1, workers) / workers
+    bounds = np.unique(np.concatenate(([0], np.searchsorted(offsets[:-1], targets), [len(offsets) - 1])))
+
+    output_dir = os.path.dirname(output_path) or "."
+    os.makedirs(output_dir, exist_ok=True)
+    shard_dir = tempfile.mkdtemp(prefix=".shards_", dir=output_dir)
+    try:
+        tasks = []
+        for k, (start, end) in enumerate(zip(bounds[:-1], bounds[1:])):
+            last = k == len(bounds) - 2
+            chromatograms = layout["chromatograms"] + (layout["n_chromatograms"],) if last else None
+            tasks.append((input_path, os.path.join(shard_dir, f"shard_{k}.mzML"), layout["prefix"],
+                          offsets[start:end + 1].tolist(), chromatograms, make_filters, filter_args))
+        print(f"[SHARDED] {input_path}: {len(offsets) - 1} spectra in {len(tasks)} shards")
+        run_parallel(_filter_shard, tasks, task_memory=file_task_memory())
+        # Joined next to output_path and renamed over it (output_path may be a link to an uploaded blob)
+        with replaced_output(output_path) as temp_path:
+            return _merge_shards([task[1] for task in tasks], temp_path)
+    finally:
+        shutil.rmtree(shard_dir, ignore_errors=True)
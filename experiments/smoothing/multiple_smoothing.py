@@ -1,9 +1,13 @@
+from experiments.parallel.pool import file_task_memory, run_parallel
+from experiments.parallel.sharded import sharded_filter
 
 import pyopenms as oms
 import os
 
-def multiple_smoothing(file_paths, window_length, polyorder):
-
+def savgol_filters(window_length, polyorder):
+    """
+    Savitzky-Golay filter for spectra and chromatograms (built again in every worker process)
+    """
 
 # Set up Savitzky-Golay filter parameters
     sg_filter = oms.SavitzkyGolayFilter()
@@ -11,23 +15,24 @@ def multiple_smoothing(file_paths, window_length, polyorder):
     params.setValue("frame_length", window_length)          # Window length (odd: 5, 7, 11, etc.)
     params.setValue("polynomial_order", polyorder)       # Polynomial order (1, 2, 3, etc.)
     sg_filter.setParameters(params)
-    output_files = []
 
-    # Process every mzML file in the input directory
-    for file in file_paths:
-        if file.endswith(".mzML"):
-            input_file = file
-            output_file = f"{os.path.splitext(file)[0]}_savgol.mzML"
+    def smooth_spectrum(spectrum):
+        sg_filter.filter(spectrum)
+        return spectrum
 
-            # Load mzML files
-            exp = oms.MSExperiment()
-            oms.MzMLFile().load(input_file, exp)
+    return smooth_spectrum, smooth_spectrum
 
-            # Apply Savitzky-Golay filter to each spectrum
-            sg_filter.filterExperiment(exp)
+def smooth_file(input_file, output_file, window_length, polyorder):
 
-            # Save processed files
-            oms.MzMLFile().store(output_file, exp)
+    # Apply Savitzky-Golay filter to each spectrum while streaming the file to its output
+    # (a single file is split by spectra across the worker processes)
+    sharded_filter(input_file, output_file, savgol_filters, window_length, polyorder)
+    return output_file
 
-            output_files.append(output_file)
+def multiple_smoothing(file_paths, window_length, polyorder):
+    # Process every mzML file in the input directory, one file per worker process
+    input_files = [file for file in file_paths if file.endswith(".mzML")]
+    tasks = [(file, f"{os.path.splitext(file)[0]}_savgol.mzML", window_length, polyorder) for file in input_files]
+    # Streaming keeps a single spectrum in memory, whatever the file size
+    output_files = run_parallel(smooth_file, tasks, task_memory=file_task_memory())
     return output_files
@@ -1,37 +1,73 @@
 import pyopenms as oms
 import numpy as np
 import plotly.graph_objects as go
+from experiments.loaders.peak_sidecar import get_sidecar, gather_peaks
+from experiments.loaders.load_options import MS1_ONLY, select_spectra
+from experiments.loaders.peak_stats import BLOCK_PEAKS, scan_peaks
 
-def merge_spectra(exp):
-    # Cargar el archivo mzML
-    spectra = exp.getSpectra()
+# Espectros que se fusionan (puedes cambiar el nivel si es necesario)
+LOAD_OPTIONS = MS1_ONLY
 
-    # Filtrar solo los espectros MS1 (puedes cambiar el nivel si es necesario)
-    spectra_ms1 = [s for s in spectra if s.getMSLevel() == 1]
+# Ancho de bin por defecto y unidades aceptadas ('Da' fijo o 'ppm' proporcional al m/z)
+DEFAULT_BIN_WIDTH = 0.01
+DEFAULT_BIN_UNIT = "Da"
+BIN_UNITS = ("Da", "ppm")
+# Límite de bins del espectro fusionado (memoria acotada aunque el ancho sea muy pequeño)
+MAX_BINS = 20_000_000
 
 
-    # Inicializar arrays para almacenar m/z e intensidades
-    mz_all = np.array([])
-    intensity_all = np.array([])
+def _bin_index(mz, mz_min, bin_width, bin_unit):
+    if bin_unit == "ppm":
+        # Bins de ancho relativo constante: el índice es logarítmico en m/z
+        return np.floor(np.log(mz / mz_min) / np.log1p(bin_width * 1e-6)).astype(np.int64)
+    return np.floor((mz - mz_min) / bin_width).astype(np.int64)
 
-    # Concatenar los picos de todos los espectros MS1
-    for spectrum in spectra_ms1:
-        mz_values, intensity_values = spectrum.get_peaks()
-        mz_all = np.concatenate((mz_all, mz_values))
-        intensity_all = np.concatenate((intensity_all, intensity_values))
 
-    # Ordenar los valores de m/z
-    sorted_indices = np.argsort(mz_all)
-    mz_all_sorted = mz_all[sorted_indices]
-    intensity_all_sorted = intensity_all[sorted_indices]
+def merged_spectrum(file_path, bin_width=DEFAULT_BIN_WIDTH, bin_unit=DEFAULT_BIN_UNIT, options=LOAD_OPTIONS):
+    """
+    Suma de los picos de los espectros seleccionados en bins de m/z de ancho fijo (Da) o en ppm.
 
-    # Fusionar las intensidades si los valores de m/z se repiten
-    # En este caso, vamos a sumar las intensidades de los picos con el mismo m/z
-    unique_mz, unique_indices = np.unique(mz_all_sorted, return_inverse=True)
-    intensity_fused = np.zeros(len(unique_mz))
+    Los picos se leen del sidecar por bloques de espectros completos (como mucho BLOCK_PEAKS picos)
+    y se acumulan con np.bincount, así que la memoria no depende del tamaño del archivo.
+    Devuelve (mz, intensity) de los bins con señal; el m/z de cada bin es la media ponderada por intensidad.
+    """
+    if bin_unit not in BIN_UNITS:
+        raise ValueError(f"Unknown bin unit '{bin_unit}', use one of {', '.join(BIN_UNITS)}")
+    if not bin_width > 0:
+        raise ValueError("The bin width must be greater than 0")
 
-    for idx in range(len(mz_all_sorted)):
-        intensity_fused[unique_indices[idx]] += intensity_all_sorted[idx]
+    sidecar = get_sidecar(file_path)
+    mz_min, mz_max = options.mz_range or scan_peaks(sidecar)["mz_range"]
+    if mz_min is None:
+        return np.zeros(0), np.zeros(0)
+    if bin_unit == "ppm" and mz_min <= 0:
+        raise ValueError("ppm bins need positive m/z values")
+    n_bins = int(_bin_index(np.float64(mz_max), mz_min, bin_width, bin_unit)) + 1
+    if n_bins > MAX_BINS:
+        raise ValueError(f"A bin width of {bin_width} {bin_unit} gives {n_bins} bins (max {MAX_BINS}), use a larger one")
+
+    intensity_sum = np.zeros(n_bins)
+    weighted_mz = np.zeros(n_bins)
+    indices = select_spectra(sidecar, options)
+    counts = np.diff(sidecar["offsets"])[indices]
+    # Bloques de espectros completos con como mucho BLOCK_PEAKS picos (un espectro más grande va solo)
+    block_of_spectrum = np.cumsum(counts) // BLOCK_PEAKS
+    for block in np.split(indices, np.flatnonzero(np.diff(block_of_spectrum)) + 1):
+        mz, intensity = gather_peaks(sidecar, block, options.mz_range)
+        if len(mz) == 0:
+            continue
+        bins = np.clip(_bin_index(mz, mz_min, bin_width, bin_unit), 0, n_bins - 1)
+        intensity = intensity.astype(np.float64)
+        intensity_sum += np.bincount(bins, weights=intensity, minlength=n_bins)
+        weighted_mz += np.bincount(bins, weights=mz * intensity, minlength=n_bins)
+
+    filled = np.flatnonzero(intensity_sum > 0)
+    return weighted_mz[filled] / intensity_sum[filled], intensity_sum[filled]
+
+
+def merge_spectra(file_path, bin_width=DEFAULT_BIN_WIDTH, bin_unit=DEFAULT_BIN_UNIT):
+    # Fusionar los picos de todos los espectros MS1 del sidecar en bins de m/z
+    unique_mz, intensity_fused = merged_spectrum(file_path, bin_width, bin_unit)
 
     # Crear la gráfica con Plotly
     fig = go.Figure()
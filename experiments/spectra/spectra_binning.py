@@ -1,25 +1,92 @@
 import pyopenms
 import plotly.graph_objects as go
 import numpy as np
+from experiments.loaders.mzml_peek import peek_mzml
+from experiments.loaders.indexed_mzml import read_spectrum
 
-def binning_spectrum(exp, spectrum_value):
-    alert = None
-    
+# Promediado de SpectraMerger: "gaussian" (FWHM en segundos) o "tophat" (rango en scans o segundos)
+AVERAGE_METHODS = ("gaussian", "tophat")
+
+
+def _average_window(table, index, params, method):
+    """
+    Rango [first, last] de espectros (de todos los niveles, como en el experimento completo)
+    que cubre a todos los vecinos que SpectraMerger usa para promediar el espectro index.
+    La ventana es más ancha que el cutoff: los espectros que sobran no cambian el promedio.
+    """
+    same_level = np.flatnonzero(table["ms_level"] == table["ms_level"][index])
+    rt = table["rt"][same_level]
+    if method == "gaussian":
+        # Distancia en RT a la que el peso gaussiano cae por debajo del cutoff
+        sigma = float(params.getValue("average_gaussian:rt_FWHM")) / (2 * np.sqrt(2 * np.log(2)))
+        max_rt = sigma * np.sqrt(-2 * np.log(float(params.getValue("average_gaussian:cutoff"))))
+        neighbours = same_level[np.abs(rt - table["rt"][index]) <= 2 * max_rt]
+    elif params.getValue("average_tophat:rt_unit") == "scans":
+        position = int(np.searchsorted(same_level, index))
+        half = int(np.ceil(float(params.getValue("average_tophat:rt_range")) / 2)) + 1
+        neighbours = same_level[max(0, position - half):position + half + 1]
+    else:
+        neighbours = same_level[np.abs(rt - table["rt"][index]) <= float(params.getValue("average_tophat:rt_range"))]
+    # Un espectro más a cada lado (SpectraMerger incluye el primero fuera de la ventana)
+    return max(0, int(neighbours.min()) - 1), min(len(table["rt"]) - 1, int(neighbours.max()) + 1)
+
+
+def _spectrum(file_path, index, spectrum_type):
+    data = read_spectrum(file_path, index)
+    spectrum = pyopenms.MSSpectrum()
+    spectrum.set_peaks((np.array(data["mz"], dtype=np.float64), np.array(data["intensity"], dtype=np.float64)))
+    spectrum.setRT(data["rt"])
+    spectrum.setMSLevel(data["ms_level"])
+    spectrum.setType(pyopenms.SpectrumSettings.SpectrumType(int(spectrum_type)))
+    return spectrum
+
+
+def average_spectrum(file_path, index, method="gaussian"):
+    """
+    Espectro index promediado con sus vecinos en RT (SpectraMerger.average, "gaussian" o "tophat"),
+    decodificando solo los espectros de su ventana: el coste es O(ventana), no O(run),
+    y no se modifica ningún experimento en caché. Devuelve el MSSpectrum promediado.
+    """
+    if method not in AVERAGE_METHODS:
+        raise ValueError(f"Unknown averaging method '{method}', use one of {', '.join(AVERAGE_METHODS)}")
+    table = peek_mzml(file_path)
+    spectrum_types = table["spectrum_type"]
     merger = pyopenms.SpectraMerger()
-    merger.average(exp, "gaussian")
-    spectra = exp.getSpectra()
-    # Extract spectra
-    spectra = exp.getSpectra()
+    params = merger.getParameters()
+    ms_level = int(params.getValue(f"average_{method}:ms_level"))
+    # Como en el experimento completo, los espectros de otros niveles se muestran sin promediar
+    if table["ms_level"][index] != ms_level:
+        return _spectrum(file_path, index, spectrum_types[index])
+
+    # El tipo (perfil/centroide) se fija para todo el archivo con el primer espectro del nivel,
+    # así el resultado no depende de qué espectro abre la ventana
+    first = int(np.flatnonzero(table["ms_level"] == ms_level)[0])
+    if params.getValue(f"average_{method}:spectrum_type") == "automatic":
+        spectrum_type = _spectrum(file_path, first, spectrum_types[first]).getType(True)
+        params.setValue(f"average_{method}:spectrum_type",
+                        "profile" if spectrum_type == pyopenms.SpectrumSettings.SpectrumType.PROFILE else "centroid")
+        merger.setParameters(params)
+
+    start, end = _average_window(table, index, params, method)
+    window = pyopenms.MSExperiment()
+    for j in range(start, end + 1):
+        window.addSpectrum(_spectrum(file_path, j, spectrum_types[j]))
+    merger.average(window, method)
+    return window.getSpectrum(index - start)
+
+
+def binning_spectrum(file_path, spectrum_value, method="gaussian"):
+    alert = None
 
     # Verify if exists at least one spectrum
-    if len(spectra) > 0:
+    n_spectra = peek_mzml(file_path)["n_spectra"]
+    if n_spectra > 0:
         spectrum_index = spectrum_value
-        try:
-            spectrum = spectra[spectrum_index]
-        except IndexError:
+        if not 0 <= spectrum_index < n_spectra:
             alert = f"Spectrum index {spectrum_index} is out of range."
             return alert, None, spectrum_index
 
+        spectrum = average_spectrum(file_path, spectrum_index, method)
         mz_values, intensity_values = spectrum.get_peaks()
         rt = spectrum.getRT()
         ms_level = spectrum.getMSLevel()
@@ -30,7 +97,7 @@ def binning_spectrum(exp, spectrum_value):
             x=mz_values,
             y=intensity_values,
             mode='lines',
-            name="Averaged Spectrum (Gaussian)",
+            name=f"Averaged Spectrum ({method.capitalize()})",
             line=dict(color='darkblue', width=2),
             fill='tozeroy',
             fillcolor='rgba(0,100,255,0.3)',
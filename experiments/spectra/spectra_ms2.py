@@ -3,52 +3,55 @@ import plotly.graph_objects as go
 import plotly.express as px
 from plotly.subplots import make_subplots
 import numpy as np
+from experiments.loaders.mzml_peek import peek_mzml
+from experiments.loaders.indexed_mzml import read_spectrum
+from experiments.loaders.ms2_index import ms2_index, select_ms2
+from experiments.spectra.stick_traces import create_stick_traces
 
-# Load the mzML file
-def load_mzml_file(exp):
-    
-    # Get the list of spectra
-    spectra = exp.getSpectra()
-    
-    # Separate spectra by MS level
-    spectra_ms1 = [s for s in spectra if s.getMSLevel() == 1]
-    spectra_ms2 = [s for s in spectra if s.getMSLevel() == 2]
-    
+# SpectrumType value of centroided spectra in the scan table
+CENTROID = 1
 
-    if len(spectra_ms1) > 0 and len(spectra_ms2) > 0:
-        ms1_index = min(300, len(spectra_ms1) - 1)  # MS1 spectrum
-        ms2_index = min(80, len(spectra_ms2) - 1)  # MS2 spectrum
+# Load the MS1/MS2 pair to plot (only the two spectra shown are decoded)
+def load_mzml_file(file_path, precursor_mz=None, rt=None):
+    
+    # MS2 browsing index (levels, RT, precursors and parent MS1), built once per file
+    index = ms2_index(file_path)
+    position = select_ms2(index, precursor_mz, rt)
+    if position is None or len(index["ms1"]) == 0:
+        return None
 
-        spectrum_ms1 = spectra_ms1[ms1_index]
-        #print(f"spectrum_ms1: {spectrum_ms1.getType()}")
-        spectrum_ms2 = spectra_ms2[ms2_index]
-        #print(f"spectrum_ms2: {spectrum_ms2.getType()}")
+    # The MS1 shown is the parent scan of the selected MS2 spectrum
+    parent = int(index["parent"][position])
+    spectrum_ms1 = read_spectrum(file_path, parent if parent >= 0 else int(index["ms1"][0]))
+    spectrum_ms2 = read_spectrum(file_path, int(index["ms2"][position]))
 
-        if spectrum_ms1.getType() == 1 and spectrum_ms2.getType() == 1:
-            type = "Centroid"
-            print("Both MS1 and MS2 spectra are centroided.")
-        else:
-            type = "Profile"
-            print("At least one of the spectra is profile (not centroided).")
-        
-         # Extract MS1 data
-        mz_ms1, intensity_ms1 = spectrum_ms1.get_peaks()
-        rt_ms1 = spectrum_ms1.getRT()
-    
-        # Extract MS2 data
-        mz_ms2, intensity_ms2 = spectrum_ms2.get_peaks()
-        rt_ms2 = spectrum_ms2.getRT()
-    
-        # Get precursor ion for MS2 (if available)
-        precursor_mz = "N/A"
-        if spectrum_ms2.getPrecursors():
-            precursor_mz = f"{spectrum_ms2.getPrecursors()[0].getMZ():.3f}"
+    spectrum_types = peek_mzml(file_path)["spectrum_type"]
+    if spectrum_types[spectrum_ms1["index"]] == CENTROID and spectrum_types[spectrum_ms2["index"]] == CENTROID:
+        type = "Centroid"
+        print("Both MS1 and MS2 spectra are centroided.")
+    else:
+        type = "Profile"
+        print("At least one of the spectra is profile (not centroided).")
+
+    # Get precursor ion for MS2 (if available)
+    precursor_mz = "N/A"
+    if spectrum_ms2["precursor_mz"] is not None:
+        precursor_mz = f"{spectrum_ms2['precursor_mz']:.3f}"
 
-    return spectra_ms1, spectra_ms2, spectrum_ms1, spectrum_ms2, mz_ms1, intensity_ms1, rt_ms1, mz_ms2, intensity_ms2, rt_ms2, precursor_mz, type
+    return {
+        "ms1": spectrum_ms1,
+        "ms2": spectrum_ms2,
+        "ms2_position": position,
+        "precursor_charge": int(index["precursor_charge"][position]),
+        "precursor_mz": precursor_mz,
+        "type": type,
+    }
 
 # Plot comparative spectra side by side
-def comparative_spectra_plots(exp):
-    spectra_ms1, spectra_ms2, spectrum_ms1, spectrum_ms2, mz_ms1, intensity_ms1, rt_ms1, mz_ms2, intensity_ms2, rt_ms2, precursor_mz, type = load_mzml_file(exp)
+def comparative_spectra_plots(pair):
+    mz_ms1, intensity_ms1, rt_ms1 = pair["ms1"]["mz"], pair["ms1"]["intensity"], pair["ms1"]["rt"]
+    mz_ms2, intensity_ms2, rt_ms2 = pair["ms2"]["mz"], pair["ms2"]["intensity"], pair["ms2"]["rt"]
+    precursor_mz = pair["precursor_mz"]
 
     fig_comparison = make_subplots(
         rows=1, cols=2,
@@ -99,8 +102,10 @@ def comparative_spectra_plots(exp):
     fig_comparison.update_yaxes(title_text="Intensity", row=1, col=2)
     return fig_comparison
 
-def overlay_spectra_plots(exp):
-    spectra_ms1, spectra_ms2, spectrum_ms1, spectrum_ms2, mz_ms1, intensity_ms1, rt_ms1, mz_ms2, intensity_ms2, rt_ms2, precursor_mz, type = load_mzml_file(exp)
+def overlay_spectra_plots(pair):
+    mz_ms1, intensity_ms1, rt_ms1 = pair["ms1"]["mz"], pair["ms1"]["intensity"], pair["ms1"]["rt"]
+    mz_ms2, intensity_ms2, rt_ms2 = pair["ms2"]["mz"], pair["ms2"]["intensity"], pair["ms2"]["rt"]
+    precursor_mz = pair["precursor_mz"]
 
     fig_overlay = go.Figure()
     
@@ -143,64 +148,13 @@ def overlay_spectra_plots(exp):
     
     return fig_overlay
 
-def create_stick_traces(mz_array, intensity_array, name, color, show_fill=False):
-    """
-    Create stick traces (vertical lines) for centroided data
-    """
-    x_stick = []
-    y_stick = []
-    
-    for mz, intensity in zip(mz_array, intensity_array):
-        x_stick.extend([mz, mz, None])  # x, x, None para línea vertical
-        y_stick.extend([0, intensity, None])  # 0, intensidad, None
-    
-    trace = go.Scatter(
-        x=x_stick,
-        y=y_stick,
-        mode='lines',
-        name=name,
-        line=dict(color=color, width=1.5),
-        hoverinfo='skip',  # Desactivar hover en las líneas
-        showlegend=True
-    )
-    
-    # Agregar puntos en las cimas para hover mejorado
-    hover_trace = go.Scatter(
-        x=mz_array,
-        y=intensity_array,
-        mode='markers',
-        marker=dict(color=color, size=4, opacity=0.8),
-        name=name + ' (peaks)',
-        showlegend=False,
-        hovertemplate=f'<b>{name}</b><br><b>m/z:</b> %{{x:.4f}}<br><b>Intensity:</b> %{{y:.0f}}<extra></extra>'
-    )
-    
-    return trace, hover_trace
+def comparative_spectra_plots2(pair):
+    mz_ms1, intensity_ms1, rt_ms1 = pair["ms1"]["mz"], pair["ms1"]["intensity"], pair["ms1"]["rt"]
+    mz_ms2, intensity_ms2, rt_ms2 = pair["ms2"]["mz"], pair["ms2"]["intensity"], pair["ms2"]["rt"]
+    precursor_mz = pair["precursor_mz"]
 
-def comparative_spectra_plots2(exp):
-    spectra_ms1, spectra_ms2, spectrum_ms1, spectrum_ms2, mz_ms1, intensity_ms1, rt_ms1, mz_ms2, intensity_ms2, rt_ms2, precursor_mz, type = load_mzml_file(exp)
-    
-    ms1_index = min(500, len(spectra_ms1) - 1)  # Espectro MS1
-    ms2_index = min(100, len(spectra_ms2) - 1)  # Espectro MS2
-    
-    spectrum_ms1 = spectra_ms1[ms1_index]
-    spectrum_ms2 = spectra_ms2[ms2_index]
-    
-    # Extraer datos MS1
-    mz_ms1, intensity_ms1 = spectrum_ms1.get_peaks()
-    rt_ms1 = spectrum_ms1.getRT()
-    
-    # Extraer datos MS2
-    mz_ms2, intensity_ms2 = spectrum_ms2.get_peaks()
-    rt_ms2 = spectrum_ms2.getRT()
-    
-    # Obtener ion precursor para MS2 (si está disponible)
-    precursor_mz = "N/A"
-    if spectrum_ms2.getPrecursors():
-        precursor_mz = f"{spectrum_ms2.getPrecursors()[0].getMZ():.3f}"
-    
-    print(f"\nMS1 - Índice: {ms1_index}, RT: {rt_ms1:.2f} s, Picos: {len(mz_ms1)}")
-    print(f"MS2 - Índice: {ms2_index}, RT: {rt_ms2:.2f} s, Picos: {len(mz_ms2)}, Precursor: {precursor_mz}")
+    print(f"\nMS1 - Índice: {pair['ms1']['index']}, RT: {rt_ms1:.2f} s, Picos: {len(mz_ms1)}")
+    print(f"MS2 - Índice: {pair['ms2']['index']}, RT: {rt_ms2:.2f} s, Picos: {len(mz_ms2)}, Precursor: {precursor_mz}")
     
     # ==================== GRÁFICO COMPARATIVO STICK (LADO A LADO) ====================
     fig_comparison = make_subplots(
@@ -234,8 +188,10 @@ def comparative_spectra_plots2(exp):
 
     return fig_comparison
 
-def overlay_spectra_plots2(exp):
-    spectra_ms1, spectra_ms2, spectrum_ms1, spectrum_ms2, mz_ms1, intensity_ms1, rt_ms1, mz_ms2, intensity_ms2, rt_ms2, precursor_mz, type = load_mzml_file(exp)
+def overlay_spectra_plots2(pair):
+    mz_ms1, intensity_ms1, rt_ms1 = pair["ms1"]["mz"], pair["ms1"]["intensity"], pair["ms1"]["rt"]
+    mz_ms2, intensity_ms2, rt_ms2 = pair["ms2"]["mz"], pair["ms2"]["intensity"], pair["ms2"]["rt"]
+    precursor_mz = pair["precursor_mz"]
     
     fig_overlay = go.Figure()
     
@@ -266,11 +222,14 @@ def overlay_spectra_plots2(exp):
     )
     return fig_overlay
 
-def render_spectra_plots(exp):
-    type = load_mzml_file(exp)[-1]
-    if type == "Centroid":
-        fig_comparison, fig_overlay = comparative_spectra_plots2(exp), overlay_spectra_plots2(exp)
-        return fig_comparison, fig_overlay
-    elif type == "Profile":
-        fig_comparison, fig_overlay = comparative_spectra_plots(exp), overlay_spectra_plots(exp)
-        return fig_comparison, fig_overlay
\ No newline at end of file
+def render_spectra_plots(file_path, precursor_mz=None, rt=None):
+    """
+    MS1/MS2 comparison and overlay figures of the MS2 spectrum selected by precursor m/z
+    (and RT), next to its parent MS1 scan. Returns (None, None) if the file has no MS1/MS2 pair.
+    """
+    pair = load_mzml_file(file_path, precursor_mz, rt)
+    if pair is None:
+        return None, None
+    if pair["type"] == "Centroid":
+        return comparative_spectra_plots2(pair), overlay_spectra_plots2(pair)
+    return comparative_spectra_plots(pair), overlay_spectra_plots(pair)
@@ -0,0 +1,52 @@
+import numpy as np
+import plotly.graph_objects as go
+
+# From this number of peaks the traces are drawn with WebGL (Scattergl)
+WEBGL_MIN_PEAKS = 5000
+
+
+def stick_arrays(mz_array, intensity_array):
+    """
+    x/y arrays of a stick plot: (mz, 0) -> (mz, intensity) for every peak, separated by NaN.
+    Built in one vectorized operation (NaN gaps instead of a list with None per peak).
+    """
+    mz_array = np.asarray(mz_array, dtype=np.float64)
+    intensity_array = np.asarray(intensity_array, dtype=np.float64)
+    x_stick = np.repeat(mz_array, 3)
+    x_stick[2::3] = np.nan
+    y_stick = np.column_stack((np.zeros_like(intensity_array), intensity_array,
+                               np.full_like(intensity_array, np.nan))).ravel()
+    return x_stick, y_stick
+
+
+def create_stick_traces(mz_array, intensity_array, name, color, show_fill=False, y_format=".0f"):
+    """
+    Create stick traces (vertical lines) for centroided data, plus a marker trace on the
+    peak tops for the hover. Large spectra are drawn with Scattergl.
+    """
+    scatter = go.Scattergl if len(mz_array) >= WEBGL_MIN_PEAKS else go.Scatter
+    x_stick, y_stick = stick_arrays(mz_array, intensity_array)
+
+    trace = scatter(
+        x=x_stick,
+        y=y_stick,
+        mode='lines',
+        name=name,
+        line=dict(color=color, width=1.5),
+        connectgaps=False,
+        hoverinfo='skip',  # Desactivar hover en las líneas
+        showlegend=True
+    )
+
+    # Agregar puntos en las cimas para hover mejorado
+    hover_trace = scatter(
+        x=mz_array,
+        y=intensity_array,
+        mode='markers',
+        marker=dict(color=color, size=4, opacity=0.8),
+        name=name + ' (peaks)',
+        showlegend=False,
+        hovertemplate=f'<b>{name}</b><br><b>m/z:</b> %{{x:.4f}}<br><b>Intensity:</b> %{{y:{y_format}}}<extra></extra>'
+    )
+
+    return trace, hover_trace
@@ -1,30 +1,28 @@
-from pyopenms import MSExperiment, MzMLFile
+from experiments.loaders.mzml_peek import peek_mzml
+from experiments.loaders.peak_sidecar import get_sidecar
 
 def get_file_info(file_path):
-    # Load the .mzML file
-    exp = MSExperiment()
-    MzMLFile().load(file_path, exp)
+    # Read the spectrum headers only (no peak is decoded)
+    peek = peek_mzml(file_path)
     
     
     # Basic metaData
-    num_spectra = exp.getNrSpectra()
-    num_chroms = exp.getNrChromatograms()
-    rt_range = (exp.getMinRT()/60, exp.getMaxRT()/60) # Convert to minutes
-    mz_range = (exp.getMinMZ(), exp.getMaxMZ())
+    num_spectra = peek["n_spectra"]
+    num_chroms = peek["n_chromatograms"]
+    rt_range = peek["rt_range"] or (0.0, 0.0)
+    rt_range = (rt_range[0]/60, rt_range[1]/60) # Convert to minutes
+    mz_range = peek["mz_range"]
+    if mz_range is None:
+        # The file does not report the observed m/z: take it from the memory-mapped peaks
+        mz = get_sidecar(file_path)["mz"]
+        mz_range = (mz.min(), mz.max()) if len(mz) else (0.0, 0.0)
     
     # count MS levels (MS1, MS2)
-    ms1 = 0
-    ms2 = 0
-    for spec in exp:
-        if spec.getMSLevel() ==1:
-            ms1 += 1
-        elif spec.getMSLevel() == 2:
-            ms2 += 1
+    ms1 = peek["ms_levels"].get(1, 0)
+    ms2 = peek["ms_levels"].get(2, 0)
             
     # if theres an instrument, get its info 
-    instrument = "unavailable"
-    if exp.getInstrument() is not None:
-        instrument = exp.getInstrument().getName() # if theres a name, get it
+    instrument = peek["instrument"] or "unavailable"
         
     # print summary
     # print(f"File: {file_path}")
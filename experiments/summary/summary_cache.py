@@ -0,0 +1,183 @@
+import hashlib
+import json
+import os
+import threading
+
+import numpy as np
+import pandas as pd
+
+from experiments.loaders.peak_sidecar import get_sidecar
+from experiments.loaders.peak_stats import scan_peaks
+from experiments.summary.summary_extended import get_file_info_extended
+from experiments.tic.tic_2d_3d import spectrum_table, spikes_grid, surface_grid
+
+# Folder holding one binary summary per mzML file
+SUMMARY_DIR = os.environ.get("MS_SUMMARY_DIR", os.path.join("uploads", "summary"))
+SUMMARY_VERSION = 2
+# Points sampled for the 3D surface plot
+MAX_POINTS = 10000
+
+# (absolute path, size, mtime) -> summary dict, for the filter toggles of the same file
+_summaries = {}
+_summaries_lock = threading.Lock()
+
+
+def summary_path(file_path):
+    name = hashlib.sha1(os.path.abspath(file_path).encode("utf-8")).hexdigest()
+    return os.path.join(SUMMARY_DIR, f"{name}.summary.npz")
+
+
+def _encode(value):
+    """
+    JSON-safe form of the info dict: dicts (with int keys) and tuples are tagged so they come back as they were
+    """
+    if isinstance(value, dict):
+        return {"dict": [[_encode(k), _encode(v)] for k, v in value.items()]}
+    if isinstance(value, tuple):
+        return {"tuple": [_encode(v) for v in value]}
+    if isinstance(value, list):
+        return [_encode(v) for v in value]
+    if isinstance(value, (np.generic, np.ndarray)):
+        return _encode(value.tolist())
+    return value
+
+
+def _decode(value):
+    if isinstance(value, dict):
+        if "tuple" in value:
+            return tuple(_decode(v) for v in value["tuple"])
+        return {_decode(k): _decode(v) for k, v in value["dict"]}
+    if isinstance(value, list):
+        return [_decode(v) for v in value]
+    return value
+
+
+def _read_header(cache):
+    return json.loads(str(cache["header"]))
+
+
+def _write_summary(cache_file, key, summary):
+    """
+    Save a summary as .npz: the table columns and plot grids as arrays, and a JSON header with
+    the version, the source key, the info dict and the plot error (no pickled objects)
+    """
+    table = summary["table"]
+    header = {
+        "version": SUMMARY_VERSION,
+        "source": list(key),
+        "info": _encode(summary["info"]),
+        "plot_error": summary["plot_error"],
+        "columns": list(table.columns),
+        "grids": [name for name in ("spikes", "surface") if summary[name] is not None],
+    }
+    arrays = {"header": np.array(json.dumps(header))}
+    for i, column in enumerate(table.columns):
+        values = table[column].to_numpy()
+        arrays[f"table_{i}"] = values.astype(str) if values.dtype == object else values
+    for name in header["grids"]:
+        for i, values in enumerate(summary[name]):
+            arrays[f"{name}_{i}"] = np.asarray(values)
+    temp_file = f"{cache_file}.{os.getpid()}.tmp"
+    with open(temp_file, "wb") as f:
+        np.savez(f, **arrays)
+    os.replace(temp_file, cache_file)
+
+
+def _read_summary(cache_file, key):
+    """
+    Summary saved by _write_summary, or None if it belongs to another version of the file
+    """
+    with np.load(cache_file, allow_pickle=False) as cache:
+        header = _read_header(cache)
+        if header.get("version") != SUMMARY_VERSION or tuple(header.get("source", ())) != key:
+            return None
+        table = pd.DataFrame({column: cache[f"table_{i}"] for i, column in enumerate(header["columns"])})
+        summary = {"info": _decode(header["info"]), "table": table, "spikes": None, "surface": None,
+                   "plot_error": header["plot_error"]}
+        for name in header["grids"]:
+            summary[name] = tuple(cache[f"{name}_{i}"] for i in range(3))
+    return summary
+
+
+def build_summary(file_path):
+    """
+    Everything the Summary page shows, from a single pass over the peaks of the file:
+    'info' (get_file_info_extended dict), 'table' (RT/m/z/TIC of every MS1 spectrum)
+    and the binned LC-MS grids 'spikes' (3D surface) and 'surface' (2D heatmap).
+    """
+    sidecar = get_sidecar(file_path)
+    peaks = scan_peaks(sidecar)
+    info = get_file_info_extended(file_path, peaks=peaks)
+    table = spectrum_table(sidecar, peaks)
+    summary = {"info": info, "table": table, "spikes": None, "surface": None, "plot_error": None}
+    # Without valid TIC values there is nothing to plot (the endpoint reports it)
+    if not table.empty and not table['TIC'].isna().all():
+        try:
+            summary["spikes"] = spikes_grid(table, max_points=MAX_POINTS)
+            summary["surface"] = surface_grid(table)
+        except Exception as e:
+            # Kept with the summary, so the metadata is still cached and the error is shown every time
+            summary["plot_error"] = str(e)
+    return summary
+
+
+def get_summary(file_path, build=True):
+    """
+    Summary of an mzML file, built once and cached in memory and on disk (.npz next to the uploads).
+    Later calls for the same file (e.g. changing the colorscale) are a cache lookup.
+    With build=False only the caches are looked up (None if the file was never summarized).
+    """
+    stat = os.stat(file_path)
+    key = (os.path.abspath(file_path), stat.st_size, stat.st_mtime_ns)
+    with _summaries_lock:
+        summary = _summaries.get(key)
+    if summary is not None:
+        return summary
+
+    cache_file = summary_path(file_path)
+    summary = None
+    if os.path.exists(cache_file):
+        try:
+            summary = _read_summary(cache_file, key)
+        except Exception as e:
+            print(f"Error reading cached summary {cache_file}: {e}")
+
+    if summary is None:
+        if not build:
+            return None
+        summary = build_summary(file_path)
+        os.makedirs(SUMMARY_DIR, exist_ok=True)
+        _write_summary(cache_file, key, summary)
+
+    with _summaries_lock:
+        # Forget older versions of the same file
+        for old_key in [k for k in _summaries if k[0] == key[0]]:
+            del _summaries[old_key]
+        _summaries[key] = summary
+    return summary
+
+
+def prune_summaries():
+    """
+    Remove the cached summaries whose mzML file no longer exists
+    """
+    removed = 0
+    if os.path.isdir(SUMMARY_DIR):
+        for name in os.listdir(SUMMARY_DIR):
+            cache_file = os.path.join(SUMMARY_DIR, name)
+            if name.endswith(".tmp"):
+                # Skip summaries still being written
+                continue
+            try:
+                # Only the header is read (members of an .npz are loaded on access)
+                with np.load(cache_file, allow_pickle=False) as cache:
+                    source = _read_header(cache)["source"][0]
+            except Exception:
+                source = ""
+            if not os.path.exists(source):
+                os.remove(cache_file)
+                removed += 1
+    with _summaries_lock:
+        for key in [k for k in _summaries if not os.path.exists(k[0])]:
+            del _summaries[key]
+    return removed
@@ -1,12 +1,20 @@
-from pyopenms import MSExperiment, MzMLFile, FileHandler
+from pyopenms import IonSource
+import numpy as np
 import time
 import os
 from collections import defaultdict
+from experiments.loaders.peak_sidecar import get_sidecar
+from experiments.loaders.peak_stats import scan_peaks
 
+# SpectrumType values stored in the sidecar scan table
+CENTROID = 1
+PROFILE = 2
 
-def get_file_info_extended(file_path):
+
+def get_file_info_extended(file_path, peaks=None):
     """
     Replicates the functionality of the OpenMS FileInfo command line tool with extended details.
+    peaks: result of scan_peaks() if the caller already made the pass over the peaks.
     """
     start_time = time.time()
     
@@ -18,99 +26,58 @@ def get_file_info_extended(file_path):
     # Get file size
     file_size_mb = os.path.getsize(file_path) / (1024 * 1024)
     
-    # Load the file silently
-    exp = MSExperiment()
-    MzMLFile().load(file_path, exp)
-    
-    # Instrument information
-    try:
-        instrument = exp.getInstrument()
-        if instrument is not None:
-            
-            # Mass analyzer information
-            for analyzer in instrument.getMassAnalyzers():
-                analyzer_type = analyzer.getType()
-                resolution = analyzer.getResolution()
-        else:
-            print("Instrument: Unknown")
-    except:
-        print("Instrument: Unknown")
-    
+    # Open the memory-mapped peaks and scan table (the mzML is only parsed the first time)
+    sidecar = get_sidecar(file_path)
+    meta = sidecar["meta"]
+    levels = sidecar["ms_level"]
+    offsets = sidecar["offsets"]
+    peak_counts = np.diff(offsets)
+
     # Spectrum analysis
     ms_levels = defaultdict(int)
-    total_peaks = 0
-    all_rt = []
-    all_mz = []
-    all_intensity = []
-    
-    profile_by_level = defaultdict(int)
-    centroid_by_level = defaultdict(int)
-    ionization_method = None
-    polarity = None
-    
-    # Process each spectrum
-    for spec in exp:
-        polarity = spec.getInstrumentSettings().getPolarity()
-        ms_level = spec.getMSLevel()
-        ms_levels[ms_level] += 1
-        
-        # Get peak data
-        if spec.size() > 0:
-            try:
-                mz_array, intensity_array = spec.get_peaks()
-                total_peaks += len(mz_array)
-                
-                if len(mz_array) > 0:
-                    all_mz.extend(mz_array)
-                    all_intensity.extend(intensity_array)
-                
-                # Determine data type by MS level
-                spec_type = spec.getType()
-                if spec_type == 0:  # Profile
-                    profile_by_level[ms_level] += 1
-                elif spec_type == 1:  # Centroid
-                    centroid_by_level[ms_level] += 1
-                else:
-                    # Density-based estimation
-                    if len(mz_array) > 1:
-                        mz_range = mz_array[-1] - mz_array[0]
-                        if mz_range > 0:
-                            density = len(mz_array) / mz_range
-                            if density > 10:
-                                profile_by_level[ms_level] += 1
-                            else:
-                                centroid_by_level[ms_level] += 1
-            except:
-                pass
-        
-        # Retention time
-        rt = spec.getRT()
-        if 0 < rt < 1e6:  # Filter out extreme values
-            all_rt.append(rt)
-    
-    ms_levels_sorted = sorted(ms_levels.keys())
-    # Ranges
-    if all_rt:
-        rt_min, rt_max = min(all_rt), max(all_rt)
+    for level, count in zip(*np.unique(levels, return_counts=True)):
+        ms_levels[int(level)] = int(count)
+    total_peaks = int(meta["n_peaks"])
+
+    # Polarity of the last spectrum, as reported before
+    polarity = str(IonSource.Polarity(int(sidecar["polarity"][-1]))) if len(levels) else None
+
+    # Retention time
+    rt = sidecar["rt"]
+    all_rt = rt[(rt > 0) & (rt < 1e6)]  # Filter out extreme values
+
+    # Ranges (one pass over the peaks)
+    if len(all_rt):
+        rt_min, rt_max = float(all_rt.min()), float(all_rt.max())
     else:
         rt_min, rt_max = None, None
-    if all_mz:
-        mz_min, mz_max = min(all_mz), max(all_mz)
-    else:
-        mz_min, mz_max = None, None
-    if all_intensity:
-        int_min, int_max = min(all_intensity), max(all_intensity)
-    else:
-        int_min, int_max = None, None
+    if peaks is None:
+        peaks = scan_peaks(sidecar)
+    mz_min, mz_max = peaks["mz_range"]
+    int_min, int_max = peaks["intensity_range"]
+
+    ms_levels_sorted = sorted(ms_levels.keys())
 
     # Spectra per MS level
     spectra_per_level = {level: ms_levels[level] for level in ms_levels_sorted}
 
-    # Peak type per MS level
+    # Peak type of every spectrum (spectra without peaks are not counted)
+    spectrum_types = sidecar["spectrum_type"]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        mz_span = peaks["last_mz"] - peaks["first_mz"]
+        density = peak_counts / mz_span
+    # Density-based estimation when the type is unknown
+    estimated = (spectrum_types != PROFILE) & (spectrum_types != CENTROID) & (peak_counts > 1) & (mz_span > 0)
+    is_profile = ((spectrum_types == PROFILE) & (peak_counts > 0)) | (estimated & (density > 10))
+    is_centroid = ((spectrum_types == CENTROID) & (peak_counts > 0)) | (estimated & (density <= 10))
+
+    # Peak type and breakdown per MS level
     peak_types = {}
+    level_breakdown = {}
     for level in ms_levels_sorted:
-        profile_count = profile_by_level[level]
-        centroid_count = centroid_by_level[level]
+        in_level = levels == level
+        profile_count = int(np.count_nonzero(is_profile & in_level))
+        centroid_count = int(np.count_nonzero(is_centroid & in_level))
         if profile_count > centroid_count:
             peak_type = "Profile"
             if centroid_count > 0:
@@ -123,69 +90,44 @@ def get_file_info_extended(file_path):
             peak_type = "Mixed"
         peak_types[level] = peak_type
 
+        level_rt = rt[in_level]
+        level_breakdown[level] = {
+            "Peaks": int(peak_counts[in_level].sum()),
+            "TIC": float(peaks["tic"][in_level].sum()),
+            "RT range (sec)": (float(level_rt.min()), float(level_rt.max())),
+        }
+
     # Activation methods (MS2+)
-    activation_methods = set()
-    has_ms2_plus = any(spec.getMSLevel() > 1 for spec in exp)
-    if has_ms2_plus:
-        for spec in exp:
-            if spec.getMSLevel() > 1:
-                for precursor in spec.getPrecursors():
-                    for method in precursor.getActivationMethods():
-                        activation_methods.add(str(method))
-    activation_methods = sorted(activation_methods)
+    activation_methods = meta["activation_methods"]
 
     # Precursor charge distribution (MS2+)
     precursor_charges = {}
-    if has_ms2_plus:
-        charges = defaultdict(int)
-        for spec in exp:
-            if spec.getMSLevel() > 1:
-                for precursor in spec.getPrecursors():
-                    charge = precursor.getCharge()
-                    if charge > 0:
-                        charges[charge] += 1
-        precursor_charges = dict(charges)
+    charges = sidecar["precursor_charge"][levels > 1]
+    charges = charges[charges > 0]
+    if len(charges):
+        precursor_charges = {int(charge): int(count) for charge, count in zip(*np.unique(charges, return_counts=True))}
 
     # Chromatogram info
-    num_chroms = exp.getNrChromatograms()
+    chromatograms = meta["chromatograms"]
+    num_chroms = len(chromatograms)
     chrom_types = {}
     total_chrom_peaks = 0
     if num_chroms > 1 or (num_chroms == 1 and len(ms_levels) > 1):
-        if num_chroms > 0:
-            types = defaultdict(int)
-            for chrom in exp.getChromatograms():
-                total_chrom_peaks += chrom.size()
-                chrom_type = "unknown"
-                try:
-                    if chrom.getNativeID().lower().find('tic') != -1:
-                        chrom_type = "total ion current chromatogram"
-                    elif chrom.getNativeID().lower().find('bpc') != -1:
-                        chrom_type = "base peak chromatogram"
-                    else:
-                        chrom_type = "total ion current chromatogram"
-                except:
-                    chrom_type = "total ion current chromatogram"
-                types[chrom_type] += 1
-            chrom_types = dict(types)
+        types = defaultdict(int)
+        for chrom in chromatograms:
+            total_chrom_peaks += chrom["size"]
+            native_id = chrom["native_id"].lower()
+            if native_id.find('bpc') != -1:
+                chrom_type = "base peak chromatogram"
+            else:
+                chrom_type = "total ion current chromatogram"
+            types[chrom_type] += 1
+        chrom_types = dict(types)
 
     # Instrument info
-    instrument_name = None
-    analyzers = []
-    try:
-        instrument = exp.getInstrument()
-        if instrument is not None:
-            instrument_name = instrument.getName()
-            ion_source = instrument.getIonSources()
-            for source in ion_source:
-                ionization_method = source.getIonizationMethod()
-                print(f"Ionization Method: {ionization_method}")
-            for analyzer in instrument.getMassAnalyzers():
-                analyzers.append({
-                    "type": analyzer.getType(),
-                    "resolution": analyzer.getResolution()
-                })
-    except:
-        instrument_name = None
+    instrument_name = meta["instrument"]
+    analyzers = meta["analyzers"]
+    ionization_method = meta["ionization_methods"][-1] if meta["ionization_methods"] else None
 
     # Build summary dictionary
     summary = {
@@ -200,6 +142,7 @@ def get_file_info_extended(file_path):
         "Spectra levels": ms_levels_sorted,
         "Spectra per level": spectra_per_level,
         "Peak types": peak_types,
+        "Per level breakdown": level_breakdown,
         "Activation methods": activation_methods,
         "Precursor charges": precursor_charges,
         "Number of chromatograms": num_chroms,
@@ -13,44 +13,37 @@ from scipy.ndimage import gaussian_filter
 from scipy.interpolate import griddata
 
 from experiments.summary import summary
+from experiments.loaders.peak_sidecar import get_sidecar
+from experiments.loaders.load_options import MS1_ONLY, select_spectra
+from experiments.loaders.peak_stats import scan_peaks
 
+# The TIC only needs the MS1 spectra
+LOAD_OPTIONS = MS1_ONLY
+
+
+def spectrum_table(sidecar, peaks):
+    """
+    RT (min), mean m/z and TIC of every MS1 spectrum, from the per-spectrum sums of scan_peaks()
+    """
+    index = select_spectra(sidecar, LOAD_OPTIONS)
+    counts = peaks["peak_count"][index]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        mz = np.where(counts > 0, peaks["mz_sum"][index] / counts, np.nan)
 
-def load_and_process_data(file_path):
-    
-    # load the mzML file
-    exp = oms.MSExperiment()
-    oms.MzMLFile().load(file_path, exp)
-    
-    # get the espectra list
-    spectra = exp.getSpectra()
-    
-    #Initialize RT and TIC lists
-    rt_list = []
-    tic_list = []
-    mz_list = []
-    
-    # Iterate through each spectrum MS1 to calculate the TIC
-    for spectrum in spectra:
-        if spectrum.getMSLevel() == 1: # Only consider MS1 spectra
-            rt = spectrum.getRT()/60 # Get Retention Time
-            mz_values= spectrum.get_peaks()[0] # Get m/z values
-            mz = np.mean(mz_values) if len(mz_values) > 0 else np.nan
-            intensities = spectrum.get_peaks()[1] # Get peak intensities
-            tic = sum(intensities) # Sum all the intensities to get TIC
-        
-            rt_list.append(rt)
-            mz_list.append(mz)
-            tic_list.append(tic)
-    
     # Crear DataFrame sin guardar en sesión (eso lo hace el endpoint)
-    df_summary = pd.DataFrame({
-        'RT': rt_list, 
-        'mz': mz_list, 
-        'TIC': tic_list, 
-        'filter_type': ['Plasma'] * len(rt_list)
+    return pd.DataFrame({
+        'RT': sidecar["rt"][index] / 60,
+        'mz': mz,
+        'TIC': peaks["tic"][index],
+        'filter_type': ['Plasma'] * len(index)
     })
 
-    return df_summary
+
+def load_and_process_data(file_path):
+    
+    # open the memory-mapped peaks of the mzML file (converted once, no XML parsing)
+    sidecar = get_sidecar(file_path)
+    return spectrum_table(sidecar, scan_peaks(sidecar))
 
 
 # Function to create a 3D scatter plot using Plotly
@@ -58,9 +51,14 @@ def create_optimized_3d_spikes(df_summary, max_points=10000):
     """
     Crea una gráfica 3D tipo superficie (como 3d_personalizado.py) pero usando filter_type como colorscale.
     """
-    import numpy as np
-    import plotly.graph_objects as go
+    heatmap, xedges, yedges = spikes_grid(df_summary, max_points=max_points)
+    return spikes_figure(heatmap, xedges, yedges, df_summary['filter_type'].iloc[0])
+
 
+def spikes_grid(df_summary, max_points=10000):
+    """
+    Grid RT x m/z weighted by TIC of the 3D surface plot
+    """
     # Convertir listas a arrays de numpy
     rt_array = np.array(df_summary['RT'])
     mz_array = np.array(df_summary['mz'])
@@ -85,7 +83,13 @@ def create_optimized_3d_spikes(df_summary, max_points=10000):
         bins=[rt_bins, mz_bins],
         weights=tic_array
     )
+    return heatmap, xedges, yedges
+
 
+def spikes_figure(heatmap, xedges, yedges, colorscale):
+    """
+    3D surface plot of a grid built by spikes_grid()
+    """
     # Crear malla para la superficie
     X, Y = np.meshgrid(xedges[:-1], yedges[:-1])
 
@@ -94,7 +98,7 @@ def create_optimized_3d_spikes(df_summary, max_points=10000):
         x=X,
         y=Y,
         z=heatmap.T,
-        colorscale=df_summary['filter_type'].iloc[0],
+        colorscale=colorscale,
         colorbar=dict(
             title=dict(
                 text='Intensity',
@@ -237,7 +241,14 @@ def create_optimized_3d_spikes(df_summary, max_points=10000):
     
 def create_2d_surface_and_heatmap(df_summary): 
     
-    
+    H_log, rt_centers, mz_centers = surface_grid(df_summary)
+    return surface_figure(H_log, rt_centers, mz_centers, df_summary['filter_type'].iloc[0]), df_summary
+
+
+def surface_grid(df_summary):
+    """
+    Smoothed log(TIC) grid RT x m/z of the 2D heatmap
+    """
     rt_min, rt_max = df_summary['RT'].min(), df_summary['RT'].max()
     mz_min, mz_max = df_summary['mz'].min(), df_summary['mz'].max()
     
@@ -256,7 +267,13 @@ def create_2d_surface_and_heatmap(df_summary):
     
     rt_centers = (rt_edges[:-1] + rt_edges[1:]) / 2
     mz_centers = (mz_edges[:-1] + mz_edges[1:]) / 2
-    
+    return H_log, rt_centers, mz_centers
+
+
+def surface_figure(H_log, rt_centers, mz_centers, colorscale):
+    """
+    2D heatmap of a grid built by surface_grid()
+    """
     # Only create and return a 2D heatmap
     fig = go.Figure()
     fig.add_trace(
@@ -264,7 +281,7 @@ def create_2d_surface_and_heatmap(df_summary):
             z=H_log,
             x=mz_centers,
             y=rt_centers,
-            colorscale=df_summary['filter_type'].iloc[0],
+            colorscale=colorscale,
             colorbar=dict(title='Log(TIC)'),
             showscale=True
         )
@@ -279,7 +296,7 @@ def create_2d_surface_and_heatmap(df_summary):
         width=550,
         height=550
     )
-    return fig, df_summary
+    return fig
 
 def main(file_path=None, mode=None, max_points=None, df_summary=None, filter_type='Plasma'):
     if df_summary is not None:
@@ -0,0 +1,209 @@
+import hashlib
+import os
+import shutil
+import uuid
+from contextlib import contextmanager
+
+COPY_BUFFER_SIZE = 1024 * 1024
+
+
+class BlobDigestError(ValueError):
+    """Raised when the bytes of a file do not match the digest it is committed under"""
+
+
+class MissingUploadError(ValueError):
+    """Raised when a file sent by name is not in the store and no file with its digest is on the server"""
+
+
+def is_digest(value):
+    """
+    True for a SHA-256 hex digest (anything else must not reach blob_path)
+    """
+    return len(value) == 64 and all(c in "0123456789abcdef" for c in value)
+
+
+def blob_path(blobs_dir, digest):
+    """
+    Path of the blob with the given SHA-256 hex digest (sharded by the first two characters)
+    """
+    return os.path.join(blobs_dir, digest[:2], digest)
+
+
+def has_blob(blobs_dir, digest):
+    return os.path.isfile(blob_path(blobs_dir, digest))
+
+
+def _temp_path(blobs_dir):
+    temp_dir = os.path.join(blobs_dir, "tmp")
+    os.makedirs(temp_dir, exist_ok=True)
+    return os.path.join(temp_dir, uuid.uuid4().hex)
+
+
+def link_blob(blobs_dir, digest, dest_path):
+    """
+    Make dest_path point to a stored blob through a hardlink.
+
+    The link is created next to dest_path and then renamed over it, so an existing file
+    with the same name is replaced instead of being overwritten in place (which would
+    change the content of every other folder sharing that blob). If hardlinks are not
+    supported the blob is copied.
+    """
+    source = blob_path(blobs_dir, digest)
+    if os.path.isfile(dest_path) and os.path.samefile(source, dest_path):
+        # Already linked (renaming a link over the same inode would be a no-op that leaves the temp link behind)
+        return dest_path
+    dest_dir = os.path.dirname(dest_path) or "."
+    os.makedirs(dest_dir, exist_ok=True)
+    temp_link = os.path.join(dest_dir, f".{uuid.uuid4().hex}.link")
+    try:
+        os.link(source, temp_link)
+    except OSError:
+        shutil.copyfile(source, temp_link)
+    os.replace(temp_link, dest_path)
+    return dest_path
+
+
+@contextmanager
+def replaced_output(path):
+    """
+    Path to write a step output to: a temporary file next to path, renamed over it when the
+    block finishes (and removed if it fails).
+
+    Uploads in the step folders are hardlinks to the blob store, and OpenMS writers open an
+    existing file in place: writing an output over an upload with the same name would change
+    the blob and every other link to it. The rename only replaces the link.
+    """
+    folder, name = os.path.split(path)
+    os.makedirs(folder or ".", exist_ok=True)
+    temp_path = os.path.join(folder, f".{uuid.uuid4().hex}.{name}")
+    try:
+        yield temp_path
+        os.replace(temp_path, path)
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+
+
+def file_digest(file_path):
+    """
+    SHA-256 hex digest of a file on disk
+    """
+    sha256 = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        while True:
+            buffer = f.read(COPY_BUFFER_SIZE)
+            if not buffer:
+                break
+            sha256.update(buffer)
+    return sha256.hexdigest()
+
+
+def commit_blob(blobs_dir, file_path, digest, dest_path, verify=True):
+    """
+    Move an already hashed file into the store (or drop it if the blob exists) and link it at dest_path.
+
+    With verify (default) the file is hashed again from disk first: a blob is shared by every later
+    upload with the same digest, so a file whose bytes do not match it is removed and
+    BlobDigestError is raised instead of being stored.
+    """
+    if verify:
+        actual = file_digest(file_path)
+        if actual != digest:
+            os.remove(file_path)
+            raise BlobDigestError(f"{file_path} does not match its SHA-256: expected {digest}, got {actual}")
+    target = blob_path(blobs_dir, digest)
+    if os.path.isfile(target):
+        os.remove(file_path)
+    else:
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        os.replace(file_path, target)
+    return link_blob(blobs_dir, digest, dest_path)
+
+
+def save_upload(file, dest_path, blobs_dir):
+    """
+    Save an uploaded file (werkzeug FileStorage) through the blob store.
+
+    The SHA-256 is computed while the upload is written to disk, so identical files
+    uploaded to different step folders share the same physical copy.
+    Returns the hex digest.
+    """
+    temp_path = _temp_path(blobs_dir)
+    sha256 = hashlib.sha256()
+    with open(temp_path, "wb") as out:
+        while True:
+            buffer = file.stream.read(COPY_BUFFER_SIZE)
+            if not buffer:
+                break
+            out.write(buffer)
+            sha256.update(buffer)
+    digest = sha256.hexdigest()
+    # Hashed from the very buffers written to temp_path: no need to read it back
+    commit_blob(blobs_dir, temp_path, digest, dest_path, verify=False)
+    return digest
+
+
+def resolve_upload(blobs_dir, path, digest):
+    """
+    Make path hold the upload with the given SHA-256 (sent by the client for a file it uploaded
+    before, by chunks or recognized by its hash). The blob is linked at path; a file at path that
+    is not in the store is only accepted if its bytes match the digest. Otherwise (no digest,
+    unknown content) MissingUploadError is raised, so an older file with the same name is
+    never used instead.
+    """
+    name = os.path.basename(path)
+    digest = digest.lower()
+    if not is_digest(digest):
+        raise MissingUploadError(f"{name} was sent without a valid SHA-256: upload it again")
+    if has_blob(blobs_dir, digest):
+        return link_blob(blobs_dir, digest, path)
+    if os.path.isfile(path) and file_digest(path) == digest:
+        return path
+    raise MissingUploadError(f"{name} is not on the server (or has changed): upload it again")
+
+
+def prune_blobs(blobs_dir):
+    """
+    Remove blobs no longer referenced by any step folder (only the store's own link is left)
+    """
+    removed = 0
+    if not os.path.isdir(blobs_dir):
+        return removed
+    for shard in os.listdir(blobs_dir):
+        shard_dir = os.path.join(blobs_dir, shard)
+        if shard == "tmp" or not os.path.isdir(shard_dir):
+            continue
+        for name in os.listdir(shard_dir):
+            path = os.path.join(shard_dir, name)
+            try:
+                if os.stat(path).st_nlink <= 1:
+                    os.remove(path)
+                    removed += 1
+            except OSError as e:
+                print(f"Error pruning blob {path}: {e}")
+    return removed
+
+
+def storage_usage(folders):
+    """
+    Logical vs physical bytes of the files in the given folders.
+
+    Logical bytes count every file; physical bytes count each hardlinked blob once.
+    """
+    logical = 0
+    physical = 0
+    seen = set()
+    for folder in folders:
+        if not os.path.isdir(folder):
+            continue
+        for name in os.listdir(folder):
+            path = os.path.join(folder, name)
+            if not os.path.isfile(path):
+                continue
+            stat = os.stat(path)
+            logical += stat.st_size
+            key = (stat.st_dev, stat.st_ino)
+            if key not in seen:
+                seen.add(key)
+                physical += stat.st_size
+    return {"logical_bytes": logical, "physical_bytes": physical}
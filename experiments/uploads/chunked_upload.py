@@ -0,0 +1,380 @@
+import hashlib
+import json
+import os
+import shutil
+import threading
+import time
+import zlib
+
+from experiments.uploads.blob_store import commit_blob, has_blob, link_blob
+
+DEFAULT_CHUNK_SIZE = 2 * 1024 * 1024  # must match the chunk size used by single_input_chunk.js
+COPY_BUFFER_SIZE = 1024 * 1024
+# Seconds a completed upload is remembered, so a retry of its last chunk gets 'complete' again
+COMPLETED_TTL = int(os.environ.get("MS_UPLOAD_COMPLETED_TTL", 3600))
+
+
+class ChunkChecksumError(ValueError):
+    """Raised when a received chunk does not match the checksum sent by the client"""
+
+
+class ChunkSizeError(ChunkChecksumError):
+    """Raised when a received chunk does not have the length its index implies"""
+
+
+# In-memory state of the uploads in progress, one entry per upload_id
+_uploads = {}
+_uploads_lock = threading.Lock()
+
+
+def _manifest_path(upload_folder):
+    return os.path.join(upload_folder, "manifest.json")
+
+
+def _bitmap_path(upload_folder):
+    return os.path.join(upload_folder, "received.bitmap")
+
+
+def _completed_path(upload_folder):
+    return os.path.join(upload_folder, "complete.json")
+
+
+def _record_completion(upload_folder, result):
+    """
+    Replace the manifest, bitmap and partial file of a finished upload with its result
+    """
+    for name in os.listdir(upload_folder):
+        os.remove(os.path.join(upload_folder, name))
+    with open(_completed_path(upload_folder), "w", encoding="utf-8") as f:
+        json.dump(result, f)
+
+
+def _read_completion(upload_folder, final_path, total_chunks, blobs_dir):
+    """
+    Result of an upload completed less than COMPLETED_TTL ago into final_path, or None.
+    A record that is too old, was for another layout or whose file is gone is removed.
+    """
+    completed_file = _completed_path(upload_folder)
+    if not os.path.exists(completed_file):
+        return None
+    try:
+        with open(completed_file, "r", encoding="utf-8") as f:
+            result = json.load(f)
+        fresh = time.time() - os.path.getmtime(completed_file) < COMPLETED_TTL
+    except (OSError, ValueError):
+        result, fresh = None, False
+    if fresh and result["file_path"] == final_path and result["total"] == total_chunks:
+        if blobs_dir is not None and has_blob(blobs_dir, result["sha256"]):
+            # Linked again in case the file was replaced since
+            link_blob(blobs_dir, result["sha256"], final_path)
+            return result
+        if blobs_dir is None and os.path.exists(final_path):
+            return result
+    shutil.rmtree(upload_folder, ignore_errors=True)
+    return None
+
+
+def _read_manifest(upload_folder):
+    manifest_file = _manifest_path(upload_folder)
+    bitmap_file = _bitmap_path(upload_folder)
+    if not (os.path.exists(manifest_file) and os.path.exists(bitmap_file)):
+        return None, None
+    with open(manifest_file, "r", encoding="utf-8") as f:
+        manifest = json.load(f)
+    with open(bitmap_file, "rb") as f:
+        bitmap = f.read()
+    return manifest, bitmap
+
+
+def _preallocate(path, total_size):
+    """
+    Reserve the final size of the assembled file so every chunk can be written at its offset
+    """
+    with open(path, "wb") as f:
+        if total_size > 0:
+            try:
+                os.posix_fallocate(f.fileno(), 0, total_size)
+            except (AttributeError, OSError):
+                # Not available on this platform/filesystem: a sparse file is enough
+                f.truncate(total_size)
+
+
+def _open_upload(chunks_dir, target_dir, upload_id, filename, total_chunks, chunk_size, total_size, blobs_dir=None):
+    """
+    Get the state of an upload, creating (or resuming from disk) its manifest, bitmap and target file.
+    For an upload already completed the state only holds its 'result'.
+    """
+    state = _uploads.get(upload_id)
+    if state is not None:
+        return state
+
+    upload_folder = os.path.join(chunks_dir, upload_id)
+    result = _read_completion(upload_folder, os.path.join(target_dir, filename), total_chunks, blobs_dir)
+    if result is not None:
+        # A chunk sent again after the upload finished (e.g. the response to the last one was lost)
+        return {"result": result}
+    os.makedirs(upload_folder, exist_ok=True)
+    manifest_file = _manifest_path(upload_folder)
+    bitmap_file = _bitmap_path(upload_folder)
+    manifest, bitmap = _read_manifest(upload_folder)
+    if manifest is not None and (manifest["total_chunks"] != total_chunks
+                                 or manifest["chunk_size"] != chunk_size
+                                 or manifest["total_size"] != total_size
+                                 or not os.path.exists(manifest["part_path"])):
+        # The client changed the chunk layout (or the partial file is gone): start over
+        manifest = None
+    if manifest is not None:
+        # Resume an upload started before (e.g. after a dropped connection or a server restart)
+        bitmap = bytearray(bitmap)
+    else:
+        os.makedirs(target_dir, exist_ok=True)
+        final_path = os.path.join(target_dir, filename)
+        manifest = {
+            "filename": filename,
+            "final_path": final_path,
+            "part_path": final_path + ".part",
+            "total_chunks": total_chunks,
+            "chunk_size": chunk_size,
+            "total_size": total_size,
+        }
+        _preallocate(manifest["part_path"], total_size)
+        bitmap = bytearray(total_chunks)
+        with open(bitmap_file, "wb") as f:
+            f.write(bitmap)
+        with open(manifest_file, "w", encoding="utf-8") as f:
+            json.dump(manifest, f)
+
+    state = {
+        "folder": upload_folder,
+        "manifest": manifest,
+        "bitmap": bitmap,
+        "received": bitmap.count(1),
+        # SHA-256 of the contiguous prefix of chunks received so far
+        "sha256": hashlib.sha256(),
+        "hashed_chunks": 0,
+        # Chunks being written by a request (a concurrent retry of one of them is not written again)
+        "writing": set(),
+        # Set when the upload completes, for the requests still holding this state
+        "result": None,
+        "lock": threading.Lock(),
+    }
+    _uploads[upload_id] = state
+    return state
+
+
+def _expected_length(manifest, chunk_index):
+    """
+    Length of a chunk: chunk_size, or the remainder of the file for the last one
+    (None if the client did not send the total size)
+    """
+    if not manifest["total_size"]:
+        return None
+    offset = chunk_index * manifest["chunk_size"]
+    return max(0, min(manifest["chunk_size"], manifest["total_size"] - offset))
+
+
+def _read_with_crc32(stream, max_bytes):
+    """
+    Read a chunk into memory computing its CRC32 on the fly (no extra pass over the data).
+    At most max_bytes + 1 bytes are read, enough to tell an oversize chunk without buffering it.
+    The buffers are returned so the chunk can be written and fed to the file's SHA-256.
+    """
+    crc = 0
+    received = 0
+    buffers = []
+    while received <= max_bytes:
+        buffer = stream.read(min(COPY_BUFFER_SIZE, max_bytes + 1 - received))
+        if not buffer:
+            break
+        crc = zlib.crc32(buffer, crc)
+        received += len(buffer)
+        buffers.append(buffer)
+    return crc, received, buffers
+
+
+def _advance_hash(state, chunk_index, buffers):
+    """
+    Feed the SHA-256 with every chunk contiguous to the part already hashed.
+
+    Chunks arriving in order are hashed from the buffers just received; chunks that
+    arrived early are read back from the part file (still in the page cache) once the
+    gap before them is filled.
+    """
+    manifest = state["manifest"]
+    bitmap = state["bitmap"]
+    total = manifest["total_chunks"]
+    chunk_size = manifest["chunk_size"]
+    part = None
+    try:
+        while state["hashed_chunks"] < total and bitmap[state["hashed_chunks"]]:
+            index = state["hashed_chunks"]
+            if index == chunk_index:
+                for buffer in buffers:
+                    state["sha256"].update(buffer)
+            else:
+                if part is None:
+                    part = open(manifest["part_path"], "rb")
+                part.seek(index * chunk_size)
+                state["sha256"].update(part.read(chunk_size))
+            state["hashed_chunks"] += 1
+    finally:
+        if part is not None:
+            part.close()
+
+
+def get_upload_status(chunks_dir, upload_id):
+    """
+    Report which chunk indices of an upload are already stored, so the client can resume it
+    """
+    upload_id = os.path.basename(upload_id)
+    with _uploads_lock:
+        state = _uploads.get(upload_id)
+    if state is not None:
+        with state["lock"]:
+            manifest = state["manifest"]
+            bitmap = bytes(state["bitmap"])
+    else:
+        upload_folder = os.path.join(chunks_dir, upload_id)
+        manifest, bitmap = _read_manifest(upload_folder)
+        if manifest is None and os.path.exists(_completed_path(upload_folder)):
+            with open(_completed_path(upload_folder), "r", encoding="utf-8") as f:
+                result = json.load(f)
+            return {"status": "complete", "received": list(range(result["total"])), "total": result["total"],
+                    "file_path": result["file_path"]}
+    if manifest is None:
+        return {"status": "new", "received": [], "total": 0}
+    received = [i for i, flag in enumerate(bitmap) if flag == 1]
+    return {
+        "status": "incomplete",
+        "received": received,
+        "total": manifest["total_chunks"],
+        "chunk_size": manifest["chunk_size"],
+        "total_size": manifest["total_size"],
+    }
+
+
+def receive_chunk(chunks_dir, target_dir, upload_id, filename, chunk_index, total_chunks, stream,
+                  chunk_size=DEFAULT_CHUNK_SIZE, total_size=0, checksum=None, blobs_dir=None):
+    """
+    Write one chunk straight to its offset in the pre-allocated target file.
+
+    Completion is tracked with a one-byte-per-chunk bitmap, so each chunk costs O(1)
+    and the finished file is renamed into place instead of being copied. Chunks can
+    arrive concurrently and in any order; a chunk sent again after the upload completed
+    (within COMPLETED_TTL) gets the same 'complete' result without being read. The chunk is checked before it is written:
+    its length must be chunk_size (the remainder for the last one) and, if a CRC32
+    checksum (hex string) is given, it must match; otherwise nothing is written and
+    ChunkSizeError / ChunkChecksumError is raised. A chunk already received is not
+    written again (a retry cannot overwrite good bytes).
+    The SHA-256 of the whole file is computed as chunks arrive; if blobs_dir is given
+    the finished file is committed to the content-addressed store and linked into
+    target_dir.
+
+    Returns a dict with 'status' ('complete' or 'incomplete'), 'received', 'total'
+    and, when complete, 'file_path' and 'sha256'.
+    """
+    upload_id = os.path.basename(upload_id)
+    filename = os.path.basename(filename)
+    if not upload_id or not filename:
+        raise ValueError("Invalid upload_id or filename")
+    if total_chunks < 1 or not 0 <= chunk_index < total_chunks:
+        raise ValueError(f"Chunk index {chunk_index} is out of range (total chunks: {total_chunks})")
+
+    with _uploads_lock:
+        state = _open_upload(chunks_dir, target_dir, upload_id, filename,
+                             total_chunks, chunk_size, total_size, blobs_dir)
+    if state["result"] is not None:
+        return state["result"]
+    manifest = state["manifest"]
+    offset = chunk_index * manifest["chunk_size"]
+
+    expected = _expected_length(manifest, chunk_index)
+    crc, received_bytes, buffers = _read_with_crc32(stream, manifest["chunk_size"] if expected is None else expected)
+    if expected is None:
+        # Without the total size only the last chunk may be shorter
+        size_ok = received_bytes <= manifest["chunk_size"] and (
+            received_bytes == manifest["chunk_size"] or chunk_index == manifest["total_chunks"] - 1)
+    else:
+        size_ok = received_bytes == expected
+    if not size_ok:
+        # The read stops one byte past the expected length, so an oversize chunk is reported as "at least"
+        limit = manifest["chunk_size"] if expected is None else expected
+        size = f"at least {received_bytes}" if received_bytes > limit else str(received_bytes)
+        raise ChunkSizeError(f"Chunk {chunk_index} of {filename} has {size} bytes, expected {limit}")
+    if checksum is not None and int(checksum, 16) != crc:
+        raise ChunkChecksumError(
+            f"Checksum mismatch for chunk {chunk_index} of {filename}: expected {checksum}, got {crc:08x} ({received_bytes} bytes)")
+
+    with state["lock"]:
+        if state["result"] is not None:
+            return state["result"]
+        if state["bitmap"][chunk_index] or chunk_index in state["writing"]:
+            # Retry of a chunk already on disk (or being written by another request): keep those bytes
+            return {"status": "incomplete", "received": state["received"], "total": manifest["total_chunks"]}
+        state["writing"].add(chunk_index)
+    try:
+        # Each request writes through its own file descriptor, so chunks never wait for each other here
+        with open(manifest["part_path"], "r+b") as part:
+            part.seek(offset)
+            for buffer in buffers:
+                part.write(buffer)
+    except Exception:
+        with state["lock"]:
+            state["writing"].discard(chunk_index)
+        raise
+
+    with state["lock"]:
+        state["writing"].discard(chunk_index)
+        bitmap = state["bitmap"]
+        if not bitmap[chunk_index]:
+            bitmap[chunk_index] = 1
+            with open(_bitmap_path(state["folder"]), "r+b") as bitmap_file:
+                bitmap_file.seek(chunk_index)
+                bitmap_file.write(b"\x01")
+            state["received"] += 1
+        _advance_hash(state, chunk_index, buffers)
+        received = state["received"]
+        total = manifest["total_chunks"]
+        if received < total:
+            return {"status": "incomplete", "received": received, "total": total}
+
+        # All chunks written in place: move the file to its final name (or into the blob store)
+        digest = state["sha256"].hexdigest()
+        try:
+            if blobs_dir is not None:
+                # Hashed from the verified chunks as they were written (or read back from the part file):
+                # no second pass over the whole file
+                commit_blob(blobs_dir, manifest["part_path"], digest, manifest["final_path"], verify=False)
+            else:
+                os.replace(manifest["part_path"], manifest["final_path"])
+            state["result"] = {"status": "complete", "received": received, "total": total,
+                               "file_path": manifest["final_path"], "sha256": digest}
+            # Only the result is kept on disk, for retries of the last chunk
+            _record_completion(state["folder"], state["result"])
+        except Exception:
+            # A failed commit drops the part file: the client has to upload the file again
+            shutil.rmtree(state["folder"], ignore_errors=True)
+            raise
+        finally:
+            with _uploads_lock:
+                _uploads.pop(upload_id, None)
+        return state["result"]
+
+
+def prune_uploads(chunks_dir):
+    """
+    Remove the records of uploads completed more than COMPLETED_TTL seconds ago
+    """
+    removed = 0
+    if not os.path.isdir(chunks_dir):
+        return removed
+    for upload_id in os.listdir(chunks_dir):
+        completed_file = _completed_path(os.path.join(chunks_dir, upload_id))
+        try:
+            if time.time() - os.path.getmtime(completed_file) >= COMPLETED_TTL:
+                shutil.rmtree(os.path.dirname(completed_file), ignore_errors=True)
+                removed += 1
+        except OSError:
+            # Upload in progress (no record)
+            continue
+    return removed
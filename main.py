@@ -5,17 +5,17 @@ import os
 import pandas as pd
 # Import summary functions
 from experiments.summary.summary import get_file_info
-from experiments.tic.tic_2d_3d import main as plot_tic
-from experiments.tic.tic_2d_3d import load_and_process_data
-from experiments.summary.summary_extended import get_file_info_extended
+from experiments.tic.tic_2d_3d import spikes_figure, surface_figure
+from experiments.summary.summary_cache import get_summary, prune_summaries
 
 # Import chromatogram functions
 from experiments.chromatograms.multiple_chromatograms import render_chromatogram_comparison as compare_chromatograms
 
 # Import spectra functions
 from experiments.spectra.spectra_binning import binning_spectrum
-from experiments.spectra.merge_spectra import merge_spectra
+from experiments.spectra.merge_spectra import merge_spectra, DEFAULT_BIN_WIDTH, DEFAULT_BIN_UNIT
 from experiments.spectra.spectra_ms2 import render_spectra_plots
+from experiments.loaders.ms2_index import ms2_index, precursor_list
 
 # Import the smoothing functions
 from experiments.smoothing.multiple_smoothing import multiple_smoothing
@@ -25,11 +25,12 @@ from experiments.smoothing.single_smoothing import single_smoothing
 from experiments.centroiding.centroiding import centroid_file
 
 # Import normalization functions
-from experiments.normalize.normalize_to_one import normalize_to_one
-from experiments.normalize.normalize_to_tic import normalize_to_tic
+from experiments.normalize.normalize_files import normalization_plots, normalize_files
 
 # Import features functions
-from experiments.features.features import plot_features
+from experiments.features.features import (plot_features, ISOTOPE_FILTERING_MODELS,
+                                            DEFAULT_ISOTOPE_FILTERING_MODEL, DEFAULT_REMOVE_SINGLE_TRACES)
+from experiments.features.trace_cache import prune_traces
 
 # Import adduct functions
 from experiments.adduct.adduct import get_adduct_files
@@ -46,6 +47,16 @@ from experiments.gnps.gnps import get_gnps_files
 # Import Accurate Mass functions
 from experiments.accurate_mass_search.accurate_mass import load_files as accurate_mass_search
 
+# Import upload functions
+from experiments.uploads.chunked_upload import receive_chunk, get_upload_status, prune_uploads, ChunkChecksumError, DEFAULT_CHUNK_SIZE
+from experiments.uploads.blob_store import save_upload, prune_blobs, storage_usage, has_blob, link_blob, resolve_upload, is_digest, MissingUploadError
+
+# Import shared loaders
+from experiments.loaders.experiment_cache import cache_stats, invalidate
+from experiments.loaders.peak_sidecar import prune_sidecars
+from experiments.loaders.indexed_mzml import read_spectrum, nearest_spectrum_index, count_spectra
+from experiments.loaders.mzml_peek import peek_mzml
+
 
 app = Flask(__name__)
 app.secret_key = '123'
@@ -61,6 +72,8 @@ CONSENSUS_DIR = 'uploads/consensus'  # default folder for consensus files
 GNPS_DIR = 'uploads/gnps'  # default folder for gnps files
 # default folder for accurate mass search files
 ACCURATE_MASS_DIR = 'uploads/accurate_mass'
+# content-addressed store (SHA-256) shared by every step folder through hardlinks
+BLOBS_DIR = 'uploads/blobs'
 
 ALL_UPLOAD_DIRS = [SMOOTHING_DIR, CENTROIDS_DIR, NORMALIZE_DIR, FEATURES_DIR,
                    ADDUCTS_DIR, ALIGNMENT_DIR, CONSENSUS_DIR, GNPS_DIR, ACCURATE_MASS_DIR]
@@ -85,7 +98,11 @@ def upload_chunk():
     - upload_id: id único de la subida
     - chunk_index: índice del chunk
     - total_chunks: número total de chunks
+    - chunk_size: tamaño de cada chunk en bytes (el último puede ser menor)
+    - total_size: tamaño total del archivo en bytes
+    - checksum: CRC32 del chunk en hexadecimal (opcional)
     - target_dir: carpeta destino
+    Los chunks pueden llegar en paralelo y en cualquier orden.
     """
     try:
         chunk = request.files['chunk']
@@ -93,44 +110,128 @@ def upload_chunk():
         upload_id = request.form['upload_id']
         chunk_index = int(request.form['chunk_index'])
         total_chunks = int(request.form['total_chunks'])
+        chunk_size = int(request.form.get('chunk_size', DEFAULT_CHUNK_SIZE))
+        total_size = int(request.form.get('total_size', 0))
         target_dir = request.form.get('target_dir', 'mzML_samples')
-
-        # Carpeta temporal para los chunks de este archivo
-        chunk_folder = os.path.join(CHUNKS_DIR, upload_id)
-        os.makedirs(chunk_folder, exist_ok=True)
-
-        # Guardar el chunk
-        chunk_path = os.path.join(chunk_folder, f"chunk_{chunk_index}")
-        chunk.save(chunk_path)
-
-        # Revisar si ya se recibieron todos los chunks
-        uploaded_chunks = len([name for name in os.listdir(
-            chunk_folder) if name.startswith('chunk_')])
-        if uploaded_chunks == total_chunks:
-            # Ensamblar el archivo final
-            os.makedirs(target_dir, exist_ok=True)
-            assembled_path = os.path.join(target_dir, filename)
-            print(
-                f"[UPLOAD_CHUNK] All chunks received. Assembling to {assembled_path}")
-            with open(assembled_path, 'wb') as assembled:
-                for i in range(total_chunks):
-                    part_path = os.path.join(chunk_folder, f"chunk_{i}")
-                    with open(part_path, 'rb') as part:
-                        assembled.write(part.read())
-            # Limpiar los chunks temporales
-            for name in os.listdir(chunk_folder):
-                os.remove(os.path.join(chunk_folder, name))
-            os.rmdir(chunk_folder)
+        checksum = request.form.get('checksum')
+
+        # Escribir el chunk directamente en su offset del archivo final
+        result = receive_chunk(CHUNKS_DIR, target_dir, upload_id, filename, chunk_index,
+                               total_chunks, chunk.stream, chunk_size, total_size, checksum,
+                               blobs_dir=BLOBS_DIR)
+        if result['status'] == 'complete':
+            assembled_path = result['file_path']
             # Guardar la ruta en sesión para el summary
             session['file_path'] = assembled_path
             print(
                 f"[UPLOAD_CHUNK] Assembly complete. Returning file_path: {assembled_path}")
             return jsonify({'status': 'complete', 'file_path': assembled_path})
         else:
-            return jsonify({'status': 'incomplete', 'received': uploaded_chunks, 'total': total_chunks})
+            return jsonify({'status': 'incomplete', 'received': result['received'], 'total': result['total']})
+    except ChunkChecksumError as e:
+        # El cliente debe reenviar el chunk
+        print(f"[UPLOAD_CHUNK] {e}")
+        return jsonify({'status': 'error', 'error': str(e)}), 400
     except Exception as e:
         print(f"[UPLOAD_CHUNK] Error: {e}")
         return jsonify({'status': 'error', 'error': str(e)}), 500
+
+
+@app.route('/upload_status', methods=['GET'])
+def upload_status():
+    """
+    Devuelve los índices de chunks ya recibidos para una subida, para poder reanudarla.
+    Espera el parámetro upload_id en la query string.
+    """
+    upload_id = request.args.get('upload_id', '')
+    if not upload_id:
+        return jsonify({'status': 'error', 'error': 'upload_id is required'}), 400
+    return jsonify(get_upload_status(CHUNKS_DIR, upload_id))
+
+
+@app.route('/check_upload', methods=['POST'])
+def check_upload():
+    """
+    Handshake previo a la subida: el cliente envía el SHA-256 del archivo completo.
+    Si el contenido ya está en el almacén de blobs se enlaza en la carpeta destino
+    y no hace falta transferirlo.
+    Espera un JSON con:
+    - sha256: hash del archivo en hexadecimal
+    - filename: nombre original del archivo
+    - target_dir: carpeta destino
+    """
+    data = request.get_json(silent=True) or {}
+    sha256 = str(data.get('sha256', '')).lower()
+    filename = os.path.basename(data.get('filename', ''))
+    target_dir = data.get('target_dir', 'mzML_samples')
+    if not is_digest(sha256) or not filename:
+        return jsonify({'status': 'error', 'error': 'sha256 and filename are required'}), 400
+    if not has_blob(BLOBS_DIR, sha256):
+        return jsonify({'status': 'missing'})
+    file_path = link_blob(BLOBS_DIR, sha256, os.path.join(target_dir, filename))
+    session['file_path'] = file_path
+    print(f"[CHECK_UPLOAD] {filename} already stored, linked to {file_path}")
+    return jsonify({'status': 'exists', 'file_path': file_path})
+
+
+def resolve_uploaded_files(field, upload_dir):
+    """
+    Devuelve las rutas de los archivos de un campo del formulario.
+    Los archivos enviados en el cuerpo del form se guardan a través del almacén de blobs;
+    los ya subidos por chunks (o reconocidos por su hash) llegan solo como nombre y su
+    SHA-256 en el campo '<field>_sha256'. Si ese contenido no está en el servidor se lanza
+    MissingUploadError (nunca se usa otro archivo con el mismo nombre).
+    """
+    paths = []
+    for file in request.files.getlist(field):
+        if file and file.filename:
+            path = os.path.join(upload_dir, os.path.basename(file.filename))
+            save_upload(file, path, BLOBS_DIR)
+            paths.append(path)
+    names = request.form.getlist(field)
+    hashes = request.form.getlist(f'{field}_sha256')
+    for i, name in enumerate(names):
+        name = os.path.basename(name)
+        if not name:
+            continue
+        path = os.path.join(upload_dir, name)
+        sha256 = hashes[i] if i < len(hashes) else ''
+        resolve_upload(BLOBS_DIR, path, sha256)
+        if path not in paths:
+            paths.append(path)
+    return paths
+
+
+# Page of every step that resolves uploaded files, to report a missing upload on it:
+# template, page, selected option (set by the step before its files are resolved) and extra context
+UPLOAD_PAGES = {
+    'process_alignment': ('alignment.html', 'Alignment', lambda: request.form.get('selected_option', 'op1'), {}),
+    'process_consensus': ('consensus.html', 'Consensus', None, {}),
+    'features_function': ('features.html', 'Features', lambda: session.get('selected_option_features', 'op1'),
+                          {'isotope_filtering_models': ISOTOPE_FILTERING_MODELS}),
+    'process_gnps': ('gnps.html', 'GNPS', None, {}),
+    'process_chromatograms': ('chromatogram.html', 'Chromatograms', None, {}),
+    'process_normalize': ('normalize.html', 'Normalize', lambda: session.get('selected_option_normalize', 'op1'), {}),
+    'process_spectra': ('spectra.html', 'Spectra', None, {}),
+    'process_smoothing': ('smoothing.html', 'Smoothing', lambda: request.form.get('smoothing_options', 'op1'),
+                          {'window_length': 11, 'polyorder': 3}),
+    'process_mzML': ('summary.html', 'Summary', None, {}),
+    'process_adducts': ('adducts.html', 'Adducts', None, {}),
+    'process_centroiding': ('centroiding.html', 'Centroiding', None, {}),
+    'process_ami': ('accurate_mass.html', 'Accurate Mass Search', None, {}),
+}
+
+
+@app.errorhandler(MissingUploadError)
+def missing_upload(e):
+    """
+    A file sent by name whose content is not on the server: the client has to upload it again
+    """
+    print(f"[UPLOAD] {e}")
+    template, page, selected_option, context = UPLOAD_PAGES.get(request.endpoint, ('index.html', None, None, {}))
+    if selected_option is not None:
+        context = dict(context, selected_option=selected_option())
+    return render_template(template, error_alert=str(e), page=page, **context)
 # -------------------------------------------------------------------------------------------------------------------------------------
 # -------------------------------------------------------------------------------------------------------------------------------------
 
@@ -283,29 +384,15 @@ def process_alignment():
     if not selected_option:
         selected_option = 'op1'
 
-    feature_files = request.files.getlist('feature_filename')
-    if not all(file.filename.endswith('.featureXML') for file in feature_files):
+    feature_file_paths = resolve_uploaded_files('feature_filename', uploads_dir)
+    if not all(path.endswith('.featureXML') for path in feature_file_paths):
         error_alert = "Please upload only .featureXML files for features."
         return render_template('alignment.html', download_links_features=None, download_links_mzml=None, selected_option=selected_option, error_alert=error_alert, page='Alignment')
-    mzml_files = request.files.getlist('mzml_filename')
-    if not all(file.filename.endswith('.mzML') for file in mzml_files):
+    mzml_file_paths = resolve_uploaded_files('mzml_filename', uploads_dir)
+    if not all(path.endswith('.mzML') for path in mzml_file_paths):
         error_alert = "Please upload only .mzML files for mzML."
         return render_template('alignment.html', download_links_features=None, download_links_mzml=None, selected_option=selected_option, error_alert=error_alert, page='Alignment')
 
-    # Save files and get their paths
-    feature_file_paths = []
-    for file in feature_files:
-        path = os.path.join(uploads_dir, file.filename)
-        if not os.path.exists(path):
-            file.save(path)
-        feature_file_paths.append(path)
-    mzml_file_paths = []
-    for file in mzml_files:
-        path = os.path.join(uploads_dir, file.filename)
-        if not os.path.exists(path):
-            file.save(path)
-        mzml_file_paths.append(path)
-
     # Get base names without extension from mzML files
     mzml_basenames = [os.path.splitext(os.path.basename(f))[
         0] for f in mzml_file_paths]
@@ -437,21 +524,13 @@ def process_consensus():
     uploads_dir = os.path.join(os.getcwd(), CONSENSUS_DIR)
     os.makedirs(uploads_dir, exist_ok=True)
 
-    file_paths = request.files.getlist('filename')
+    file_paths = resolve_uploaded_files('filename', uploads_dir)
 
     if len(file_paths) < 2:
         error_alert = "Error: Please upload at least two .featureXML files to generate a consensus matrix."
         session['step_status'] = 'started'
         return render_template('consensus.html', error_alert=error_alert, page='Consensus')
     else:
-        saved_file_paths = []
-        for file in file_paths:
-            path = os.path.join(uploads_dir, file.filename)
-            if not os.path.exists(path):
-                file.save(path)
-            saved_file_paths.append(path)
-        file_paths = saved_file_paths
-
         # get_consensus_matrix now returns (output_path, csv_path)
         result = get_consensus_matrix(file_paths, uploads_dir, "empty.idXML")
         if isinstance(result, tuple):
@@ -492,7 +571,7 @@ def features():
         if 'features' in session.get('current_steps', []) and session.get('step_status') == 'finished':
             session['step_status'] = 'started'
     selected_option = request.form.get('features_options', 'op1')
-    return render_template('features.html', selected_option=selected_option, page='Features')
+    return render_template('features.html', selected_option=selected_option, isotope_filtering_models=ISOTOPE_FILTERING_MODELS, page='Features')
 
 # FEATURES Endpoint for serving files from the uploads folder ####################################
 
@@ -508,24 +587,24 @@ def features_function():
         'selected_option_features', 'op1')
     session['selected_option_features'] = selected_option
 
-    files = request.files.getlist('filename')
-    if not all(file.filename.endswith('.mzML') or file.filename.endswith('.featureXML') for file in files if file.filename):
+    files = resolve_uploaded_files('filename', uploads_dir)
+    if not all(path.endswith('.mzML') or path.endswith('.featureXML') for path in files):
         error_alert = "Please upload only .mzML or .featureXML files."
-        return render_template('features.html', plot_features=None, download_links=None, error_alert=error_alert, selected_option=selected_option, page='Features')
+        return render_template('features.html', plot_features=None, download_links=None, error_alert=error_alert, selected_option=selected_option, isotope_filtering_models=ISOTOPE_FILTERING_MODELS, page='Features')
 
      # Get parameters from the form
     mass_error_ppm = request.form.get('mass_error_ppm', 10)
     noise_threshold_int = request.form.get('noise_threshold_int', 1000)
+    # FeatureFindingMetabo options (changing only these reuses the cached mass traces)
+    isotope_filtering_model = request.form.get('isotope_filtering_model', DEFAULT_ISOTOPE_FILTERING_MODEL)
+    if isotope_filtering_model not in ISOTOPE_FILTERING_MODELS:
+        isotope_filtering_model = DEFAULT_ISOTOPE_FILTERING_MODEL
+    remove_single_traces = 'false' if request.form.get('remove_single_traces', DEFAULT_REMOVE_SINGLE_TRACES) == 'false' else 'true'
     download_links = []
 
     # if theres files uploaded, use them, otherwise use the ones in the session
-    if files and any(file.filename for file in files):
-        file_paths = []
-        for file in files:
-            path = os.path.join(uploads_dir, file.filename)
-            if not os.path.exists(path):
-                file.save(path)
-            file_paths.append(path)
+    if files:
+        file_paths = files
         session['file_paths'] = file_paths
     else:
         file_paths = session.get('file_paths', [])
@@ -548,7 +627,8 @@ def features_function():
 
     # Procesar todos los archivos juntos para que la gráfica incluya todos
     output_files, plot_features_detected = plot_features(
-        file_paths, mass_error_ppm, noise_threshold_int, uploads_dir, features_type)
+        file_paths, mass_error_ppm, noise_threshold_int, uploads_dir, features_type,
+        isotope_filtering_model, remove_single_traces)
     import plotly.io as pio
     plot_features_render = pio.to_html(
         plot_features_detected, full_html=False, include_plotlyjs='cdn')
@@ -568,7 +648,7 @@ def features_function():
             })
         workflow_step_finished('features', generated_files)
         # advance_workflow_step('features')
-        return render_template('features.html', plot_features=plot_features_render, download_links=None, selected_option=selected_option, page='Features')
+        return render_template('features.html', plot_features=plot_features_render, download_links=None, selected_option=selected_option, isotope_filtering_models=ISOTOPE_FILTERING_MODELS, isotope_filtering_model=isotope_filtering_model, remove_single_traces=remove_single_traces, page='Features')
 
     elif output_files and len(output_files) > 0:
         # Generar links de descarga para todos los archivos generados
@@ -590,11 +670,11 @@ def features_function():
             })
         workflow_step_finished('features', generated_files)
         # advance_workflow_step('features')
-        return render_template('features.html', plot_features=plot_features_render, download_links=download_links, selected_option=selected_option, page='Features')
+        return render_template('features.html', plot_features=plot_features_render, download_links=download_links, selected_option=selected_option, isotope_filtering_models=ISOTOPE_FILTERING_MODELS, isotope_filtering_model=isotope_filtering_model, remove_single_traces=remove_single_traces, page='Features')
     else:
         alert = 'There are no features detected.'
         session['step_status'] = 'started'
-        return render_template('features.html', plot_features=plot_features_render, download_links=None, error_alert=alert, selected_option=selected_option, page='Features')
+        return render_template('features.html', plot_features=plot_features_render, download_links=None, error_alert=alert, selected_option=selected_option, isotope_filtering_models=ISOTOPE_FILTERING_MODELS, isotope_filtering_model=isotope_filtering_model, remove_single_traces=remove_single_traces, page='Features')
 
 # GNPS page ####################################
 
@@ -620,25 +700,17 @@ def process_gnps():
         download_links = []
         mzml_file_paths = []
 
-        aligned_mzML_files = request.files.getlist("mzml_filename")
-        consensus_file = request.files["consensus_filename"]
-        if not consensus_file.filename.endswith('consensusXML') or consensus_file.filename.endswith('csv'):
+        mzml_file_paths = resolve_uploaded_files("mzml_filename", uploads_dir)
+        consensus_paths = resolve_uploaded_files("consensus_filename", uploads_dir)
+        consensus_path = consensus_paths[0] if consensus_paths else ''
+        if not consensus_path.endswith('consensusXML') or consensus_path.endswith('csv'):
             error_alert = "Please upload a valid .consensusXML or .csv file for consensus."
             return render_template('gnps.html', error_alert=error_alert, page='GNPS')
 
-        if len(aligned_mzML_files) < 1 or not consensus_file:
+        if len(mzml_file_paths) < 1 or not consensus_path:
             error_alert = "Error: Please upload at least one aligned .mzML file and one .consensusXML file to generate GNPS files."
             return render_template('gnps.html', error_alert=error_alert, page='GNPS')
         else:
-            for file in aligned_mzML_files:
-                path = os.path.join(uploads_dir, file.filename)
-                if not os.path.exists(path):
-                    file.save(path)
-                mzml_file_paths.append(path)
-
-            consensus_path = os.path.join(uploads_dir, consensus_file.filename)
-            consensus_file.save(consensus_path)
-
             output_files, alert = get_gnps_files(
                 mzml_file_paths, consensus_path, uploads_dir)
             if alert is not None:
@@ -679,16 +751,12 @@ def process_chromatograms():
 
     try:
         # Check if files are uploaded
-        if 'filename' in request.files:
-            files = request.files.getlist('filename')
-            if not all(file.filename.endswith('.mzML') for file in files):
+        files = resolve_uploaded_files('filename', 'mzML_samples')
+        if files:
+            if not all(path.endswith('.mzML') for path in files):
                 return render_template('chromatogram.html', plot_chromatograms=None, error_alert="Please upload only .mzML files.", page='Chromatograms')
             intensity_threshold = 100
-            file_paths = []
-            for file in files:
-                path = f"mzML_samples/{file.filename}"
-                file.save(path)
-                file_paths.append(path)
+            file_paths = files
             session['file_paths'] = file_paths
             print("Rutas de archivos:", file_paths)
         else:
@@ -732,7 +800,6 @@ def normalize():
 def process_normalize():
     plot_normalized = None
     plot_original = None
-    download_link = None
 
     # Folder for uploaded files
     uploads_dir = os.path.join(os.getcwd(), NORMALIZE_DIR)
@@ -742,50 +809,43 @@ def process_normalize():
         'selected_option_normalize', 'op1')
     session['selected_option_normalize'] = selected_option
 
-    # check if theres a file in the request
-    uploaded_file = request.files.get('filename')
-    file_path = None
-
-    if uploaded_file and uploaded_file.filename:
-        if not uploaded_file.filename.endswith('.mzML'):
-            return render_template('normalize.html', selected_option=selected_option, plot_original=None, plot_normalized=None, download_link=None, error_alert="Please upload a valid .mzML file.", page='Normalize')
-        else:
-            file_path = os.path.join(uploads_dir, uploaded_file.filename)
-            uploaded_file.save(file_path)
-            session['file_path'] = file_path
-    else:
-        file_path = session.get('file_path')
-
-    # Only proceed if file_path is set
-    if not file_path:
-        return render_template('normalize.html', selected_option=selected_option, plot_original=None, plot_normalized=None, download_link=None, error_alert="No file uploaded.", page='Normalize')
+    # check if theres a file in the request (one or several: batch normalization)
+    file_paths = resolve_uploaded_files('filename', uploads_dir)
 
-    if selected_option == 'op1':
-        result = normalize_to_one(file_path)
-    elif selected_option == 'op2':
-        result = normalize_to_tic(file_path)
+    if file_paths:
+        if not all(path.endswith('.mzML') for path in file_paths):
+            return render_template('normalize.html', selected_option=selected_option, plot_original=None, plot_normalized=None, download_links=None, error_alert="Please upload valid .mzML files.", page='Normalize')
+        session['file_path'] = file_paths[0]
+    elif session.get('file_path'):
+        file_paths = [session.get('file_path')]
 
-    if isinstance(result, tuple):
-        fig, fig2, output_path = result
-    else:
-        fig, fig2, output_path = None, None, result
+    # Only proceed if there are files
+    if not file_paths:
+        return render_template('normalize.html', selected_option=selected_option, plot_original=None, plot_normalized=None, download_links=None, error_alert="No file uploaded.", page='Normalize')
 
-    plot_original = None
-    plot_normalized = None
-    download_link = None
+    method, method_label = ('to_one', 'One') if selected_option == 'op1' else ('to_TIC', 'TIC')
+    try:
+        # One read and one write per file, the files in parallel
+        results = normalize_files(file_paths, method, NORMALIZE_DIR)
+    except Exception as e:
+        return render_template('normalize.html', selected_option=selected_option, plot_original=None, plot_normalized=None, download_links=None, error_alert=f"Error during normalization: {str(e)}", page='Normalize')
 
-    if output_path and "normalized" in output_path:
+    download_links = []
+    for output_path, _ in results:
         filename = os.path.basename(output_path)
-        download_link = f"{NORMALIZE_DIR}/{filename}"
-        print(f"Download link: {download_link}")
-        if fig is not None and fig2 is not None:
-            import plotly.io as pio
-            plot_original = pio.to_html(
-                fig, full_html=False, include_plotlyjs='cdn')
-            plot_normalized = pio.to_html(
-                fig2, full_html=False, include_plotlyjs='cdn')
+        download_links.append(f"{NORMALIZE_DIR}/{filename}")
+        print(f"Download link: {download_links[-1]}")
+
+    # Plots of the first spectrum of the first file
+    fig, fig2 = normalization_plots(results[0][1], method_label)
+    if fig is not None and fig2 is not None:
+        import plotly.io as pio
+        plot_original = pio.to_html(
+            fig, full_html=False, include_plotlyjs='cdn')
+        plot_normalized = pio.to_html(
+            fig2, full_html=False, include_plotlyjs='cdn')
 
-    return render_template('normalize.html', selected_option=selected_option, plot_original=plot_original, plot_normalized=plot_normalized, download_link=download_link, page='Normalize')
+    return render_template('normalize.html', selected_option=selected_option, plot_original=plot_original, plot_normalized=plot_normalized, download_links=download_links, page='Normalize')
 
 # render spectra page ####################################
 
@@ -805,24 +865,20 @@ def spectra():
 @app.route('/get_files_spectra', methods=['POST'])
 def process_spectra():
     import plotly.io as pio
-    import pyopenms as oms
 
-    if 'filename' in request.files:
-        file = request.files['filename']
+    # Guardar en uploads/temp_chunks (los archivos subidos por chunks ya están ahí)
+    chunk_dir = os.path.join('uploads', 'temp_chunks')
+    os.makedirs(chunk_dir, exist_ok=True)
+    uploaded_files = resolve_uploaded_files('filename', chunk_dir)
+    if uploaded_files:
+        path = uploaded_files[0]
 
-        if not file or not file.filename.endswith('.mzML'):
+        if not path.endswith('.mzML'):
             return render_template('spectra.html', error_alert="Please upload a valid .mzML file.", page='Spectra')
 
         spectrum_value = 1
-        # Guardar en uploads/temp_chunks
-        chunk_dir = os.path.join('uploads', 'temp_chunks')
-        os.makedirs(chunk_dir, exist_ok=True)
-        path = os.path.join(chunk_dir, file.filename)
-        # Si el archivo ya existe (por chunks), no lo volvemos a guardar
-        if not os.path.exists(path):
-            file.save(path)
         session['file_path'] = path
-        filename = file.filename
+        filename = os.path.basename(path)
         # print("Ruta de archivos:", path)
     else:
         # if there is no new file, get the previous one from the session, and the spectrum index from the set value input
@@ -830,28 +886,37 @@ def process_spectra():
         filename = os.path.basename(path) if path else ''
         spectrum_value = int(request.form.get('spectrum_value', 100))
 
-    # Check MS level
-    exp = oms.MSExperiment()
-    oms.MzMLFile().load(path, exp)
-    spectra = exp.getSpectra()
-
-    ms1 = sum(1 for s in spectra if s.getMSLevel() == 1)
-    ms2 = sum(1 for s in spectra if s.getMSLevel() == 2)
+    # Bins of the merged MS1 spectrum (fixed width in Da or ppm)
+    try:
+        merge_bin_width = float(request.form.get('merge_bin_width') or DEFAULT_BIN_WIDTH)
+    except ValueError:
+        return render_template('spectra.html', error_alert="The bin width must be a number.", page='Spectra')
+    if not 0 < merge_bin_width < float('inf'):
+        return render_template('spectra.html', error_alert="The bin width must be greater than 0.", page='Spectra')
+    merge_bin_unit = request.form.get('merge_bin_unit', DEFAULT_BIN_UNIT)
+
+    # Check MS level (spectrum headers only)
+    ms_levels = peek_mzml(path)['ms_levels']
+    ms1 = ms_levels.get(1, 0)
+    ms2 = ms_levels.get(2, 0)
 
     # ========== MS1 ==========
     if ms1 > 0 and ms2 == 0:
         ms_type = 1
 
-        # Binning usando el experimento ya cargado
+        # Promediado local: solo se decodifican los espectros de la ventana del espectro elegido
         alert, fig_binning, spectrum_index = binning_spectrum(
-            exp, spectrum_value)
+            path, spectrum_value)
         if alert and fig_binning is None:
             return render_template('spectra.html', error_alert=alert, page='Spectra')
 
         plot_spectra = pio.to_html(fig_binning, full_html=False)
 
-        # Merge usando el experimento ya cargado
-        fig_merge = merge_spectra(exp)
+        # Merge de los picos MS1 del sidecar
+        try:
+            fig_merge = merge_spectra(path, merge_bin_width, merge_bin_unit)
+        except ValueError as e:
+            return render_template('spectra.html', error_alert=str(e), page='Spectra')
         plot_merge_spectrum = pio.to_html(fig_merge, full_html=False)
 
         return render_template('spectra.html',
@@ -861,12 +926,19 @@ def process_spectra():
                                ms_level=ms1,
                                ms_type=ms_type,
                                spectrum_value=spectrum_value,
+                               merge_bin_width=merge_bin_width,
+                               merge_bin_unit=merge_bin_unit,
                                page='Spectra', config={'displayModeBar': True})
 
     # ========== MS2 ==========
     elif ms2 > 0:
         ms_type = 2
-        fig_ms2_spectra, fig_ms2_overlay = render_spectra_plots(exp)
+        # MS2 spectrum selected by precursor m/z (and RT), shown next to its parent MS1
+        precursor_mz = request.form.get('precursor_mz', type=float)
+        precursor_rt = request.form.get('precursor_rt', type=float)
+        fig_ms2_spectra, fig_ms2_overlay = render_spectra_plots(path, precursor_mz, precursor_rt)
+        if fig_ms2_spectra is None:
+            return render_template('spectra.html', error_alert="No MS1/MS2 spectrum pair found.", page='Spectra')
         plot_ms2_spectra = pio.to_html(fig_ms2_spectra, full_html=False)
         plot_ms2_overlay = pio.to_html(fig_ms2_overlay, full_html=False)
 
@@ -877,11 +949,50 @@ def process_spectra():
                                ms_level=ms1,
                                ms_type=ms_type,
                                spectrum_value=spectrum_value,
+                               precursor_mz=precursor_mz,
+                               precursor_rt=precursor_rt,
+                               precursors=precursor_list(ms2_index(path)),
                                page='Spectra')
 
     return render_template('spectra.html', error_alert="No valid MS1 or MS2 spectra found.", page='Spectra')
 
 
+# single spectrum endpoint (random access, JSON) ####################################
+@app.route('/get_spectrum', methods=['GET'])
+def get_spectrum():
+    """
+    Devuelve un único espectro del archivo actual de la página de espectros, en JSON.
+    Parámetros de la query string:
+    - index: índice del espectro
+    - rt: tiempo de retención (segundos), se devuelve el espectro más cercano
+    - ms_level: (opcional) buscar por RT solo entre espectros de este nivel
+    Solo se decodifica el espectro pedido (índice del mzML), sin cargar el archivo completo.
+    """
+    path = session.get('file_path')
+    if not path or not os.path.exists(path):
+        return jsonify({'error': 'No file loaded'}), 404
+    try:
+        if request.args.get('index') not in (None, ''):
+            index = int(request.args['index'])
+        elif request.args.get('rt') not in (None, ''):
+            ms_level = request.args.get('ms_level')
+            index = nearest_spectrum_index(path, float(request.args['rt']),
+                                           int(ms_level) if ms_level else None)
+        else:
+            return jsonify({'error': 'index or rt is required'}), 400
+    except ValueError:
+        return jsonify({'error': 'index, rt and ms_level must be numbers'}), 400
+
+    spectrum = read_spectrum(path, index) if index is not None else None
+    if spectrum is None:
+        return jsonify({'error': f"Spectrum {index} not found"}), 404
+    spectrum['mz'] = spectrum['mz'].tolist()
+    spectrum['intensity'] = spectrum['intensity'].tolist()
+    spectrum['n_spectra'] = count_spectra(path)
+    spectrum['filename'] = os.path.basename(path)
+    return jsonify(spectrum)
+
+
 # Smoothing page ####################################
 @app.route('/smoothing', methods=['GET', 'POST'])
 def smoothing():
@@ -906,19 +1017,12 @@ def process_smoothing():
     # print(f"[DEBUG] selected_option: {selected_option}")
     if selected_option == 'op1':
         # It could be a single file smoothing
-        files = request.files.getlist('filename')
-
-        file = None
-        for f in files:
-            if f and f.filename and f.filename.endswith('.mzML'):
-                file = f
-                break
-        if not file:
+        files = resolve_uploaded_files('filename', uploads_dir)
+
+        save_path = next((path for path in files if path.endswith('.mzML')), None)
+        if not save_path:
             alert = 'Please upload a valid .mzML file for single file smoothing.'
             return render_template('smoothing.html', selected_option='op1', download_link=None, window_length=11, polyorder=3, error_alert=alert, page='Smoothing')
-        save_path = os.path.join(uploads_dir, file.filename)
-        if not os.path.exists(save_path):
-            file.save(save_path)
         output_path = single_smoothing(save_path)
         if "savgol" in output_path:
             filename = os.path.basename(output_path)
@@ -942,16 +1046,9 @@ def process_smoothing():
                 polyorder = 3
             else:
                 polyorder = int(polyorder)
-            files = request.files.getlist('filename')
+            files = resolve_uploaded_files('filename', uploads_dir)
             # print(f"[DEBUG] multiple files count: {len(files)}")
-            file_paths = []
-            for file in files:
-                # print(f"[DEBUG] processing file: {file.filename}")
-                if file.filename and file.filename.endswith('.mzML'):
-                    save_path = os.path.join(uploads_dir, file.filename)
-                    if not os.path.exists(save_path):
-                        file.save(save_path)
-                    file_paths.append(save_path)
+            file_paths = [path for path in files if path.endswith('.mzML')]
 
             # If no files from form (chunked upload), look for files already in uploads_dir
             if not file_paths:
@@ -1014,19 +1111,12 @@ def process_mzML():
     if file:
         path = os.path.join('mzML_samples', filename)
         session['file_path'] = path
-        file.save(path)
-        # Clean the previous DataFrame when a new file is uploaded
-        session.pop('df_summary', None)
-        session.pop('df_summary_path', None)
-        # Clean the previous JSON file if it exists
-        df_json_path = 'uploads/temp_chunks/df_summary.json'
-        if os.path.exists(df_json_path):
-            try:
-                os.remove(df_json_path)
-            except Exception as e:
-                print(f"Error removing old df_summary.json: {e}")
+        save_upload(file, path, BLOBS_DIR)
     else:
-        # If coming from upload_chunk, the path is already in session['file_path']
+        # If coming from upload_chunk (or recognized by its hash), the file is already in mzML_samples/
+        resolved = resolve_uploaded_files('filename', 'mzML_samples')
+        if resolved:
+            session['file_path'] = resolved[0]
         path = session.get('file_path')
         # If not in session, try to find in mzML_samples/
         if not path and filename:
@@ -1037,16 +1127,19 @@ def process_mzML():
             return render_template('summary.html', error_alert=alert, page='Summary')
 
     import plotly.io as pio
-    import pandas as pd
 
+    # Metadata, TIC table and plot grids come from one pass over the file, cached per file:
+    # changing the colorscale (AJAX) is only a cache lookup
     try:
-        result = get_file_info_extended(path)
+        summary = get_summary(path)
+        result = summary['info']
         if not result:
             alert = "Error processing file: No data returned."
             return render_template('summary.html', error_alert=alert, page='Summary')
     except Exception as e:
         alert = f"Error processing file: {str(e)}"
         return render_template('summary.html', error_alert=alert, page='Summary')
+    session['summary_file'] = path
 
     # Convert numpy values to native types to avoid np.float64/np.int32 issues
     def clean_value(val):
@@ -1064,69 +1157,33 @@ def process_mzML():
 
     result2 = {k: clean_value(v) for k, v in result.items()}
 
-    # Para 3D spikes y para obtener los datos base
-    df_summary = None
-    df_json_path = 'uploads/temp_chunks/df_summary.json'
-
     # Verificar si es una petición AJAX (solo cambio de filtro, no nuevo archivo)
     is_ajax = request.headers.get('X-Requested-With') == 'XMLHttpRequest'
 
-    # Si es AJAX y tenemos el DataFrame guardado, usarlo
-    if is_ajax and 'df_summary_path' in session and os.path.exists(session.get('df_summary_path', '')):
-        try:
-            df_summary = pd.read_json(session.get('df_summary_path'))
-            df_summary['filter_type'] = filter_type
-        except Exception as e:
-            print(f"Error reading cached df_summary: {e}")
-            df_summary = None
-
-    # Si no tenemos DataFrame (nuevo archivo o error al leer), cargarlo
-    if df_summary is None:
-        try:
-            df_summary = load_and_process_data(path)
-            df_summary['filter_type'] = filter_type
-            # Guardar el DataFrame
-            os.makedirs('uploads/temp_chunks', exist_ok=True)
-            df_summary.to_json(df_json_path)
-            session['df_summary_path'] = df_json_path
-            # Solo un flag, no el JSON completo
-            session['df_summary'] = 'loaded'
-        except Exception as e:
-            alert = f"Error loading and processing data: {str(e)}"
-            return render_template('summary.html', error_alert=alert, page='Summary')
+    if summary['plot_error']:
+        alert = f"Error generating TIC plots: {summary['plot_error']}"
+        if is_ajax:
+            return jsonify({'error': alert}), 500
+        return render_template('summary.html', error_alert=alert, page='Summary')
 
-    # Validar que el DataFrame tenga datos válidos
-    if df_summary is None or df_summary.empty or df_summary['TIC'].isna().all():
+    # Validar que el fichero tenga datos válidos
+    if summary['spikes'] is None:
         alert = "Error: No valid data found in the file."
         return render_template('summary.html', error_alert=alert, page='Summary')
 
-    if is_ajax:
-        print("AJAX request detected for summary")
-        try:
-            fig = plot_tic(df_summary=df_summary, mode='3d-spikes',
-                           max_points=10000, filter_type=filter_type)
-            fig2, _ = plot_tic(df_summary=df_summary, mode='2d',
-                               max_points=10000, filter_type=filter_type)
-        except Exception as e:
-            return jsonify({'error': str(e)}), 500
-
-        plot_html = pio.to_html(fig, full_html=False, config={"toImageButtonOptions": {
-                                "format": "svg"}, "displaylogo": False, "responsive": True})
-        plot_html2 = pio.to_html(fig2, full_html=False, config={"toImageButtonOptions": {
-                                 "format": "svg"}, "displaylogo": False, "responsive": True})
-        return jsonify({'plot_html': plot_html, 'plot_html2': plot_html2})
-
     try:
-        fig = plot_tic(df_summary=df_summary, mode='3d-spikes',
-                       max_points=10000, filter_type=filter_type)
+        fig = spikes_figure(*summary['spikes'], filter_type)
     except Exception as e:
+        if is_ajax:
+            return jsonify({'error': str(e)}), 500
         alert = f"Error generating 3D TIC plot: {str(e)}"
         return render_template('summary.html', error_alert=alert, page='Summary')
 
     try:
-        fig2, _ = plot_tic(df_summary=df_summary, mode='2d',
-                           max_points=10000, filter_type=filter_type)
+        fig2 = surface_figure(*summary['surface'], filter_type)
     except Exception as e:
+        if is_ajax:
+            return jsonify({'error': str(e)}), 500
         alert = f"Error generating 2D TIC plot: {str(e)}"
         return render_template('summary.html', error_alert=alert, page='Summary')
 
@@ -1136,6 +1193,10 @@ def process_mzML():
     plot_html2 = pio.to_html(fig2, full_html=False, config={"toImageButtonOptions": {
                              "format": "svg"}, "displaylogo": False, "responsive": True})
 
+    if is_ajax:
+        print("AJAX request detected for summary")
+        return jsonify({'plot_html': plot_html, 'plot_html2': plot_html2})
+
     # Otherwise, return the full page
     return render_template('summary.html', result=result2, filename=filename, plot_html=plot_html, plot_html2=plot_html2, selected_filter=filter_type, page='Summary')
 
@@ -1157,19 +1218,13 @@ def process_adducts():
     uploads_dir = os.path.join(os.getcwd(), ADDUCTS_DIR)
     os.makedirs(uploads_dir, exist_ok=True)
 
-    files = request.files.getlist('filename')
-    if not all(file.filename.endswith('.featureXML') for file in files):
+    # Save uploaded files and get their paths
+    file_paths = resolve_uploaded_files('filename', uploads_dir)
+    if not all(file_path.endswith('.featureXML') for file_path in file_paths):
         return render_template('adducts.html',
                                error_alert="Please upload only .featureXML files.",
                                page='Adducts')
 
-     # Save uploaded files and get their paths
-    file_paths = []
-    for file in files:
-        file_path = os.path.join(uploads_dir, file.filename)
-        file.save(file_path)
-        file_paths.append(file_path)
-
     for file in file_paths:
         print(f"Uploaded file: {file}")
 
@@ -1259,16 +1314,10 @@ def process_centroiding():
         uploads_dir = os.path.join(os.getcwd(), CENTROIDS_DIR)
         os.makedirs(uploads_dir, exist_ok=True)
 
-        files = request.files.getlist('filename')
-        file_paths = []
+        file_paths = resolve_uploaded_files('filename', uploads_dir)
 
-        for file in files:
-            if file.filename.endswith('.mzML'):
-                path = f"{uploads_dir}/{file.filename}"
-                if not os.path.exists(path):
-                    file.save(path)
-                file_paths.append(path)
-            else:
+        for path in file_paths:
+            if not path.endswith('.mzML'):
                 error_alert = 'Please upload only .mzML files for centroiding.'
                 session['step_status'] = 'started'
                 return render_template('centroiding.html', download_links=None, error_alert=error_alert, page='Centroiding')
@@ -1320,18 +1369,14 @@ def process_ami():
     os.makedirs(uploads_dir, exist_ok=True)
     session['step_status'] = 'started'
 
-    consensus_path = request.files.get('filename1')
-    consensus_file = os.path.join(uploads_dir, consensus_path.filename)
-    consensus_path.save(consensus_file)
-    dbmapping = request.files.get('filename2')
-    dbmapping_file = os.path.join(uploads_dir, dbmapping.filename)
-    dbmapping.save(dbmapping_file)
-    dbstruct = request.files.get('filename3')
-    dbstruct_file = os.path.join(uploads_dir, dbstruct.filename)
-    dbstruct.save(dbstruct_file)
-    adducts = request.files.get('filename4')
-    adducts_file = os.path.join(uploads_dir, adducts.filename)
-    adducts.save(adducts_file)
+    def uploaded_file(field):
+        paths = resolve_uploaded_files(field, uploads_dir)
+        return paths[0] if paths else ''
+
+    consensus_file = uploaded_file('filename1')
+    dbmapping_file = uploaded_file('filename2')
+    dbstruct_file = uploaded_file('filename3')
+    adducts_file = uploaded_file('filename4')
 
     if not consensus_file.endswith('.csv'):
         return render_template('accurate_mass.html', error_alert="Please upload a valid .csv file for consensus.", page='Accurate Mass Search')
@@ -1450,6 +1495,14 @@ def backup_storage():
     return render_template('backup_storage.html', page='Backup Storage')
 
 
+@app.route('/experiment_cache_stats', methods=['GET'])
+def experiment_cache_stats():
+    """
+    Contadores de aciertos/fallos y memoria usada por la caché de MSExperiment
+    """
+    return jsonify(cache_stats())
+
+
 # Backup storage page functions ####################################
 @app.route('/show_upload_folders', methods=['GET', 'POST'])
 def show_upload_folders():
@@ -1466,6 +1519,13 @@ def show_upload_folders():
         'Samples': 'mzML_samples',
     }
     folder_contents = {}
+    # Logical bytes count every copy; physical bytes count each deduplicated blob once
+    usage = storage_usage(list(upload_folders.values()) + [CHUNKS_DIR])
+    storage = {
+        'logical': float(usage['logical_bytes']/1024/1024).__round__(2),
+        'physical': float(usage['physical_bytes']/1024/1024).__round__(2),
+        'saved': float((usage['logical_bytes'] - usage['physical_bytes'])/1024/1024).__round__(2),
+    }
     for folder_name, folder_path in upload_folders.items():
         files_info = []
         if os.path.exists(folder_path):
@@ -1485,7 +1545,7 @@ def show_upload_folders():
             folder_contents[folder_name] = files_info
         else:
             folder_contents[folder_name] = []
-    return render_template('backup_storage.html', folder_contents=folder_contents, page='Backup Storage')
+    return render_template('backup_storage.html', folder_contents=folder_contents, storage=storage, page='Backup Storage')
 
 # Cleaning folders endpoint/function ####################################
 
@@ -1515,8 +1575,16 @@ def clean_folders():
                 try:
                     if os.path.isfile(file_path):
                         os.remove(file_path)
+                        # Release the parsed experiment of the removed file
+                        invalidate(file_path)
                 except Exception as e:
                     print(f"Error removing file {file_path}: {e}")
+    # Remove the blobs, peak sidecars and cached mass traces that no folder references anymore
+    prune_uploads(CHUNKS_DIR)
+    prune_blobs(BLOBS_DIR)
+    prune_sidecars()
+    prune_summaries()
+    prune_traces()
     return jsonify({'status': 'ok'})
 
 # Upload folders ###########################################################
@@ -1604,10 +1672,10 @@ def inject_workflow_vars():
     current_steps = session.get('current_steps', [])
     finished_steps = session.get('finished_steps', [])
     step_status = session.get('step_status', 'not started')
-    if 'df_summary' in session:
-        df_summary = pd.read_json(session.get('df_summary_path'))
-    else:
-        df_summary = None
+    # Table of the last summarized file (cache lookup only, never parses the file)
+    summary_file = session.get('summary_file')
+    summary = get_summary(summary_file, build=False) if summary_file and os.path.exists(summary_file) else None
+    df_summary = summary['table'] if summary else None
     return {
         'workflow_id': workflow_id,
         'current_workflow': current_workflow,
@@ -1716,4 +1784,6 @@ def generated_files(filename):
 # -------------------------------------------------------------------
 
 
-app.run(host='0.0.0.0', port=5000)
+# Guarded: the worker processes of the parallel pool import this module too
+if __name__ == '__main__':
+    app.run(host='0.0.0.0', port=5000)
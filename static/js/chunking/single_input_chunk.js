@@ -1,20 +1,26 @@
 // Chunks upload with progress bar
 document.addEventListener('DOMContentLoaded', function() {
     const form = document.getElementById('uploadForm');
-    const fileInput = document.getElementById('inputGroupFile04');
     const progressContainer = document.getElementById('progressContainer');
     const progressBar = document.getElementById('uploadProgress');
     const progressPercent = document.getElementById('progressPercent');
 
-    if (form) {
+    // Este script se incluye en base.html y en algunas páginas: registrar el submit una sola vez
+    if (form && !form.dataset.chunkUpload) {
+        form.dataset.chunkUpload = '1';
         form.addEventListener('submit', function(e) {
-            const files = fileInput.files;
-            if (!files.length) return;
+            // Todos los archivos de todos los inputs del formulario, con el nombre de su campo
+            const fileInputs = Array.from(form.querySelectorAll('input[type="file"]'));
+            const entries = [];
+            fileInputs.forEach(input => {
+                for (let i = 0; i < input.files.length; i++) entries.push({ field: input.name, file: input.files[i] });
+            });
+            if (!entries.length) return;
             e.preventDefault();
 
             // --- NUEVO: calcular progreso global por bytes ---
             let totalBytes = 0;
-            for (let i = 0; i < files.length; i++) totalBytes += files[i].size;
+            for (let i = 0; i < entries.length; i++) totalBytes += entries[i].file.size;
             let uploadedBytes = 0;
 
             let fileIndex = 0;
@@ -22,9 +28,10 @@ document.addEventListener('DOMContentLoaded', function() {
             progressBar.style.width = '0%';
             progressPercent.textContent = '0%';
 
-            // helper: generar id simple único por archivo
+            // helper: id estable por archivo y carpeta destino, para poder reanudar la subida
             function generateUploadId(file) {
-                return `${Date.now()}-${Math.floor(Math.random() * 1e9)}-${file.name.replace(/\s+/g, '_')}`;
+                const target = window.targetDir || 'mzML_samples';
+                return `${target}-${file.name}-${file.size}-${file.lastModified}`.replace(/[^A-Za-z0-9._-]/g, '_');
             }
 
             // helper: fetch con timeout usando AbortController
@@ -35,118 +42,274 @@ document.addEventListener('DOMContentLoaded', function() {
                 return fetch(url, options).finally(() => clearTimeout(timer));
             }
 
+            // helper: CRC32 de un chunk (el servidor lo verifica al escribirlo)
+            const crcTable = (function() {
+                const table = new Uint32Array(256);
+                for (let n = 0; n < 256; n++) {
+                    let c = n;
+                    for (let k = 0; k < 8; k++) c = (c & 1) ? (0xEDB88320 ^ (c >>> 1)) : (c >>> 1);
+                    table[n] = c >>> 0;
+                }
+                return table;
+            })();
+            function crc32(buffer) {
+                const bytes = new Uint8Array(buffer);
+                let crc = 0xFFFFFFFF;
+                for (let i = 0; i < bytes.length; i++) crc = crcTable[(crc ^ bytes[i]) & 0xFF] ^ (crc >>> 8);
+                return ((crc ^ 0xFFFFFFFF) >>> 0).toString(16).padStart(8, '0');
+            }
+
+            // helper: SHA-256 incremental del archivo completo (sin cargarlo entero en memoria)
+            const sha256K = new Uint32Array([
+                0x428a2f98, 0x71374491, 0xb5c0fbcf, 0xe9b5dba5, 0x3956c25b, 0x59f111f1, 0x923f82a4, 0xab1c5ed5,
+                0xd807aa98, 0x12835b01, 0x243185be, 0x550c7dc3, 0x72be5d74, 0x80deb1fe, 0x9bdc06a7, 0xc19bf174,
+                0xe49b69c1, 0xefbe4786, 0x0fc19dc6, 0x240ca1cc, 0x2de92c6f, 0x4a7484aa, 0x5cb0a9dc, 0x76f988da,
+                0x983e5152, 0xa831c66d, 0xb00327c8, 0xbf597fc7, 0xc6e00bf3, 0xd5a79147, 0x06ca6351, 0x14292967,
+                0x27b70a85, 0x2e1b2138, 0x4d2c6dfc, 0x53380d13, 0x650a7354, 0x766a0abb, 0x81c2c92e, 0x92722c85,
+                0xa2bfe8a1, 0xa81a664b, 0xc24b8b70, 0xc76c51a3, 0xd192e819, 0xd6990624, 0xf40e3585, 0x106aa070,
+                0x19a4c116, 0x1e376c08, 0x2748774c, 0x34b0bcb5, 0x391c0cb3, 0x4ed8aa4a, 0x5b9cca4f, 0x682e6ff3,
+                0x748f82ee, 0x78a5636f, 0x84c87814, 0x8cc70208, 0x90befffa, 0xa4506ceb, 0xbef9a3f7, 0xc67178f2
+            ]);
+            function sha256Blocks(state, w, bytes, offset, end) {
+                let h0 = state[0], h1 = state[1], h2 = state[2], h3 = state[3];
+                let h4 = state[4], h5 = state[5], h6 = state[6], h7 = state[7];
+                for (; offset < end; offset += 64) {
+                    for (let i = 0; i < 16; i++) {
+                        const j = offset + i * 4;
+                        w[i] = (bytes[j] << 24) | (bytes[j + 1] << 16) | (bytes[j + 2] << 8) | bytes[j + 3];
+                    }
+                    for (let i = 16; i < 64; i++) {
+                        const x = w[i - 15], y = w[i - 2];
+                        const s0 = ((x >>> 7) | (x << 25)) ^ ((x >>> 18) | (x << 14)) ^ (x >>> 3);
+                        const s1 = ((y >>> 17) | (y << 15)) ^ ((y >>> 19) | (y << 13)) ^ (y >>> 10);
+                        w[i] = (w[i - 16] + s0 + w[i - 7] + s1) | 0;
+                    }
+                    let a = h0, b = h1, c = h2, d = h3, f = h5, g = h6, h = h7, e2 = h4;
+                    for (let i = 0; i < 64; i++) {
+                        const S1 = ((e2 >>> 6) | (e2 << 26)) ^ ((e2 >>> 11) | (e2 << 21)) ^ ((e2 >>> 25) | (e2 << 7));
+                        const t1 = (h + S1 + ((e2 & f) ^ (~e2 & g)) + sha256K[i] + w[i]) | 0;
+                        const S0 = ((a >>> 2) | (a << 30)) ^ ((a >>> 13) | (a << 19)) ^ ((a >>> 22) | (a << 10));
+                        const t2 = (S0 + ((a & b) ^ (a & c) ^ (b & c))) | 0;
+                        h = g; g = f; f = e2; e2 = (d + t1) | 0; d = c; c = b; b = a; a = (t1 + t2) | 0;
+                    }
+                    h0 = (h0 + a) | 0; h1 = (h1 + b) | 0; h2 = (h2 + c) | 0; h3 = (h3 + d) | 0;
+                    h4 = (h4 + e2) | 0; h5 = (h5 + f) | 0; h6 = (h6 + g) | 0; h7 = (h7 + h) | 0;
+                }
+                state[0] = h0; state[1] = h1; state[2] = h2; state[3] = h3;
+                state[4] = h4; state[5] = h5; state[6] = h6; state[7] = h7;
+            }
+            function sha256File(file, onProgress) {
+                const sliceSize = 4 * 1024 * 1024; // múltiplo de 64 bytes
+                const state = new Int32Array([0x6a09e667, 0xbb67ae85, 0x3c6ef372, 0xa54ff53a,
+                                              0x510e527f, 0x9b05688c, 0x1f83d9ab, 0x5be0cd19]);
+                const w = new Int32Array(64);
+                let position = 0;
+                function next() {
+                    if (position + sliceSize < file.size) {
+                        return file.slice(position, position + sliceSize).arrayBuffer().then(buffer => {
+                            sha256Blocks(state, w, new Uint8Array(buffer), 0, buffer.byteLength);
+                            position += sliceSize;
+                            onProgress(position / file.size);
+                            return next();
+                        });
+                    }
+                    // último bloque: añadir padding y longitud en bits
+                    return file.slice(position).arrayBuffer().then(buffer => {
+                        const rest = buffer.byteLength;
+                        const padded = new Uint8Array(Math.ceil((rest + 9) / 64) * 64);
+                        padded.set(new Uint8Array(buffer));
+                        padded[rest] = 0x80;
+                        const bits = file.size * 8;
+                        const view = new DataView(padded.buffer);
+                        view.setUint32(padded.length - 8, Math.floor(bits / 0x100000000));
+                        view.setUint32(padded.length - 4, bits >>> 0);
+                        sha256Blocks(state, w, padded, 0, padded.length);
+                        onProgress(1);
+                        return Array.from(state, v => (v >>> 0).toString(16).padStart(8, '0')).join('');
+                    });
+                }
+                return next();
+            }
+
+            // helper: preguntar al servidor si ya tiene ese contenido; si lo tiene, lo enlaza en la carpeta destino
+            function checkUpload(file, sha256) {
+                return fetchWithTimeout('/check_upload', {
+                    method: 'POST',
+                    headers: { 'Content-Type': 'application/json' },
+                    body: JSON.stringify({
+                        sha256: sha256,
+                        filename: file.name,
+                        target_dir: window.targetDir || 'mzML_samples'
+                    })
+                }, 30000)
+                    .then(response => response.ok ? response.json() : {})
+                    .then(data => data && data.status === 'exists')
+                    .catch(() => false);
+            }
+
+            function updateProgress() {
+                const percent = Math.floor((uploadedBytes / totalBytes) * 100);
+                progressBar.style.width = percent + '%';
+                progressPercent.textContent = percent + '%';
+            }
+
+            // helper: índices de chunks que el servidor ya tiene de una subida anterior
+            function fetchReceivedChunks(uploadId, totalChunks, chunkSize, fileSize) {
+                return fetchWithTimeout('/upload_status?upload_id=' + encodeURIComponent(uploadId), {}, 30000)
+                    .then(response => response.ok ? response.json() : {})
+                    .then(data => {
+                        if (data && data.status === 'incomplete' && data.total === totalChunks &&
+                            data.chunk_size === chunkSize && data.total_size === fileSize) {
+                            return new Set(data.received || []);
+                        }
+                        return new Set();
+                    })
+                    .catch(() => new Set());
+            }
+
             function uploadFile(file, onComplete, onError) {
                 const chunkSize = 2 * 1024 * 1024; // 2MB por chunk
-                const totalChunks = Math.ceil(file.size / chunkSize);
-                let currentChunk = 0;
+                const parallelUploads = window.parallelUploads || 4; // chunks enviados a la vez
+                const totalChunks = Math.max(1, Math.ceil(file.size / chunkSize));
                 const uploadId = generateUploadId(file);
+                const maxRetries = 3;
+                let failed = false;
 
-                function uploadNextChunk() {
-                    const start = currentChunk * chunkSize;
+                function sendChunk(chunkIndex, attempt) {
+                    const start = chunkIndex * chunkSize;
                     const end = Math.min(start + chunkSize, file.size);
                     const chunk = file.slice(start, end);
-                    const formData = new FormData();
-                    formData.append('chunk', chunk);
-                    formData.append('filename', file.name);
-                    formData.append('upload_id', uploadId);
-                    formData.append('chunk_index', currentChunk);
-                    formData.append('total_chunks', totalChunks);
-                    formData.append('target_dir', window.targetDir || 'mzML_samples');
-
-                    const maxRetries = 3;
-                    let attempt = 0;
-
-                    function sendChunk() {
-                        attempt++;
-                        fetchWithTimeout('/upload_chunk', {
+                    return chunk.arrayBuffer().then(buffer => {
+                        const formData = new FormData();
+                        formData.append('chunk', chunk);
+                        formData.append('filename', file.name);
+                        formData.append('upload_id', uploadId);
+                        formData.append('chunk_index', chunkIndex);
+                        formData.append('total_chunks', totalChunks);
+                        formData.append('chunk_size', chunkSize);
+                        formData.append('total_size', file.size);
+                        formData.append('checksum', crc32(buffer));
+                        formData.append('target_dir', window.targetDir || 'mzML_samples');
+                        return fetchWithTimeout('/upload_chunk', {
                             method: 'POST',
                             body: formData
-                        }, 30000)
-                        .then(response => {
-                            if (!response.ok) {
-                                return response.text().then(text => {
-                                    let msg = `Server returned ${response.status}`;
-                                    try {
-                                        const j = JSON.parse(text || '{}');
-                                        msg = j.error || JSON.stringify(j) || msg;
-                                    } catch {}
-                                    return Promise.reject(new Error(msg));
-                                });
-                            }
-                            return response.text().then(txt => {
-                                try { return JSON.parse(txt || '{}'); } catch { return {}; }
+                        }, 30000);
+                    })
+                    .then(response => {
+                        if (!response.ok) {
+                            return response.text().then(text => {
+                                let msg = `Server returned ${response.status}`;
+                                try {
+                                    const j = JSON.parse(text || '{}');
+                                    msg = j.error || JSON.stringify(j) || msg;
+                                } catch {}
+                                return Promise.reject(new Error(msg));
                             });
-                        })
-                        .then(data => {
-                            // actualizar progreso global por bytes reales
-                            uploadedBytes += chunk.size;
-                            const percent = Math.floor((uploadedBytes / totalBytes) * 100);
-                            progressBar.style.width = percent + '%';
-                            progressPercent.textContent = percent + '%';
-
-                            currentChunk++;
-                            if ((data && data.status === 'complete') || currentChunk >= totalChunks) {
-                                // asegurar 100% si acabó este archivo y es el último
-                                if (uploadedBytes === totalBytes) {
-                                    progressBar.style.width = '100%';
-                                    progressPercent.textContent = '100%';
-
-                                    if (typeof window.showProcessingSpinner === 'function') {
-                                        window.showProcessingSpinner();
-                                    }
-                                    setTimeout(() => {
-                                        form.submit();
-                                    }, 300);
-                                }
-                                onComplete();
-                            } else {
-                                uploadNextChunk();
-                            }
-                        })
-                        .catch(err => {
-                            console.error(`Chunk ${currentChunk} upload error (attempt ${attempt}):`, err);
-                            if (attempt < maxRetries) {
-                                const baseDelay = 500 * Math.pow(2, attempt - 1);
-                                const jitter = Math.floor(Math.random() * 200);
-                                const delay = baseDelay + jitter;
-                                setTimeout(sendChunk, delay);
-                            } else {
-                                // error definitivo: informar y detener subida
-                                onError(err);
-                            }
-                        });
+                        }
+                        uploadedBytes += chunk.size;
+                        updateProgress();
+                    })
+                    .catch(err => {
+                        console.error(`Chunk ${chunkIndex} upload error (attempt ${attempt}):`, err);
+                        if (attempt < maxRetries && !failed) {
+                            const baseDelay = 500 * Math.pow(2, attempt - 1);
+                            const jitter = Math.floor(Math.random() * 200);
+                            return new Promise(resolve => setTimeout(resolve, baseDelay + jitter))
+                                .then(() => sendChunk(chunkIndex, attempt + 1));
+                        }
+                        // error definitivo: los chunks ya recibidos se conservan para reanudar
+                        return Promise.reject(err);
+                    });
+                }
+
+                fetchReceivedChunks(uploadId, totalChunks, chunkSize, file.size).then(received => {
+                    // Cola de chunks pendientes; los ya recibidos cuentan como progreso
+                    const pending = [];
+                    for (let i = 0; i < totalChunks; i++) {
+                        if (received.has(i)) {
+                            uploadedBytes += Math.min(chunkSize, file.size - i * chunkSize);
+                        } else {
+                            pending.push(i);
+                        }
                     }
-                    sendChunk();
+                    updateProgress();
+
+                    function worker() {
+                        if (failed || !pending.length) return Promise.resolve();
+                        return sendChunk(pending.shift(), 1).then(worker);
+                    }
+                    const workers = [];
+                    for (let w = 0; w < Math.min(parallelUploads, pending.length); w++) workers.push(worker());
+
+                    Promise.all(workers).then(() => {
+                        if (uploadedBytes === totalBytes) {
+                            // asegurar 100% si acabó el último archivo
+                            progressBar.style.width = '100%';
+                            progressPercent.textContent = '100%';
+                        }
+                        onComplete();
+                    }).catch(err => {
+                        failed = true;
+                        onError(err);
+                    });
+                });
+            }
+
+            function submitForm() {
+                // Los archivos ya están en el servidor: enviar solo sus nombres y hashes, no su contenido
+                if (typeof window.showProcessingSpinner === 'function') {
+                    window.showProcessingSpinner();
                 }
-                uploadNextChunk();
+                entries.forEach(entry => {
+                    const hidden = document.createElement('input');
+                    hidden.type = 'hidden';
+                    hidden.name = entry.field;
+                    hidden.value = entry.file.name;
+                    form.appendChild(hidden);
+                    const hiddenHash = document.createElement('input');
+                    hiddenHash.type = 'hidden';
+                    hiddenHash.name = entry.field + '_sha256';
+                    hiddenHash.value = entry.sha256 || '';
+                    form.appendChild(hiddenHash);
+                });
+                fileInputs.forEach(input => { input.disabled = true; });
+                form.submit();
             }
 
             function uploadAllFiles() {
-                if (fileIndex >= files.length) {
+                if (fileIndex >= entries.length) {
                     // Todos los archivos subidos, enviar el form
-                    if (typeof window.showProcessingSpinner === 'function') {
-                        window.showProcessingSpinner();
-                    }
-                    for (let i = 0; i < files.length; i++) {
-                        const hidden = document.createElement('input');
-                        hidden.type = 'hidden';
-                        hidden.name = 'filename';
-                        hidden.value = files[i].name;
-                        form.appendChild(hidden);
-                    }
-                    form.submit();
+                    submitForm();
                     return;
                 }
-                uploadFile(files[fileIndex], function() {
+                const entry = entries[fileIndex];
+                const file = entry.file;
+                function next() {
                     fileIndex++;
                     uploadAllFiles();
-                }, function(err) {
-                    alert('Error al subir "' + files[fileIndex].name + '": ' + (err.message || JSON.stringify(err)));
-                    console.error('Upload aborted for file:', files[fileIndex].name, err);
+                }
+                function fail(err) {
+                    alert('Error al subir "' + file.name + '": ' + (err.message || JSON.stringify(err)));
+                    console.error('Upload aborted for file:', file.name, err);
                     // detener cualquier otra subida: no avanzar fileIndex
-                });
+                }
+                sha256File(file, fraction => {
+                    progressPercent.textContent = `Checking ${file.name}: ${Math.floor(fraction * 100)}%`;
+                }).then(sha256 => {
+                    entry.sha256 = sha256;
+                    return checkUpload(file, sha256);
+                }).then(exists => {
+                    if (exists) {
+                        // El servidor ya tiene este contenido: no hace falta transferirlo
+                        uploadedBytes += file.size;
+                        updateProgress();
+                        next();
+                    } else {
+                        uploadFile(file, next, fail);
+                    }
+                }).catch(fail);
             }
             uploadAllFiles();
         });
     }
-});
\ No newline at end of file
+});